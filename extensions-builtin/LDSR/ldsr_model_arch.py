@@ -14,17 +14,12 @@ from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.util import instantiate_from_config, ismap
 from modules import shared, sd_hijack
 
-cached_ldsr_model: torch.nn.Module = None
-
 
 # Create LDSR Class
 class LDSR:
     def load_model_from_config(self, half_attention):
-        global cached_ldsr_model
-
-        if shared.opts.ldsr_cached and cached_ldsr_model is not None:
-            print("Loading model from cache")
-            model: torch.nn.Module = cached_ldsr_model
+        if self.model is not None:
+            model: torch.nn.Module = self.model
         else:
             print(f"Loading model from {self.modelPath}")
             _, extension = os.path.splitext(self.modelPath)
@@ -46,14 +41,16 @@ class LDSR:
             sd_hijack.model_hijack.hijack(model) # apply optimization
             model.eval()
 
+            # kept with this object, which stays in the upscaler model cache and counts towards its memory limit
             if shared.opts.ldsr_cached:
-                cached_ldsr_model = model
+                self.model = model
 
         return {"model": model}
 
     def __init__(self, model_path, yaml_path):
         self.modelPath = model_path
         self.yamlPath = yaml_path
+        self.model = None
 
     @staticmethod
     def run(model, selected_path, custom_steps, eta):
@@ -43,7 +43,13 @@ class UpscalerLDSR(Upscaler):
                                   file_name="project.yaml", progress=True)
 
         try:
-            return LDSR(model, yaml)
+            ldsr = LDSR(model, yaml)
+
+            # load the network now so that the upscaler model cache can tell its size and time the load
+            if shared.opts.ldsr_cached:
+                ldsr.load_model_from_config(half_attention=False)
+
+            return ldsr
 
         except Exception:
             print("Error importing LDSR:", file=sys.stderr)
@@ -51,7 +57,7 @@ class UpscalerLDSR(Upscaler):
         return None
 
     def do_upscale(self, img, path):
-        ldsr = self.load_model(path)
+        ldsr = self.load_model_cached(path)
         if ldsr is None:
             print("NO LDSR!")
             return img
@@ -23,4 +23,4 @@ class ExtraNetworkLora(extra_networks.ExtraNetwork):
         lora.load_loras(names, multipliers)
 
     def deactivate(self, p):
-        pass
+        lora.restore_weights()
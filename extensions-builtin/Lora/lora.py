@@ -1,9 +1,16 @@
+import atexit
 import glob
+import json
 import os
 import re
+import threading
+import time
+
+import filelock
 import torch
 
-from modules import shared, devices, sd_models
+from modules import shared, devices, sd_models, hashes, lru_cache, errors
+from modules.paths import data_path
 
 re_digits = re.compile(r"\d+")
 re_unet_down_blocks = re.compile(r"lora_unet_down_blocks_(\d+)_attentions_(\d+)_(.+)")
@@ -60,6 +67,15 @@ class LoraUpDownModule:
         self.alpha = None
 
 
+class MergedWeights:
+    """Lora deltas merged into the weights of a model's layers, along with the original weights to restore."""
+
+    def __init__(self, key, backups, model):
+        self.key = key
+        self.backups = backups
+        self.model = model
+
+
 def assign_lora_names_to_compvis_modules(sd_model):
     lora_layer_mapping = {}
 
@@ -75,6 +91,9 @@ def assign_lora_names_to_compvis_modules(sd_model):
 
     sd_model.lora_layer_mapping = lora_layer_mapping
 
+    # parsed Lora are only valid for models with the same layers; this tells such models apart in loaded_cache keys
+    sd_model.lora_layout = hash(tuple(lora_layer_mapping))
+
 
 def load_lora(name, filename):
     lora = LoraModule(name)
@@ -127,6 +146,106 @@ def load_lora(name, filename):
     return lora
 
 
+def lora_size(lora):
+    return sum(module.weight.numel() * module.weight.element_size() for lora_module in lora.modules.values() for module in (lora_module.up, lora_module.down) if module is not None)
+
+
+def get_lora(name, filename):
+    """returns the Lora parsed for the current model from loaded_cache, reading the file if it is not there or has
+    changed since it was read"""
+
+    key = (filename, os.path.getmtime(filename), shared.sd_model.lora_layout)
+
+    lora = loaded_cache.get(key)
+    if lora is not None:
+        return lora
+
+    start = time.perf_counter()
+    lora = load_lora(name, filename)
+    loaded_cache.record_load(time.perf_counter() - start)
+
+    for old_key in loaded_cache.keys():
+        if old_key[0] == filename and old_key[2] == key[2]:
+            loaded_cache.pop(old_key)
+
+    loaded_cache.put(key, lora)
+
+    return lora
+
+
+def record_use(name):
+    """counts a use of the Lora in memory; the counts are added to usage_filename in the background"""
+
+    global usage_writer
+
+    with usage_lock:
+        usage_pending[name] = usage_pending.get(name, 0) + 1
+
+        if usage_writer is None or not usage_writer.is_alive():
+            usage_writer = threading.Thread(target=usage_writer_loop, name="lora-usage", daemon=True)
+            usage_writer.start()
+
+
+def read_usage():
+    try:
+        with open(usage_filename, "r", encoding="utf8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def flush_usage():
+    """adds the counts recorded since the last flush to usage_filename; the file is locked while it is read and
+    written, so counts from several processes add up"""
+
+    global usage_pending
+
+    with usage_lock:
+        pending, usage_pending = usage_pending, {}
+
+    if not pending:
+        return
+
+    with filelock.FileLock(usage_filename + ".lock"):
+        usage = read_usage()
+        for name, count in pending.items():
+            usage[name] = usage.get(name, 0) + count
+
+        with open(usage_filename + ".tmp", "w", encoding="utf8") as file:
+            json.dump(usage, file)
+        os.replace(usage_filename + ".tmp", usage_filename)
+
+
+def usage_writer_loop():
+    while True:
+        time.sleep(usage_flush_seconds)
+
+        try:
+            flush_usage()
+        except Exception as e:
+            errors.display(e, "saving Lora usage counts")
+
+
+def preload_loras(sd_model):
+    """reads the most used Lora into loaded_cache, as many as lora_preload_count says and the cache has room for"""
+
+    usage = read_usage()
+    with usage_lock:
+        for name, count in usage_pending.items():
+            usage[name] = usage.get(name, 0) + count
+
+    names = sorted([name for name in usage if name in available_loras], key=lambda name: usage[name], reverse=True)
+
+    for name in names[:shared.opts.lora_preload_count]:
+        if loaded_cache.size >= loaded_cache.limit():
+            break
+
+        try:
+            get_lora(name, available_loras[name].filename)
+        except Exception as e:
+            errors.display(e, f"preloading Lora {name}")
+
+
 def load_loras(names, multipliers=None):
     already_loaded = {}
 
@@ -148,7 +267,7 @@ def load_loras(names, multipliers=None):
         lora_on_disk = loras_on_disk[i]
         if lora_on_disk is not None:
             if lora is None or os.path.getmtime(lora_on_disk.filename) > lora.mtime:
-                lora = load_lora(name, lora_on_disk.filename)
+                lora = get_lora(name, lora_on_disk.filename)
 
         if lora is None:
             print(f"Couldn't find Lora with name {name}")
@@ -156,10 +275,109 @@ def load_loras(names, multipliers=None):
 
         lora.multiplier = multipliers[i] if multipliers else 1.0
         loaded_loras.append(lora)
+        record_use(name)
+
+    # in merge mode the deltas are added to the weights once here instead of in every forward call
+    if not shared.opts.lora_merge_weights or not merge_loaded_loras():
+        restore_weights()
+
+
+def lora_scale(lora, lora_module):
+    return lora.multiplier * (lora_module.alpha / lora_module.up.weight.shape[1] if lora_module.alpha else 1.0)
+
+
+def can_merge(sd_module):
+    return type(sd_module) == torch.nn.Linear or (type(sd_module) == torch.nn.Conv2d and sd_module.kernel_size == (1, 1))
+
+
+def merge_key():
+    return shared.sd_model.sd_checkpoint_info.filename, tuple((lora.name, lora.multiplier, lora.mtime) for lora in loaded_loras)
+
+
+def merge_loaded_loras():
+    """adds the deltas of loaded_loras to the weights of the layers they apply to, keeping the original weights to
+    restore later; returns False, changing nothing, if some layer can not be merged"""
+
+    global merged_weights
+
+    key = merge_key()
+    if merged_weights is not None and merged_weights.key == key:
+        return True
+
+    restore_weights()
+
+    if shared.opts.lora_apply_to_outputs:
+        return False
+
+    layers = {}
+    for lora in loaded_loras:
+        for name, lora_module in lora.modules.items():
+            if lora_module.up is not None and lora_module.down is not None:
+                layers.setdefault(name, []).append((lora, lora_module))
+
+    if not all(can_merge(shared.sd_model.lora_layer_mapping[name]) for name in layers):
+        return False
+
+    cached = merged_cache.get(key)
+    merged = {} if cached is None and shared.opts.lora_merge_cache_mb > 0 else None
+    backups = []
+
+    with torch.no_grad():
+        for name, lora_modules in layers.items():
+            weight = shared.sd_model.lora_layer_mapping[name].weight
+            backups.append((weight, weight.detach().clone()))
+
+            if cached is not None:
+                weight.copy_(cached[name])
+                continue
+
+            delta = sum(lora_module.up.weight.flatten(1).float() @ lora_module.down.weight.flatten(1).float() * lora_scale(lora, lora_module) for lora, lora_module in lora_modules)
+            weight.copy_(weight.float() + delta.reshape(weight.shape).to(weight.device))
+
+            if merged is not None:
+                merged[name] = weight.detach().clone()
+
+    if merged is not None:
+        merged_cache.put(key, merged)
+
+    merged_weights = MergedWeights(key, backups, shared.sd_model)
+
+    return True
+
+
+def restore_weights():
+    """puts back the original weights of layers that have Lora deltas merged into them"""
+
+    global merged_weights
+
+    if merged_weights is None:
+        return
+
+    with torch.no_grad():
+        for weight, backup in merged_weights.backups:
+            weight.copy_(backup)
+
+    merged_weights = None
+
+
+def forget_merged_weights(sd_model):
+    """on_model_loaded callback: if Lora were merged into the model that now has another checkpoint loaded, its weights
+    were replaced in place, so the backups are of the previous checkpoint and must not be restored; if they were merged
+    into another model, that one still gets its weights back. Loading only a VAE changes neither."""
+
+    global merged_weights
+
+    if merged_weights is None:
+        return
+
+    if merged_weights.model is not sd_model:
+        restore_weights()
+    elif merged_weights.key[0] != sd_model.sd_checkpoint_info.filename:
+        merged_weights = None
 
 
 def lora_forward(module, input, res):
-    if len(loaded_loras) == 0:
+    if len(loaded_loras) == 0 or merged_weights is not None:
         return res
 
     lora_layer_name = getattr(module, 'lora_layer_name', None)
@@ -199,9 +417,25 @@ def list_available_loras():
         name = os.path.splitext(os.path.basename(filename))[0]
 
         available_loras[name] = LoraOnDisk(name, filename)
+        hashes.sha256_in_background(filename, f'lora/{name}')
 
 
 available_loras = {}
 loaded_loras = []
+merged_weights = None
+
+# how many times each Lora was used, for preloading; counted in memory and added to the file every usage_flush_seconds
+usage_filename = os.path.join(data_path, "lora_usage.json")
+usage_flush_seconds = 60
+usage_lock = threading.Lock()
+usage_pending = {}
+usage_writer = None
+atexit.register(flush_usage)
+
+# parsed Lora files, on the device and ready to use, so that switching between Lora does not read them again
+loaded_cache = lru_cache.LruCache("lora_files", lambda: shared.opts.lora_cache_mb * 1024 * 1024, size_of=lora_size)
+
+# merged weights of recently used (checkpoint, Lora set) combinations, kept on the device they are used on
+merged_cache = lru_cache.LruCache("lora_merged", lambda: shared.opts.lora_merge_cache_mb * 1024 * 1024, size_of=lambda weights: sum(x.numel() * x.element_size() for x in weights.values()))
 
 list_available_loras()
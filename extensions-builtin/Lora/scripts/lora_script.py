@@ -8,6 +8,7 @@ from modules import script_callbacks, ui_extra_networks, extra_networks, shared
 
 
 def unload():
+    lora.restore_weights()
     torch.nn.Linear.forward = torch.nn.Linear_forward_before_lora
     torch.nn.Conv2d.forward = torch.nn.Conv2d_forward_before_lora
 
@@ -26,7 +27,9 @@ if not hasattr(torch.nn, 'Conv2d_forward_before_lora'):
 torch.nn.Linear.forward = lora.lora_Linear_forward
 torch.nn.Conv2d.forward = lora.lora_Conv2d_forward
 
+script_callbacks.on_model_loaded(lora.forget_merged_weights)
 script_callbacks.on_model_loaded(lora.assign_lora_names_to_compvis_modules)
+script_callbacks.on_model_loaded(lora.preload_loras)
 script_callbacks.on_script_unloaded(unload)
 script_callbacks.on_before_ui(before_ui)
 
@@ -34,5 +37,9 @@ script_callbacks.on_before_ui(before_ui)
 shared.options_templates.update(shared.options_section(('extra_networks', "Extra Networks"), {
     "sd_lora": shared.OptionInfo("None", "Add Lora to prompt", gr.Dropdown, lambda: {"choices": [""] + [x for x in lora.available_loras]}, refresh=lora.list_available_loras),
     "lora_apply_to_outputs": shared.OptionInfo(False, "Apply Lora to outputs rather than inputs when possible (experimental)"),
+    "lora_merge_weights": shared.OptionInfo(False, "Merge Lora into the model's weights once per generation instead of applying it in every layer call; faster sampling, not used with the option above"),
+    "lora_merge_cache_mb": shared.OptionInfo(0, "Memory for keeping merged weights of recently used Lora combinations on the device, in MB; 0 = merge every time", gr.Slider, {"minimum": 0, "maximum": 8192, "step": 128}),
+    "lora_cache_mb": shared.OptionInfo(0, "Memory for keeping recently used Lora on the device after they are read from disk, in MB; 0 = only the ones in use", gr.Slider, {"minimum": 0, "maximum": 16384, "step": 128}),
+    "lora_preload_count": shared.OptionInfo(0, "Number of most used Lora to read into the cache above when a model is loaded", gr.Slider, {"minimum": 0, "maximum": 100, "step": 1}),
 
 }))
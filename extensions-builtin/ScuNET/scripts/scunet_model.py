@@ -3,12 +3,12 @@ import sys
 import traceback
 
 import PIL.Image
-import numpy as np
 import torch
 from basicsr.utils.download_util import load_file_from_url
 
 import modules.upscaler
-from modules import devices, modelloader
+from modules import devices, modelloader, upscaler_tiling
+from modules.shared import opts
 from scunet_model_arch import SCUNet as net
 
 
@@ -43,27 +43,19 @@ class UpscalerScuNET(modules.upscaler.Upscaler):
         self.scalers = scalers
 
     def do_upscale(self, img: PIL.Image, selected_file):
+        return self.do_upscale_batch([img], selected_file)[0]
+
+    def do_upscale_batch(self, imgs, selected_file):
         torch.cuda.empty_cache()
 
-        model = self.load_model(selected_file)
+        model = self.load_model_cached(selected_file)
         if model is None:
-            return img
+            return imgs
 
         device = devices.get_device_for('scunet')
-        img = np.array(img)
-        img = img[:, :, ::-1]
-        img = np.moveaxis(img, 2, 0) / 255
-        img = torch.from_numpy(img).float()
-        img = img.unsqueeze(0).to(device)
-
-        with torch.no_grad():
-            output = model(img)
-        output = output.squeeze().float().cpu().clamp_(0, 1).numpy()
-        output = 255. * np.moveaxis(output, 0, 2)
-        output = output.astype(np.uint8)
-        output = output[:, :, ::-1]
+        imgs = upscaler_tiling.upscale_batch(model, imgs, opts.ESRGAN_tile, opts.ESRGAN_tile_overlap, device)
         torch.cuda.empty_cache()
-        return PIL.Image.fromarray(output, 'RGB')
+        return imgs
 
     def load_model(self, path: str):
         device = devices.get_device_for('scunet')
@@ -1,14 +1,11 @@
 import contextlib
 import os
 
-import numpy as np
 import torch
-from PIL import Image
 from basicsr.utils.download_util import load_file_from_url
-from tqdm import tqdm
 
-from modules import modelloader, devices, script_callbacks, shared
-from modules.shared import cmd_opts, opts, state
+from modules import modelloader, devices, script_callbacks, shared, upscaler_tiling
+from modules.shared import cmd_opts, opts
 from swinir_model_arch import SwinIR as net
 from swinir_model_arch_v2 import Swin2SR as net2
 from modules.upscaler import Upscaler, UpscalerData
@@ -38,16 +35,19 @@ class UpscalerSwinIR(Upscaler):
         self.scalers = scalers
 
     def do_upscale(self, img, model_file):
-        model = self.load_model(model_file)
+        return self.do_upscale_batch([img], model_file)[0]
+
+    def do_upscale_batch(self, imgs, model_file):
+        model = self.load_model_cached(model_file)
         if model is None:
-            return img
+            return imgs
         model = model.to(device_swinir, dtype=devices.dtype)
-        img = upscale(img, model)
+        imgs = upscale_batch(imgs, model)
         try:
             torch.cuda.empty_cache()
         except:
             pass
-        return img
+        return imgs
 
     def load_model(self, path, scale=4):
         if "http" in path:
@@ -104,68 +104,15 @@ def upscale(
         window_size=8,
         scale=4,
 ):
+    return upscale_batch([img], model, tile, tile_overlap, window_size, scale)[0]
+
+
+def upscale_batch(imgs, model, tile=None, tile_overlap=None, window_size=8, scale=4):
     tile = tile or opts.SWIN_tile
     tile_overlap = tile_overlap or opts.SWIN_tile_overlap
 
-
-    img = np.array(img)
-    img = img[:, :, ::-1]
-    img = np.moveaxis(img, 2, 0) / 255
-    img = torch.from_numpy(img).float()
-    img = img.unsqueeze(0).to(device_swinir, dtype=devices.dtype)
-    with torch.no_grad(), devices.autocast():
-        _, _, h_old, w_old = img.size()
-        h_pad = (h_old // window_size + 1) * window_size - h_old
-        w_pad = (w_old // window_size + 1) * window_size - w_old
-        img = torch.cat([img, torch.flip(img, [2])], 2)[:, :, : h_old + h_pad, :]
-        img = torch.cat([img, torch.flip(img, [3])], 3)[:, :, :, : w_old + w_pad]
-        output = inference(img, model, tile, tile_overlap, window_size, scale)
-        output = output[..., : h_old * scale, : w_old * scale]
-        output = output.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-        if output.ndim == 3:
-            output = np.transpose(
-                output[[2, 1, 0], :, :], (1, 2, 0)
-            )  # CHW-RGB to HCW-BGR
-        output = (output * 255.0).round().astype(np.uint8)  # float32 to uint8
-        return Image.fromarray(output, "RGB")
-
-
-def inference(img, model, tile, tile_overlap, window_size, scale):
-    # test the image tile by tile
-    b, c, h, w = img.size()
-    tile = min(tile, h, w)
-    assert tile % window_size == 0, "tile size should be a multiple of window_size"
-    sf = scale
-
-    stride = tile - tile_overlap
-    h_idx_list = list(range(0, h - tile, stride)) + [h - tile]
-    w_idx_list = list(range(0, w - tile, stride)) + [w - tile]
-    E = torch.zeros(b, c, h * sf, w * sf, dtype=devices.dtype, device=device_swinir).type_as(img)
-    W = torch.zeros_like(E, dtype=devices.dtype, device=device_swinir)
-
-    with tqdm(total=len(h_idx_list) * len(w_idx_list), desc="SwinIR tiles") as pbar:
-        for h_idx in h_idx_list:
-            if state.interrupted or state.skipped:
-                break
-
-            for w_idx in w_idx_list:
-                if state.interrupted or state.skipped:
-                    break
-                
-                in_patch = img[..., h_idx: h_idx + tile, w_idx: w_idx + tile]
-                out_patch = model(in_patch)
-                out_patch_mask = torch.ones_like(out_patch)
-
-                E[
-                ..., h_idx * sf: (h_idx + tile) * sf, w_idx * sf: (w_idx + tile) * sf
-                ].add_(out_patch)
-                W[
-                ..., h_idx * sf: (h_idx + tile) * sf, w_idx * sf: (w_idx + tile) * sf
-                ].add_(out_patch_mask)
-                pbar.update(1)
-    output = E.div_(W)
-
-    return output
+    with devices.autocast():
+        return upscaler_tiling.upscale_batch(model, imgs, tile, tile_overlap, device_swinir, devices.dtype, pad_to=window_size, desc="SwinIR tiles")
 
 
 def on_ui_settings():
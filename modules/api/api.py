@@ -3,6 +3,7 @@ import base64
 import io, os
 import time
 import json
+import queue
 import datetime
 import uvicorn
 from threading import Lock
@@ -10,33 +11,35 @@ from io import BytesIO
 from datetime import datetime, timedelta
 import sys
 
-from gradio.processing_utils import decode_base64_to_file
 from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials, OAuth2PasswordRequestForm
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 
 from secrets import compare_digest
 
 import modules.shared as shared
-from modules import sd_samplers, deepbooru, sd_hijack, postprocessing
+from modules import sd_samplers, deepbooru, sd_hijack, postprocessing, processing
 from modules.api.models import *
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
 from modules.textual_inversion.textual_inversion import create_embedding, train_embedding
 from modules.textual_inversion.preprocess import preprocess
 from modules.hypernetworks.hypernetwork import create_hypernetwork, train_hypernetwork
 from PIL import PngImagePlugin,Image
-from modules.sd_models import checkpoints_list
+from modules.sd_models import checkpoints_list, checkpoint_alisases
 from modules.sd_models_config import find_checkpoint_config_near_filename
 from modules.realesrgan_model import get_realesrgan_models
-from modules import devices
+from modules import devices, job_queue, lru_cache, sd_models_residency, progress_stream, worker_pool, upscaler, processing_pipeline, ui_common, tiled_img2img
 from typing import List
+from contextlib import closing
 
 from sqlalchemy.orm import Session
 import sqlalchemy.exc as exc
 from sqlalchemy.orm.exc import FlushError
 
-from .database import engine, get_db
-from . import models, credits, styles, auths, users
+from .database import engine, get_db, get_async_db, SessionLocal
+from . import models, credits, styles, auths, users, image_store, gallery, database
+from .ledger import ledger
 from .users import *
 from .auths import *
 from .logs import print_message
@@ -48,6 +51,13 @@ print("Python interpreter path: " + sys.executable)
 
 models.Base.metadata.create_all(bind=engine)
 
+# create_all은 이미 있는 테이블에 새 인덱스를 추가하지 않으므로 따로 만든다
+for index in models.ImezyUpdateDB.__table__.indexes:
+    try:
+        index.create(bind=engine, checkfirst=True)
+    except exc.SQLAlchemyError as e:
+        print(f"Failed to create index {index.name}: {e}")
+
 DEFAULT_CREDITS = settings.DEFAULT_CREDITS                     
 CREDITS_PER_IMAGE = settings.CREDITS_PER_IMAGE
 with open('./modules/api/conf/config.json', 'r') as f:
@@ -123,6 +133,23 @@ def convert_img_to_webp(image):
         image.save(output_bytes, "WEBP")
         bytes_data = output_bytes.getvalue()
     return base64.b64encode(bytes_data)
+
+# 생성된 이미지를 마무리하는 스레드에서 다음 배치를 샘플링하는 동안 미리 인코딩한다
+image_encoders = [encode_pil_to_base64, convert_img_to_webp]
+
+def encode_processed_images(processed):
+    b64images, b64images_compressed = [], []
+    for image in processed.images:
+        image_and_encoded = processed.encoded_images.get(id(image))
+        if image_and_encoded is not None and image_and_encoded[0] is image:
+            b64image, b64image_compressed = image_and_encoded[1]
+        else: # 스크립트가 바꾼 이미지 등은 여기서 인코딩
+            b64image, b64image_compressed = encode_pil_to_base64(image), convert_img_to_webp(image)
+
+        b64images.append(b64image)
+        b64images_compressed.append(b64image_compressed)
+
+    return b64images, b64images_compressed
     
 def api_middleware(app: FastAPI):
     @app.middleware("http")
@@ -145,6 +172,40 @@ def api_middleware(app: FastAPI):
             ))
         return res
 
+    @app.middleware("http")
+    async def db_request_scope(req: Request, call_next):
+        # 요청 하나에서 여러 의존성(access_token_auth, get_db 등)이 세션 하나를 함께 쓰고, 실행된 쿼리 수를 센다
+        scope = database.RequestScope()
+        token = database.request_scope.set(scope)
+        try:
+            res: Response = await call_next(req)
+        except Exception:
+            scope.close()
+            raise
+        finally:
+            database.request_scope.reset(token)
+
+        route = req.scope.get("route", None)
+        endpoint = route.path if route is not None else getattr(req.scope.get("endpoint", None), "__name__", None)
+        if endpoint is not None:
+            database.record_queries(endpoint, scope.queries)
+            if 0 < settings.DB_QUERY_LOG_THRESHOLD < scope.queries:
+                print_message(f"{req.method} {endpoint} ran {scope.queries} database queries")
+        res.headers["X-DB-Queries"] = str(scope.queries)
+
+        # 응답 본문(스트리밍 포함)을 다 보낸 뒤에 세션을 닫는다
+        body_iterator = res.body_iterator
+
+        async def body_and_close():
+            try:
+                async for chunk in body_iterator:
+                    yield chunk
+            finally:
+                scope.close()
+
+        res.body_iterator = body_and_close()
+        return res
+
 class Api:
     def __init__(self, app: FastAPI, queue_lock: Lock):
         if shared.cmd_opts.api_auth:
@@ -156,16 +217,31 @@ class Api:
         self.router = APIRouter()
         self.app = app
         self.queue_lock = queue_lock
+        self.job_scheduler = job_queue.get_scheduler()
+        self.worker_pool = worker_pool.from_cmd_opts(shared.cmd_opts, swap_penalty=shared.opts.api_worker_swap_penalty, health_interval=shared.opts.api_worker_health_interval)
+        if self.worker_pool is not None:
+            # 생성은 장치별 워커 프로세스가 하므로 워커 수만큼 작업을 동시에 보낸다
+            self.job_scheduler.use_remote_workers(len(self.worker_pool.workers))
+        styles.style_cache.warm_up()
         api_middleware(self.app) # 이메일 인증이 필요한 기능은 ## 표시
+        # 생성이 끝나기를 기다리는 요청의 작업이 취소되면 409로 응답한다
+        self.app.add_exception_handler(job_queue.JobCancelled, lambda request, e: JSONResponse(status_code=409, content={"detail": str(e)}))
         self.add_api_route("/sdapi/v1/txt2img", self.text2imgapi, methods=["POST"], response_model=models.TextToImageResponse)
         self.add_api_route("/sdapi/v1/txt2img-auth", self.text2imgapi_auth, methods=["POST"], response_model=models.TextToImageAuthResponse) ##
+        self.add_api_route("/sdapi/v1/txt2img-auth/submit", self.text2imgapi_auth_submit, methods=["POST"], response_model=models.JobSubmitResponse) ##
         self.add_api_route("/sdapi/v1/img2img", self.img2imgapi, methods=["POST"], response_model=ImageToImageResponse)
         self.add_api_route("/sdapi/v1/img2img-auth", self.img2imgapi_auth, methods=["POST"], response_model=models.ImageToImageAuthResponse) ##
+        self.add_api_route("/sdapi/v1/img2img-auth/submit", self.img2imgapi_auth_submit, methods=["POST"], response_model=models.JobSubmitResponse) ##
+        self.add_api_route("/sdapi/v1/sd-upscale", self.sd_upscale_api, methods=["POST"], response_model=SDUpscaleResponse)
+        self.add_api_route("/sdapi/v1/jobs/{id_task}", self.job_status, methods=["GET"], response_model=models.JobStatusResponse)
+        self.add_api_route("/sdapi/v1/jobs/{id_task}", self.job_cancel, methods=["DELETE"])
         self.add_api_route("/sdapi/v1/extra-single-image", self.extras_single_image_api, methods=["POST"], response_model=ExtrasSingleImageResponse)
         self.add_api_route("/sdapi/v1/extra-single-image-auth", self.extras_single_image_api_auth, methods=["POST"], response_model=ExtrasSingleImageResponse) ##
         self.add_api_route("/sdapi/v1/extra-batch-images", self.extras_batch_images_api, methods=["POST"], response_model=ExtrasBatchImagesResponse)
+        self.add_api_route("/sdapi/v1/extra-batch-images/stream", self.extras_batch_images_stream_api, methods=["POST"])
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=PNGInfoResponse)
         self.add_api_route("/sdapi/v1/progress", self.progressapi, methods=["GET"], response_model=ProgressResponse)
+        self.add_api_route("/sdapi/v1/progress/stream/{id_task}", self.progress_stream, methods=["GET"])
         self.add_api_route("/sdapi/v1/interrogate", self.interrogateapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/interrupt", self.interruptapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/skip", self.skip, methods=["POST"])
@@ -175,6 +251,7 @@ class Api:
         self.add_api_route("/sdapi/v1/samplers", self.get_samplers, methods=["GET"], response_model=List[SamplerItem])
         self.add_api_route("/sdapi/v1/upscalers", self.get_upscalers, methods=["GET"], response_model=List[UpscalerItem])
         self.add_api_route("/sdapi/v1/sd-models", self.get_sd_models, methods=["GET"], response_model=List[SDModelItem])
+        self.add_api_route("/sdapi/v1/sd-models/resident", self.get_resident_sd_models, methods=["GET"], response_model=List[ResidentSDModelItem])
         self.add_api_route("/sdapi/v1/hypernetworks", self.get_hypernetworks, methods=["GET"], response_model=List[HypernetworkItem])
         self.add_api_route("/sdapi/v1/face-restorers", self.get_face_restorers, methods=["GET"], response_model=List[FaceRestorerItem])
         self.add_api_route("/sdapi/v1/realesrgan-models", self.get_realesrgan_models, methods=["GET"], response_model=List[RealesrganItem])
@@ -187,6 +264,11 @@ class Api:
         self.add_api_route("/sdapi/v1/train/embedding", self.train_embedding, methods=["POST"], response_model=TrainResponse)
         self.add_api_route("/sdapi/v1/train/hypernetwork", self.train_hypernetwork, methods=["POST"], response_model=TrainResponse)
         self.add_api_route("/sdapi/v1/memory", self.get_memory, methods=["GET"], response_model=MemoryResponse)
+        self.add_api_route("/sdapi/v1/caches", self.get_caches, methods=["GET"], response_model=List[CacheStatsItem])
+        self.add_api_route("/sdapi/v1/db-stats", self.get_db_stats, methods=["GET"], response_model=DbStatsResponse)
+        self.add_api_route("/sdapi/v1/worker/health", self.get_worker_health, methods=["GET"], response_model=WorkerHealthResponse)
+        self.add_api_route("/sdapi/v1/workers", self.get_workers, methods=["GET"], response_model=List[DeviceWorkerItem])
+        self.add_api_route("/sdapi/v1/workers/drain", self.drain_worker, methods=["POST"], response_model=DeviceWorkerItem)
 
         self.add_api_route("/user/create", self.create_new_user, methods=["POST"])
         self.add_api_route("/user/login", self.login, methods=["POST"])
@@ -211,11 +293,15 @@ class Api:
         self.add_api_route("/credits/read/all", self.read_all_creds, methods=["GET"])
         self.add_api_route("/credits/read", self.read_cred_by_id, methods=["GET"])
         self.add_api_route("/credits/update", self.update_cred, methods=["PUT"], response_model=UpdateCreditsResponse)
+        self.add_api_route("/credits/reconcile", self.reconcile_creds, methods=["POST"], response_model=ReconcileCreditsResponse)
         
         self.add_api_route("/image/search", self.search_image, methods=["GET"])
         self.add_api_route("/image/search_compressed", self.search_image_compressed, methods=["GET"])
         self.add_api_route("/image/delete/{image_id}", self.delete_image, methods=["DELETE"])
         self.add_api_route("/image/download/{image_id}", self.download_image, methods=["GET"])
+        self.add_api_route("/image/file/{key:path}", self.get_image_file, methods=["GET"])
+        self.add_api_route("/image/gallery", self.get_gallery, methods=["GET"], response_model=GalleryResponse)
+        self.add_api_route("/image/gallery/stream", self.get_gallery_stream, methods=["GET"])
         
         self.add_api_route("/email/verification/send", self.email_verification_send, methods=["POST"]) # send verification code
         self.add_api_route("/email/verification/check", self.email_verification_check, methods=["PUT"]) # check verification code
@@ -228,6 +314,7 @@ class Api:
         # self.add_api_route("/style/modifier/create", self.create_modifier, methods=["POST"])
         # self.add_api_route("/style/modifier/update/{modifier_id}", self.update_modifier_by_id, methods=["PUT"])
         self.add_api_route("/style/presets", self.presets_read, methods=["GET"])
+        self.add_api_route("/style/reload", self.styles_reload, methods=["POST"], response_model=StyleCacheResponse)
         
         self.add_api_route("/payment/orderNames", self.get_order_names, methods=["GET"])
         self.add_api_route("/payment/orderNames/credits", self.get_order_names_credits, methods=["GET"])
@@ -282,19 +369,24 @@ class Api:
         if imezy_update_db is None:
             return HTTPException(status_code=404, detail="No images found in the database.")
         
+        image_store_backend = image_store.get_store()
         response = []
         for i, row in enumerate(imezy_update_db):
-            updated = datetime.strptime(str(row.updated), "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d%H%M%S") # db의 updated 시간을 파일명에 맞게 변환
-            
-            try:
-                # 이미지 저장된 json 파일 읽기
-                with open(f"generated/{IMEZY_CONFIG['imezy_type1'][str(row.imezy_type)]}/{auth['email']}/{updated}.json", "r") as f:
-                    data = json.load(f)
-                if data["images"]:
-                    response.append({"info": data["info"], "updated": row.updated, "image_id": row.id, "images": data["images"] })
-            except FileNotFoundError:
-                print(f"generated/{auth['email']}/{updated}.json 파일이 없습니다.")
+            gen = IMEZY_CONFIG['imezy_type1'][str(row.imezy_type)] # t2i or i2i
+
+            # images는 기존 클라이언트를 위해 계속 base64로 돌려주고, 이미지 저장소에 있으면 urls에 이미지 URL도 넣는다
+            if (meta := image_store.load_generation(gen, auth['email'], row.updated)) is not None:
+                images = [base64.b64encode(image_store_backend.read(key)).decode() for key in meta["images"]]
+                urls = [image_store_backend.url(key) for key in meta["images"]]
+            elif (meta := image_store.load_legacy_generation(gen, auth['email'], row.updated)) is not None:
+                images = meta["images"]
+                urls = []
+            else:
+                print(f"{image_store.legacy_filename(gen, auth['email'], row.updated)} 파일이 없습니다.")
                 return exceptions.get_file_not_exist_exception()
+
+            if images:
+                response.append({"info": meta["info"], "updated": row.updated, "image_id": row.id, "images": images, "urls": urls})
                  
         return response
     
@@ -306,24 +398,27 @@ class Api:
         if imezy_update_db is None:
             return HTTPException(status_code=404, detail="No images found in the database.")
         
+        image_store_backend = image_store.get_store()
         response = []
         for i, row in enumerate(imezy_update_db):
-            updated = datetime.strptime(str(row.updated), "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d%H%M%S") # db의 updated 시간을 파일명에 맞게 변환
-            
-            try:
-                # 이미지 저장된 json 파일 읽기
-                gen = IMEZY_CONFIG['imezy_type1'][str(row.imezy_type)] # t2i or i2i
-                with open(f"generated/{gen}/{auth['email']}/{updated}.json", "r") as f:
-                    data = json.load(f)
-                    data["info"]["gen"] = gen
-                if data["images_compressed"]:
-                    response.append({"info": data["info"], "updated": row.updated, "image_id": row.id, "images": data["images_compressed"]})
-            except FileNotFoundError:
-                print(f"generated/{auth['email']}/{updated}.json 파일이 없습니다.")
+            gen = IMEZY_CONFIG['imezy_type1'][str(row.imezy_type)] # t2i or i2i
+
+            if (meta := image_store.load_generation(gen, auth['email'], row.updated)) is not None:
+                images = [base64.b64encode(image_store_backend.read(key)).decode() for key in meta["images_compressed"]]
+                urls = [image_store_backend.url(key) for key in meta["images_compressed"]]
+            elif (meta := image_store.load_legacy_generation(gen, auth['email'], row.updated)) is not None:
+                images = meta.get("images_compressed")
+                urls = []
+            else:
+                print(f"{image_store.legacy_filename(gen, auth['email'], row.updated)} 파일이 없습니다.")
                 continue
-            except KeyError:
-                print(f"generated/{auth['email']}/{updated}.json 파일에 images_compressed가 없습니다.")
+
+            if not images:
+                print(f"{image_store.legacy_filename(gen, auth['email'], row.updated)} 파일에 images_compressed가 없습니다.")
                 continue
+
+            meta["info"]["gen"] = gen
+            response.append({"info": meta["info"], "updated": row.updated, "image_id": row.id, "images": images, "urls": urls})
                  
         return response
     
@@ -338,10 +433,7 @@ class Api:
             return exceptions.get_inappropriate_user_exception()
         
         image_type =IMEZY_CONFIG['imezy_type1'][str(image_db.imezy_type)]
-        image_updated = datetime.strptime(str(image_db.updated), "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d%H%M%S")
-        try:
-            os.remove(f"generated/{image_type}/{auth['email']}/{image_updated}.json")
-        except FileNotFoundError:
+        if not image_store.delete_generation(image_type, auth['email'], image_db.updated):
             print_message(f"Delete image file image_id: {image_id} is not exist")
             return HTTPException(status_code=404, detail=f"Delete image file image_id: {image_id} is not exist")
         try:
@@ -368,16 +460,66 @@ class Api:
             return exceptions.get_inappropriate_user_exception()
         
         image_type =IMEZY_CONFIG['imezy_type1'][str(image_db.imezy_type)]
-        image_updated = datetime.strptime(str(image_db.updated), "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d%H%M%S")
+        if (meta := image_store.load_generation(image_type, auth['email'], image_db.updated)) is not None:
+            if not 0 <= req.index < len(meta["images"]):
+                raise HTTPException(status_code=404, detail=f"Download image user: {auth['email']}, image_id: {image_id} has no image {req.index}")
+
+            key = meta["images"][req.index]
+            return {"image_id": image_id, "updated": image_db.updated, "index": req.index, 
+                    "image": base64.b64encode(image_store.get_store().read(key)), "url": image_store.get_store().url(key)}
+
+        if (data := image_store.load_legacy_generation(image_type, auth['email'], image_db.updated)) is None:
+            return HTTPException(status_code=404, detail=f"Download image user: {auth['email']}, image_id: {image_id} {image_store.updated_str(image_db.updated)}.json is not exist on file")
+            
+        if not 0 <= req.index < len(data["images"]):
+            raise HTTPException(status_code=404, detail=f"Download image user: {auth['email']}, image_id: {image_id} has no image {req.index}")
+
+        return {"image_id": image_id, "updated": image_db.updated, 
+                "index": req.index, "image": data["images"][req.index]}
+
+    def query_gallery(self, auth: dict, req: GalleryRequest, db: Session):
         try:
-            with open(f"generated/{image_type}/{auth['email']}/{image_updated}.json", "r") as f:
-                data = json.load(f)
+            rows, next_cursor = gallery.query_gallery(db, auth['email'], limit=req.limit, cursor=req.cursor, imezy_type=req.imezy_type,
+                                                      date_from=req.date_from, date_to=req.date_to)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return rows, next_cursor
+
+    def gallery_item(self, row):
+        return gallery.gallery_item(row, IMEZY_CONFIG['imezy_type1'][str(row.imezy_type)])
+
+    def get_gallery(self, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db), req: GalleryRequest = Depends()):
+        authenticated_access_token_check(auth)
+        print_message(f"Gallery user: {auth['email']}, cursor: {req.cursor}")
+
+        rows, next_cursor = self.query_gallery(auth, req, db)
+
+        return GalleryResponse(items=[self.gallery_item(row) for row in rows], next_cursor=next_cursor)
+
+    def get_gallery_stream(self, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db), req: GalleryRequest = Depends()):
+        # NDJSON: 한 줄에 생성 기록 하나, 마지막 줄은 {"next_cursor": ...}
+        authenticated_access_token_check(auth)
+        print_message(f"Gallery stream user: {auth['email']}, cursor: {req.cursor}")
+
+        rows, next_cursor = self.query_gallery(auth, req, db)
+
+        def lines():
+            for row in rows:
+                yield GalleryItem(**self.gallery_item(row)).json() + "\n"
+            yield json.dumps({"next_cursor": next_cursor}) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    def get_image_file(self, key: str):
+        # 이미지 키는 서명이 포함되어 있어 추측할 수 없으므로 별도 인증 없이 제공한다 (img 태그에서 바로 사용)
+        # 키는 사용자가 아니라 생성 기록마다 만들어지므로 URL을 아는 사람은 누구나, 캐시된 동안 계속 받을 수 있다
+        try:
+            data, media_type = image_store.read_image(key)
         except FileNotFoundError:
-            return HTTPException(status_code=404, detail=f"Download image user: {auth['email']}, image_id: {image_id} {image_updated}.json is not exist on file")
-            
-        if data["images"]:
-            return {"image_id": image_id, "updated": image_db.updated, 
-                    "index": req.index, "image": data["images"][req.index]}
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        return Response(content=data, media_type=media_type, headers={"Cache-Control": "private, max-age=31536000, immutable"})
         
     def email_verification_send(self, req: models.EmailVerificaionSendRequest, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
         authenticated_access_token_check(auth)
@@ -408,6 +550,7 @@ class Api:
                 verify_email_db.code = code
                 verify_email_db.updated = datetime.now()
                 db.commit()
+        invalidate_identity(email=email_to)
         
         # subject = "Imezy 이메일 인증 코드"
         subject = "Imezy Email Verification Code"
@@ -453,6 +596,7 @@ class Api:
         
         verify_email_db.verified = True
         db.commit()
+        invalidate_identity(email=req.email)
         
         return {"detail": f"The code is correct"}
     
@@ -509,6 +653,7 @@ class Api:
             raise HTTPException(status_code=401, detail=f"The token is invalid({current_email}). Please login again.")
         user_db.email = req.email
         db.commit()
+        invalidate_identity(user_id=user_db.id, email=current_email)
         
         if (verify_email_db := db.query(models.VerifyEmailDB).filter(models.VerifyEmailDB.email == current_email).first()) is None:
             verified = False
@@ -566,7 +711,7 @@ class Api:
     def delete_user_by_id(self, user_id: int, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
         
         authenticated_access_token_check(auth)
-        if db.query(models.UsersDB).filter(models.UsersDB.email == auth["email"]).first().is_admin == False:
+        if not user_identity(auth["user_id"], db)["is_admin"]:
             print_message("User is not admin")
             raise exceptions.get_admin_exception()
         
@@ -577,6 +722,7 @@ class Api:
             db.delete(credits_info)
             db.delete(user_db)
             db.commit()
+            invalidate_identity(user_id=user_id)
             print_message(f"User {user_id}:{username} deleted")
             return {"message": f"User {user_id}:{username} deleted"}
         raise exceptions.get_user_not_found_exception()
@@ -587,7 +733,9 @@ class Api:
         db.commit()
 
     def update_user_by_id(self, user_id: int, user: UpdateUserRequest, db: Session = Depends(get_db)):
-        return update_user(db, user_id, user)
+        response = update_user(db, user_id, user)
+        invalidate_identity(user_id=user_id)
+        return response
 
     def read_all_users(self, db: Session = Depends(get_db)):
         return read_users(db)
@@ -779,7 +927,7 @@ class Api:
     
     def make_admin(self, user_id: int, user: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
         authenticated_access_token_check(user)
-        if db.query(models.UsersDB).filter(models.UsersDB.email == user["email"]).first().is_admin == False:
+        if not user_identity(user["user_id"], db)["is_admin"]:
             print_message("User is not admin")
             raise exceptions.get_admin_exception()
         
@@ -787,6 +935,7 @@ class Api:
         if user_info is not None:
             user_info.is_admin = True
             db.commit()
+            invalidate_identity(user_id=user_id)
             print_message(f"User {user_id}:{user_info.username} is now admin")
             return {"message": f"User {user_id}:{user_info.username} is now admin"}
         raise HTTPException(status_code=404, detail="User not found")
@@ -803,7 +952,13 @@ class Api:
 
         raise HTTPException(status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"})
 
-    def text2imgapi(self, txt2imgreq: StableDiffusionTxt2ImgProcessingAPI):
+    def job_priority(self, email, db: Session):
+        # users with a payment history are scheduled ahead of free-credit users
+        if db.query(models.PaymentHistoryDB).filter(models.PaymentHistoryDB.email == email).first() is not None:
+            return job_queue.PRIORITY_PAID
+        return job_queue.PRIORITY_FREE
+
+    def create_txt2img_processing(self, txt2imgreq: StableDiffusionTxt2ImgProcessingAPI):
         populate = txt2imgreq.copy(update={ # Override __init__ params
             "sampler_name": validate_sampler_name(txt2imgreq.sampler_name or txt2imgreq.sampler_index),
             "do_not_save_samples": True,
@@ -813,24 +968,56 @@ class Api:
         if populate.sampler_name:
             populate.sampler_index = None  # prevent a warning later on
 
-        with self.queue_lock:
-            p = StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **vars(populate))
+        p = StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **vars(populate))
+        p.image_encoders = image_encoders
 
-            shared.state.begin()
-            processed = process_images(p)
-            shared.state.end()
+        return p
+
+    def submit_txt2img(self, txt2imgreq: StableDiffusionTxt2ImgProcessingAPI, user: str = None, priority: int = job_queue.PRIORITY_FREE, finalize=None, on_fail=None):
+        if self.worker_pool is not None:
+            return self.job_scheduler.submit(self.dispatch, args=("/sdapi/v1/txt2img", json.loads(txt2imgreq.json()), self.requested_checkpoint(txt2imgreq)),
+                                             user=user, priority=priority, finalize=finalize, on_fail=on_fail, checkpoint=self.requested_checkpoint(txt2imgreq), remote=True)
+
+        # compatible requests waiting in the queue are sampled together in one batch
+        p = self.create_txt2img_processing(txt2imgreq)
+
+        return self.job_scheduler.submit(process_images, args=(p,), user=user, priority=priority, finalize=finalize, on_fail=on_fail,
+                                         batch_key=processing.coalesce_key(p), batch_func=self.process_txt2img_batch, batch_size=p.batch_size,
+                                         checkpoint=self.requested_checkpoint(txt2imgreq))
+
+    def requested_checkpoint(self, req):
+        # the scheduler prefers jobs that can run without switching checkpoints
+        return (req.override_settings or {}).get("sd_model_checkpoint")
+
+    def process_txt2img_batch(self, args_list):
+        return processing.process_images_batched([p for p, in args_list])
+
+    def dispatch(self, path: str, payload: dict, checkpoint: str = None):
+        # 모델이 이미 올라가 있고 가장 한가한 장치 워커에 보내고, 워커의 응답(dict)을 그대로 돌려준다
+        try:
+            return self.worker_pool.run(path, payload, checkpoint)
+        except worker_pool.WorkerError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except worker_pool.WorkerUnavailable as e:
+            raise HTTPException(status_code=503, detail=str(e))
 
-        b64images = list(map(encode_pil_to_base64, processed.images))
-        b64images_compressed = list(map(convert_img_to_webp, processed.images))
+    def txt2img_response(self, txt2imgreq: StableDiffusionTxt2ImgProcessingAPI, processed):
+        if self.worker_pool is not None: # 워커가 이미 이미지를 인코딩해서 보냈다
+            return TextToImageResponse(**processed)
+
+        b64images, b64images_compressed = encode_processed_images(processed)
 
         return TextToImageResponse(images=b64images, images_compressed=b64images_compressed, parameters=vars(txt2imgreq), info=json.loads(processed.js()))
 
-    def text2imgapi_auth(self, txt2imgreq: StableDiffusionTxt2ImgProcessingAPI, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db), user_type: str = "normal"):
+    def text2imgapi(self, txt2imgreq: StableDiffusionTxt2ImgProcessingAPI):
+        processed = self.job_scheduler.wait(self.submit_txt2img(txt2imgreq))
+
+        return self.txt2img_response(txt2imgreq, processed)
+
+    def prepare_txt2img_auth(self, txt2imgreq: StableDiffusionTxt2ImgProcessingAPI, auth: dict, db: Session):
         authenticated_access_token_check(auth, db=db, verify=True)
         print_message(f"User {auth['email']} is generating images txt2imgapi_auth")
-        
-        
-        
+
         # 프리셋 설정
         # DB에서 프리셋 설정을 불러와 유저가 입력한 prompt와 db상에서 사전 입력된 base prompt(prompt_b)를 ', '로 합친다. negative prompt도 마찬가지
         user_prompt = txt2imgreq.prompt if txt2imgreq.prompt is not None else ""
@@ -840,17 +1027,14 @@ class Api:
                                                                             user_negative_prompt = user_negative_prompt,
                                                                             preset =  txt2imgreq.preset)
         
-        user_db = db.query(models.CreditsDB).filter(models.CreditsDB.email == auth["email"]).first()
-        if user_db is None:
-            print_message("user is None exception")
-            raise exceptions.get_user_exception()
         created_images_num = int(txt2imgreq.n_iter * txt2imgreq.batch_size)
         
-        # 유저가 가진 크레딧이 생성할 이미지의 크레딧보다 적으면 에러
-        if user_db.credits < created_images_num * CREDITS_PER_IMAGE:
-            raise exceptions.not_enough_credits_exception()
-        
-        response = self.text2imgapi(txt2imgreq)
+        # 생성할 이미지의 크레딧을 미리 예약한다. 크레딧이 부족하면 에러
+        reservation = ledger.reserve(db, auth["email"], created_images_num * CREDITS_PER_IMAGE)
+
+        return user_prompt, user_negative_prompt, created_images_num, reservation
+
+    def finish_txt2img_auth(self, response, auth: dict, user_prompt: str, user_negative_prompt: str, created_images_num: int, reservation, db: Session):
         response_json = json.loads(response.json())
         response_json["parameters"]["prompt"] = user_prompt
         response_json["parameters"]["negative_prompt"] = user_negative_prompt
@@ -864,13 +1048,9 @@ class Api:
         # 이미지 압축 저장 to webp
         response_images = response_json["images"]
         
-        # 이미지 생성 저장(json)
+        # 이미지 생성 저장(이미지 파일 + 메타데이터)
         now = datetime.now().strftime('%Y%m%d%H%M%S')
-        if os.path.exists(f"generated/t2i/{auth['email']}") == False:
-            os.makedirs(f"generated/t2i/{auth['email']}")
-            
-        with open(f"generated/t2i/{auth['email']}/{now}.json", "w") as f:
-            json.dump(response_json, f, indent=4)
+        image_store.save_generation("t2i", auth['email'], now, response_json)
         
         # 이미지 생성 데이터베이스 기록
         imezy_update_db = models.ImezyUpdateDB()
@@ -879,26 +1059,62 @@ class Api:
         imezy_update_db.num_imgs = created_images_num
         imezy_update_db.updated = now
         db.add(imezy_update_db)
+        db.commit()
 
-        # 크레딧 업데이트
-        updateing_credit_inc = -created_images_num *CREDITS_PER_IMAGE # 이미지당 10크레딧 차감
-        if credits.update_cred(user_db.email, updateing_credit_inc, db) == -1:
-            print_message(f"{auth['email']}'s update_cred failed")
-            raise exceptions.get_user_exception()
+        # 예약한 크레딧 확정 (이미지당 10크레딧 차감)
+        current_credits = ledger.commit(db, reservation)
         
-        print_message(f"User {auth['email']} is generating an image. Credits left: {user_db.credits}, Credits used: {-updateing_credit_inc}, generated images: {created_images_num}")
+        print_message(f"User {auth['email']} is generating an image. Credits left: {current_credits}, Credits used: {reservation.amount}, generated images: {created_images_num}")
         
         response = models.TextToImageAuthResponse(images=response_images, images_compressed=response_json["images_compressed"], 
                                              parameters=response_json["parameters"], info=response_json["info"], 
-                                             credits=user_db.credits)
+                                             credits=current_credits)
 
         return response
 
-    def img2imgapi(self, img2imgreq: StableDiffusionImg2ImgProcessingAPI):
+    def text2imgapi_auth(self, txt2imgreq: StableDiffusionTxt2ImgProcessingAPI, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db), user_type: str = "normal"):
+        user_prompt, user_negative_prompt, created_images_num, reservation = self.prepare_txt2img_auth(txt2imgreq, auth, db)
+
+        try:
+            priority = self.job_priority(auth['email'], db)
+            db.close() # 이미지를 생성하는 동안 커넥션을 잡고 있지 않도록 풀에 돌려준다
+
+            processed = self.job_scheduler.wait(self.submit_txt2img(txt2imgreq, user=auth['email'], priority=priority))
+            response = self.txt2img_response(txt2imgreq, processed)
+
+            return self.finish_txt2img_auth(response, auth, user_prompt, user_negative_prompt, created_images_num, reservation, db)
+        except Exception:
+            ledger.refund(db, reservation) # 이미 확정된 경우에는 아무것도 하지 않는다
+            raise
+
+    def text2imgapi_auth_submit(self, txt2imgreq: StableDiffusionTxt2ImgProcessingAPI, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
+        user_prompt, user_negative_prompt, created_images_num, reservation = self.prepare_txt2img_auth(txt2imgreq, auth, db)
+
+        def finalize(processed):
+            response = self.txt2img_response(txt2imgreq, processed)
+            with closing(SessionLocal()) as job_db:
+                return self.finish_txt2img_auth(response, auth, user_prompt, user_negative_prompt, created_images_num, reservation, job_db)
+
+        try:
+            job = self.submit_txt2img(txt2imgreq, user=auth['email'], priority=self.job_priority(auth['email'], db), finalize=finalize,
+                                      on_fail=lambda: ledger.refund_in_new_session(reservation))
+        except Exception:
+            ledger.refund(db, reservation)
+            raise
+
+        return JobSubmitResponse(id_task=job.id_task, queue_position=self.job_scheduler.position(job.id_task))
+
+    def process_img2img(self, img2imgreq: StableDiffusionImg2ImgProcessingAPI):
+        # 워커로 보내는 경우 작업을 remote=True로 제출해야 생성 락 없이 동시에 실행된다
         init_images = img2imgreq.init_images
         if init_images is None:
             raise HTTPException(status_code=404, detail="Init image not found")
 
+        if self.worker_pool is not None:
+            payload = json.loads(img2imgreq.json())
+            payload["include_init_images"] = img2imgreq.include_init_images # json()에서는 빠지는 필드
+            return self.dispatch("/sdapi/v1/img2img", payload, self.requested_checkpoint(img2imgreq))
+
         mask = img2imgreq.mask
         if mask:
             print_message(mask[:100])
@@ -917,16 +1133,17 @@ class Api:
         args = vars(populate)
         args.pop('include_init_images', None)  # this is meant to be done by "exclude": True in model, but it's for a reason that I cannot determine.
 
-        with self.queue_lock:
-            p = StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)
-            p.init_images = [decode_base64_to_image(x) for x in init_images]
+        p = StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)
+        p.init_images = [decode_base64_to_image(x) for x in init_images]
+        p.image_encoders = image_encoders
 
-            shared.state.begin()
-            processed = process_images(p)
-            shared.state.end()
+        return process_images(p)
 
-        b64images = list(map(encode_pil_to_base64, processed.images))
-        b64images_compressed = list(map(convert_img_to_webp, processed.images))
+    def img2img_response(self, img2imgreq: StableDiffusionImg2ImgProcessingAPI, processed):
+        if self.worker_pool is not None: # 워커가 이미 이미지를 인코딩해서 보냈다
+            return ImageToImageResponse(**processed)
+
+        b64images, b64images_compressed = encode_processed_images(processed)
 
         if not img2imgreq.include_init_images:
             img2imgreq.init_images = None
@@ -934,15 +1151,65 @@ class Api:
 
         return ImageToImageResponse(images=b64images, images_compressed=b64images_compressed, parameters=vars(img2imgreq), info=json.loads(processed.js()))
 
-    def img2imgapi_auth(self, img2imgreq: StableDiffusionImg2ImgProcessingAPI, 
-                        auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
+    def img2imgapi(self, img2imgreq: StableDiffusionImg2ImgProcessingAPI):
+        if img2imgreq.init_images is None:
+            raise HTTPException(status_code=404, detail="Init image not found")
+
+        processed = self.job_scheduler.run(self.process_img2img, args=(img2imgreq,), checkpoint=self.requested_checkpoint(img2imgreq), remote=self.worker_pool is not None)
+
+        return self.img2img_response(img2imgreq, processed)
+
+    def process_sd_upscale(self, req: SDUpscaleRequest):
+        if self.worker_pool is not None:
+            payload = json.loads(req.json())
+            payload["include_init_images"] = req.include_init_images # json()에서는 빠지는 필드
+            return self.dispatch("/sdapi/v1/sd-upscale", payload, self.requested_checkpoint(req))
+
+        populate = req.copy(update={ # Override __init__ params
+            "sampler_name": validate_sampler_name(req.sampler_name or req.sampler_index),
+            "do_not_save_samples": True,
+            "do_not_save_grid": True,
+            "mask": None
+            }
+        )
+        if populate.sampler_name:
+            populate.sampler_index = None  # prevent a warning later on
+
+        args = vars(populate)
+        for key in ['include_init_images', 'upscaler', 'scale_factor', 'overlap']:
+            args.pop(key, None)
+
+        p = StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)
+        p.init_images = [decode_base64_to_image(req.init_images[0])]
+        p.image_encoders = image_encoders
+
+        # 스크립트 러너를 거치지 않고 타일 img2img 엔진을 바로 사용한다
+        upscaler = next(x for x in shared.sd_upscalers if x.name == req.upscaler)
+        return tiled_img2img.process(p, upscaler, req.scale_factor, req.overlap)
+
+    def sd_upscale_api(self, req: SDUpscaleRequest):
+        if not req.init_images:
+            raise HTTPException(status_code=404, detail="Init image not found")
+
+        if not any(x.name == req.upscaler for x in shared.sd_upscalers):
+            raise HTTPException(status_code=404, detail=f"Upscaler {req.upscaler} not found")
+
+        result = self.job_scheduler.run(self.process_sd_upscale, args=(req,), checkpoint=self.requested_checkpoint(req), remote=self.worker_pool is not None)
+        if self.worker_pool is not None: # 워커가 이미 이미지를 인코딩해서 보냈다
+            return SDUpscaleResponse(**result)
+
+        processed, stats = result
+        b64images, b64images_compressed = encode_processed_images(processed)
+
+        if not req.include_init_images:
+            req.init_images = None
+
+        return SDUpscaleResponse(images=b64images, images_compressed=b64images_compressed, parameters=vars(req), info=json.loads(processed.js()), stats=stats)
+
+    def prepare_img2img_auth(self, img2imgreq: StableDiffusionImg2ImgProcessingAPI, auth: dict, db: Session):
         authenticated_access_token_check(auth, db=db, verify=True)
         print_message(f"User {auth['email']} is generating an image using img2imgapi_auth")
         
-        user_db = db.query(models.CreditsDB).filter(models.CreditsDB.email == auth["email"]).first()
-        if user_db is None:
-            print_message("user is None exception")
-            raise exceptions.get_user_exception()
         created_images_num = int(img2imgreq.n_iter * img2imgreq.batch_size)
         
         user_prompt = img2imgreq.prompt if img2imgreq.prompt is not None else ""
@@ -952,19 +1219,20 @@ class Api:
                                                                     user_negative_prompt = user_negative_prompt,
                                                                     preset =  img2imgreq.preset)
         
-        # 유저가 가진 크레딧이 생성할 이미지의 크레딧보다 적으면 에러
-        if user_db.credits < created_images_num * CREDITS_PER_IMAGE:
-            raise exceptions.not_enough_credits_exception()
-        
-        response = self.img2imgapi(img2imgreq)
+        if img2imgreq.init_images is None:
+            raise HTTPException(status_code=404, detail="Init image not found")
+
+        # 생성할 이미지의 크레딧을 미리 예약한다. 크레딧이 부족하면 에러
+        reservation = ledger.reserve(db, auth["email"], created_images_num * CREDITS_PER_IMAGE)
+
+        return created_images_num, reservation
+
+    def finish_img2img_auth(self, response, auth: dict, created_images_num: int, reservation, db: Session):
         response_json = json.loads(response.json())
                     
-        # save the response to the database
+        # save the images and generation info to the image store
         now = datetime.now().strftime('%Y%m%d%H%M%S')
-        if os.path.exists(f"generated/i2i/{auth['email']}") == False:
-            os.makedirs(f"generated/i2i/{auth['email']}")
-        with open(f"generated/i2i/{auth['email']}/{now}.json", "w") as f:
-            json.dump(response_json, f, indent=4)
+        image_store.save_generation("i2i", auth['email'], now, response_json)
             
         # 이미지 생성 데이터베이스 기록
         imezy_update_db = models.ImezyUpdateDB()
@@ -973,27 +1241,81 @@ class Api:
         imezy_update_db.num_imgs = created_images_num
         imezy_update_db.updated = now
         db.add(imezy_update_db)
+        db.commit()
 
-        # update credits
-        updateing_creedit_inc = -created_images_num*CREDITS_PER_IMAGE # 10 credits per image
-        if credits.update_cred(user_db.email, updateing_creedit_inc, db) == False:
-            raise exceptions.get_user_exception()
+        # commit the reserved credits (10 credits per image)
+        current_credits = ledger.commit(db, reservation)
         
-        print_message(f"User {auth['email']} is generating an image. Credits left: {user_db.credits}, Credits used: {-updateing_creedit_inc}, generated images: {created_images_num}")
+        print_message(f"User {auth['email']} is generating an image. Credits left: {current_credits}, Credits used: {reservation.amount}, generated images: {created_images_num}")
         
         response = ImageToImageAuthResponse(images=response_json["images"], images_compressed=response_json["images_compressed"], 
                                             parameters=response_json["parameters"], info=response_json["info"], 
-                                            credits=user_db.credits)
+                                            credits=current_credits)
         
         return response
 
+    def img2imgapi_auth(self, img2imgreq: StableDiffusionImg2ImgProcessingAPI, 
+                        auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
+        created_images_num, reservation = self.prepare_img2img_auth(img2imgreq, auth, db)
+
+        try:
+            priority = self.job_priority(auth['email'], db)
+            db.close() # 이미지를 생성하는 동안 커넥션을 잡고 있지 않도록 풀에 돌려준다
+
+            processed = self.job_scheduler.run(self.process_img2img, args=(img2imgreq,), user=auth['email'], priority=priority,
+                                               checkpoint=self.requested_checkpoint(img2imgreq), remote=self.worker_pool is not None)
+            response = self.img2img_response(img2imgreq, processed)
+
+            return self.finish_img2img_auth(response, auth, created_images_num, reservation, db)
+        except Exception:
+            ledger.refund(db, reservation) # 이미 확정된 경우에는 아무것도 하지 않는다
+            raise
+
+    def img2imgapi_auth_submit(self, img2imgreq: StableDiffusionImg2ImgProcessingAPI, 
+                               auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
+        created_images_num, reservation = self.prepare_img2img_auth(img2imgreq, auth, db)
+
+        def finalize(processed):
+            response = self.img2img_response(img2imgreq, processed)
+            with closing(SessionLocal()) as job_db:
+                return self.finish_img2img_auth(response, auth, created_images_num, reservation, job_db)
+
+        try:
+            job = self.job_scheduler.submit(self.process_img2img, args=(img2imgreq,), user=auth['email'], priority=self.job_priority(auth['email'], db), finalize=finalize,
+                                            checkpoint=self.requested_checkpoint(img2imgreq), on_fail=lambda: ledger.refund_in_new_session(reservation), remote=self.worker_pool is not None)
+        except Exception:
+            ledger.refund(db, reservation)
+            raise
+
+        return JobSubmitResponse(id_task=job.id_task, queue_position=self.job_scheduler.position(job.id_task))
+
+    def job_status(self, id_task: str, auth: dict = Depends(access_token_auth)):
+        authenticated_access_token_check(auth)
+
+        job = self.job_scheduler.get(id_task)
+        if job is None or job.user != auth['email']:
+            raise HTTPException(status_code=404, detail=f"Job {id_task} not found")
+
+        return JobStatusResponse(**job.dict(), queue_position=self.job_scheduler.position(id_task), result=job.result if job.status == "finished" else None)
+
+    def job_cancel(self, id_task: str, auth: dict = Depends(access_token_auth)):
+        authenticated_access_token_check(auth)
+
+        job = self.job_scheduler.get(id_task)
+        if job is None or job.user != auth['email']:
+            raise HTTPException(status_code=404, detail=f"Job {id_task} not found")
+
+        if not self.job_scheduler.cancel(id_task):
+            raise HTTPException(status_code=409, detail=f"Job {id_task} is already {job.status}")
+
+        return {"detail": f"Job {id_task} cancelled"}
+
     def extras_single_image_api(self, req: ExtrasSingleImageRequest):
         reqDict = setUpscalers(req)
 
         reqDict['image'] = decode_base64_to_image(reqDict['image'])
 
-        with self.queue_lock:
-            result = postprocessing.run_extras(extras_mode=0, image_folder="", input_dir="", output_dir="", save_output=False, **reqDict)
+        result = self.job_scheduler.run(postprocessing.run_extras, kwargs=dict(extras_mode=0, image_folder="", input_dir="", output_dir="", save_output=False, **reqDict))
 
         return ExtrasSingleImageResponse(images=[encode_pil_to_base64(result[0][0])], html_info=result[1])
     
@@ -1005,21 +1327,57 @@ class Api:
         
         return response
 
-    def extras_batch_images_api(self, req: ExtrasBatchImagesRequest):
+    def submit_extras_batch(self, req: ExtrasBatchImagesRequest, results: queue.Queue):
+        """queues postprocessing of the request's images and returns the job; (index, future of the encoded image,
+        infotext) is put into results for every image as soon as it is done"""
+
         reqDict = setUpscalers(req)
+        files = reqDict.pop('imageList')
+        args = postprocessing.create_extras_args(**reqDict)
+        finishers, _ = processing_pipeline.get_executors()
 
-        def prepareFiles(file):
-            file = decode_base64_to_file(file.data, file_path=file.name)
-            file.orig_name = file.name
-            return file
+        def run():
+            # base64 데이터는 처리할 차례가 되었을 때 디코딩해 모든 이미지가 한꺼번에 메모리에 올라가지 않게 한다
+            items = ((decode_base64_to_image(file.data), file.name) for file in files)
 
-        reqDict['image_folder'] = list(map(prepareFiles, reqDict['imageList']))
-        reqDict.pop('imageList')
+            for index, (image, infotext) in enumerate(postprocessing.run_postprocessing_stream(items, args)):
+                results.put((index, finishers.submit(encode_pil_to_base64, image), infotext))
 
-        with self.queue_lock:
-            result = postprocessing.run_extras(extras_mode=1, image="", input_dir="", output_dir="", save_output=False, **reqDict)
+        return self.job_scheduler.submit(run)
+
+    def extras_batch_images_api(self, req: ExtrasBatchImagesRequest):
+        results = queue.Queue()
+        self.job_scheduler.wait(self.submit_extras_batch(req, results))
+
+        items = list(results.queue)
+        infotext = items[-1][2] if items else ''
+
+        return ExtrasBatchImagesResponse(images=[future.result() for _, future, _ in items], html_info=ui_common.plaintext_to_html(infotext))
+
+    def extras_batch_images_stream_api(self, req: ExtrasBatchImagesRequest):
+        # NDJSON: 처리가 끝난 이미지부터 한 줄에 하나씩 보내고, 마지막 줄은 {"html_info": ...} 또는 {"error": ...}
+        names = [file.name for file in req.imageList]
+        results = queue.Queue()
+        job = self.submit_extras_batch(req, results)
+
+        def lines():
+            infotext = ''
+            while True:
+                try:
+                    index, future, infotext = results.get(timeout=0.5)
+                except queue.Empty:
+                    if job.done.is_set() and results.empty():
+                        break
+                    continue
+
+                yield ExtrasBatchImageItem(index=index, name=names[index], image=future.result(), info=infotext).json() + "\n"
+
+            if job.error is not None:
+                yield json.dumps({"error": str(job.error.detail if isinstance(job.error, HTTPException) else job.error)}) + "\n"
+            else:
+                yield json.dumps({"html_info": ui_common.plaintext_to_html(infotext)}) + "\n"
 
-        return ExtrasBatchImagesResponse(images=list(map(encode_pil_to_base64, result[0])), html_info=result[1])
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
 
     def pnginfoapi(self, req: PNGInfoRequest):
         if(not req.image.strip()):
@@ -1057,6 +1415,10 @@ class Api:
 
         return ProgressResponse(progress=progress, eta_relative=eta_relative, state=shared.state.dict(), current_image=current_image, textinfo=shared.state.textinfo)
 
+    async def progress_stream(self, id_task: str, request: Request):
+        # 폴링 대신 server-sent events로 진행 상황과 미리보기를 받는다 (event: progress, event: preview)
+        return StreamingResponse(progress_stream.sse_events(request, id_task), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
     def interrogateapi(self, interrogatereq: InterrogateRequest):
         image_b64 = interrogatereq.image
         if image_b64 is None:
@@ -1111,18 +1473,22 @@ class Api:
     def get_upscalers(self):
         return [
             {
-                "name": upscaler.name,
-                "model_name": upscaler.scaler.model_name,
-                "model_path": upscaler.data_path,
+                "name": x.name,
+                "model_name": x.scaler.model_name,
+                "model_path": x.data_path,
                 "model_url": None,
-                "scale": upscaler.scale,
+                "scale": x.scale,
+                **upscaler.timings.get((x.scaler.name, x.data_path), {}),
             }
-            for upscaler in shared.sd_upscalers
+            for x in shared.sd_upscalers
         ]
 
     def get_sd_models(self):
         return [{"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x)} for x in checkpoints_list.values()]
 
+    def get_resident_sd_models(self):
+        return sd_models_residency.residency.list()
+
     def get_hypernetworks(self):
         return [{"name": name, "path": shared.hypernetworks[name]} for name in shared.hypernetworks]
 
@@ -1279,6 +1645,48 @@ class Api:
             cuda = { 'error': f'{err}' }
         return MemoryResponse(ram = ram, cuda = cuda)
 
+    def get_caches(self):
+        return [CacheStatsItem(**cache.stats()) for cache in lru_cache.caches.values()]
+
+    def get_db_stats(self):
+        endpoints = [DbEndpointStatsItem(endpoint=endpoint, requests=requests, queries=queries, avg_queries=queries / requests, max_queries=max_queries)
+                     for endpoint, (requests, queries, max_queries) in database.query_stats.items()]
+
+        return DbStatsResponse(pool=database.pool_status(), endpoints=sorted(endpoints, key=lambda x: -x.avg_queries))
+
+    def get_worker_health(self):
+        checkpoints = []
+        for resident in sd_models_residency.residency.list():
+            checkpoint_info = checkpoint_alisases.get(resident["title"])
+            checkpoints += checkpoint_info.ids if checkpoint_info is not None else [resident["title"]]
+
+        active = shared.sd_model
+        running = self.job_scheduler.running_count()
+        return WorkerHealthResponse(device=devices.get_cuda_device_string(), checkpoint=active.sd_checkpoint_info.title if active is not None else None,
+                                    checkpoints=checkpoints, queued=self.job_scheduler.pending_count() + running, busy=running > 0)
+
+    def get_workers(self):
+        if self.worker_pool is None:
+            return []
+
+        return [DeviceWorkerItem(**x) for x in self.worker_pool.status()]
+
+    def drain_worker(self, name: str, drain: bool = True, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
+        # 워커에 새 작업을 보내지 않도록 한다 (관리자 전용)
+        authenticated_access_token_check(auth)
+        if not user_identity(auth["user_id"], db)["is_admin"]:
+            print_message("User is not admin")
+            raise exceptions.get_admin_exception()
+
+        if self.worker_pool is None:
+            raise HTTPException(status_code=404, detail="Not dispatching to device workers")
+
+        worker = self.worker_pool.drain(name, drain)
+        if worker is None:
+            raise HTTPException(status_code=404, detail=f"Worker {name} not found")
+
+        return DeviceWorkerItem(**worker.dict())
+
     def launch(self, server_name, port):
         self.app.include_router(self.router)
         uvicorn.run(self.app, host=server_name, port=port)
@@ -1286,13 +1694,15 @@ class Api:
     def read_all_creds(self, db: Session = Depends(get_db)):
         return credits.read_creds(db)
     
-    def read_cred_by_id(self, user: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
+    async def read_cred_by_id(self, user: dict = Depends(access_token_auth), db: Session = Depends(get_db), async_db = Depends(get_async_db)):
         if user['type'] == 'refresh':
-            return self.reissue_access_token(db=db, auth=user)
+            return await run_in_threadpool(self.reissue_access_token, db=db, auth=user)
         
         authenticated_access_token_check(user)
         user_email = user.get("email", None)
-        return credits.read_creds(db, user_email)
+        if async_db is not None: # 비동기 드라이버가 설정되어 있으면 이벤트 루프에서 바로 조회
+            return await credits.read_creds_async(async_db, user_email)
+        return await run_in_threadpool(credits.read_creds, db, user_email)
     
     
     def update_cred(self, req: UpdateCreditsRequest, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
@@ -1311,6 +1721,15 @@ class Api:
         else:
             raise HTTPException(status_code=403, detail="You are not authorized to update credits for this user")
     
+    def reconcile_creds(self, apply: bool = False, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
+        # credits_update 기록으로 잔액을 다시 계산해 비교한다. apply=True이면 다른 잔액을 기록 기준으로 고친다 (관리자 전용)
+        authenticated_access_token_check(auth)
+        if not user_identity(auth["user_id"], db)["is_admin"]:
+            print_message("User is not admin")
+            raise exceptions.get_admin_exception()
+        
+        return ReconcileCreditsResponse(**ledger.reconcile(db, apply=apply))
+    
     def modifiers_read(self, db: Session = Depends(get_db), modifier: int = None):
         '''
         modifier starts from 1
@@ -1319,7 +1738,7 @@ class Api:
         modifier: 1, ..., n - return all modifiers in category n
         '''
         print_message(f"Reading modifiers. modifier: {modifier}")
-        modifier_len = len(db.query(models.ModifiersClassDB).all())
+        modifier_len = len(styles.read_modifier(db))
         if modifier == None:
             response = styles.read_modifier(db)
             return response
@@ -1331,4 +1750,15 @@ class Api:
     
     def presets_read(self, db: Session = Depends(get_db)):
         response = styles.read_presets(db)
-        return response
\ No newline at end of file
+        return response
+    
+    def styles_reload(self, auth: dict = Depends(access_token_auth), db: Session = Depends(get_db)):
+        # 프리셋/모디파이어 캐시를 DB에서 다시 읽는다 (관리자 전용)
+        authenticated_access_token_check(auth)
+        if not user_identity(auth["user_id"], db)["is_admin"]:
+            print_message("User is not admin")
+            raise exceptions.get_admin_exception()
+        
+        snapshot = styles.style_cache.reload()
+        return StyleCacheResponse(version=snapshot.version, presets=len(snapshot.presets), modifier_categories=len(snapshot.categories),
+                                  modifiers=len(snapshot.modifiers), stats=CacheStatsItem(**styles.style_cache.stats()))
\ No newline at end of file
@@ -1,5 +1,7 @@
 from datetime import datetime, timedelta
 from typing import Optional
+import threading
+import time
 import requests
 
 from fastapi import Depends, HTTPException, status
@@ -15,6 +17,8 @@ from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 from jose import JWTError, jwt, ExpiredSignatureError
 
+from modules.lru_cache import LruCache
+
 from . import exceptions, users
 from .logs import print_message
 from .database import get_db
@@ -31,8 +35,63 @@ REFRESH_TOKEN_EXPIRES = timedelta(days=settings.JWT_REFRESH_TOKEN_EXPIRE_DAYS)
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl="token")
 bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-def access_token_auth(token: str = Depends(oauth2_bearer), user_type = "normal"):
-    db = next(get_db())
+# 토큰의 user_id -> 유저 존재 여부, 이메일 인증 여부, 관리자 여부. 캐시에 있으면 인증할 때 DB를 조회하지 않는다.
+# 유저 정보를 바꾸는 엔드포인트는 invalidate_identity()로 캐시를 지워야 한다.
+identity_cache = LruCache("identity", settings.IDENTITY_CACHE_SIZE)
+identity_lock = threading.Lock()
+identity_generation = 0
+
+
+def user_identity(user_id: int, db: Session = None) -> dict:
+    '''
+    description:
+        - returns {"email", "exists", "verified", "is_admin"} of the user with user_id
+        - cached for IDENTITY_CACHE_TTL_SECONDS; runs two queries on a miss
+    '''
+    identity = identity_cache.get(user_id)
+    if identity is not None and identity["expires"] > time.time():
+        return identity
+
+    generation = identity_generation
+    if db is None:
+        db = next(get_db())
+
+    user_db = db.query(models.UsersDB).filter(models.UsersDB.id == user_id).first()
+    verify_email_db = None if user_db is None else db.query(models.VerifyEmailDB).filter(models.VerifyEmailDB.email == user_db.email).first()
+
+    identity = {
+        "email": None if user_db is None else user_db.email,
+        "exists": user_db is not None,
+        "verified": verify_email_db is not None and verify_email_db.verified is not False,
+        "is_admin": user_db is not None and bool(user_db.is_admin),
+        "expires": time.time() + settings.IDENTITY_CACHE_TTL_SECONDS,
+    }
+
+    # 조회하는 동안 무효화되었다면 오래된 값일 수 있으므로 캐시에 넣지 않는다
+    with identity_lock:
+        if generation == identity_generation:
+            identity_cache.put(user_id, identity)
+
+    return identity
+
+
+def invalidate_identity(user_id: int = None, email: str = None):
+    '''forgets cached identities of the user with user_id and of users with email'''
+    global identity_generation
+
+    with identity_lock:
+        identity_generation += 1
+
+        if user_id is not None:
+            identity_cache.pop(user_id)
+
+        if email is not None:
+            for key, identity in identity_cache.items():
+                if identity["email"] == email:
+                    identity_cache.pop(key)
+
+
+def access_token_auth(token: str = Depends(oauth2_bearer), user_type = "normal", db: Session = Depends(get_db)):
     
     if user_type == "normal":
         try:
@@ -41,12 +100,16 @@ def access_token_auth(token: str = Depends(oauth2_bearer), user_type = "normal")
             t_type: str = payload.get("type")
             email: str = payload.get("email")
             user_id: int = payload.get("user_id")
-            username: str = db.query(models.UsersDB).filter(models.UsersDB.id == user_id).first().username
             
             if email is None or user_id is None: # 키가 잘못된 경우
                 print("get_current_user: email or user_id is None")
                 raise exceptions.get_user_exception()
             
+            identity = user_identity(user_id, db)
+            if not identity["exists"] or identity["email"] != email: # 삭제되었거나 이메일이 바뀐 유저
+                print("get_current_user: user does not exist")
+                raise exceptions.get_user_exception()
+            
             return {"email": email, "user_id": user_id, "type": t_type, "user_type": user_type} # 토큰이 유효한 경우
         
         except ExpiredSignatureError: # 토큰이 만료된 경우
@@ -79,12 +142,10 @@ def access_token_auth(token: str = Depends(oauth2_bearer), user_type = "normal")
         
     
     
-def refresh_token_auth(token: str = Depends(oauth2_bearer)):
+def refresh_token_auth(token: str = Depends(oauth2_bearer), db: Session = Depends(get_db)):
     try:
         # if access token is expired, it will raise JWTError
         payload = jwt.decode(token, SECRET_KEY_REFRESH, algorithms=[ALGORITHM_ACCESS])
-        token
-        db = next(get_db())
         
         r_token_db = db.query(models.RefreshTokenDB).filter(models.RefreshTokenDB.email == payload.get('email')).first()
         
@@ -211,19 +272,16 @@ def authenticated_access_token_check(auth: dict, db: Session = None, verify: boo
     if auth.get('type') == 'kakao_access':
         return True
     
-    # 유저가 데이터베이스에 있는지 확인
-    if db:
-        if db.query(models.UsersDB).filter(models.UsersDB.email == auth['email']).first() is None:
+    # 유저가 데이터베이스에 있는지 확인 (캐시에 있으면 DB를 조회하지 않는다)
+    if db or verify:
+        identity = user_identity(auth['user_id'], db)
+        if not identity["exists"] or identity["email"] != auth['email']:
             print("User is not in database")
             raise exceptions.get_user_exception()
     
     # 이메일 인증된 회원인지 확인
     if verify:
-        if db is None:
-            db = next(get_db()) # mysql 불러오기
-            
-        is_verified = db.query(models.VerifyEmailDB).filter(models.VerifyEmailDB.email == auth['email']).first()
-        if is_verified is None or is_verified.verified is False:
+        if not identity["verified"]:
             raise exceptions.not_verified_email_exception(auth['email'])
     
     if auth is None:
@@ -32,6 +32,9 @@ class Settings(BaseSettings):
     # credits config
     DEFAULT_CREDITS: int
     CREDITS_PER_IMAGE: int
+    CREDITS_LEDGER_BATCH_SIZE: int = 100 # credits_update에 한 번에 insert 할 최대 행 수
+    CREDITS_LEDGER_FLUSH_SECONDS: float = 1.0
+    CREDITS_RESERVATION_TIMEOUT_SECONDS: int = 3600 # 이보다 오래된 예약은 프로세스가 죽어 남은 것으로 보고 대조에서 건너뛰지 않는다
     TOSS_SECRET_KEY_HEADER: str
     
     # verification config
@@ -41,6 +44,27 @@ class Settings(BaseSettings):
     # feedback config
     FEEDBACK_TYPE: dict
     
+    # image store config
+    IMAGE_STORE_BACKEND: str = "local"
+    IMAGE_STORE_ROOT: str = "generated/store"
+    IMAGE_STORE_SIGNING_KEY: str = "" # 이미지 키 서명용. 비어 있으면 JWT_ACCESS_KEY에서 따로 유도한다
+    
+    # database pool config
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: int = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_ASYNC_DRIVER: str = "" # 예: "aiomysql", "asyncmy". 비어 있으면 비동기 엔진을 만들지 않는다
+    DB_QUERY_LOG_THRESHOLD: int = 0 # 요청 하나가 이보다 많은 쿼리를 실행하면 로그를 남긴다. 0이면 끔
+    
+    # style cache config
+    STYLE_CACHE_TTL_SECONDS: int = 600 # 프리셋/모디파이어 캐시를 다시 읽는 주기
+    STYLE_CACHE_MISS_RELOAD_SECONDS: int = 10 # 없는 프리셋을 요청받았을 때 캐시를 다시 읽는 최소 간격
+    
+    # identity cache config
+    IDENTITY_CACHE_SIZE: int = 10000 # 캐시에 담아둘 유저 수
+    IDENTITY_CACHE_TTL_SECONDS: int = 60
+    
     
     class Config:
         env_file = "./modules/api/conf/.env"
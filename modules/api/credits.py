@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from .database import get_db
 from . import models
+from .ledger import ledger
 from .auths import verify_password, get_password_hashed
 # from .models import CreditsHistoryDB, CreditsDB
 from .models import CreditsDB, UpdateCreditsRequest
@@ -9,6 +10,7 @@ from .logs import print_message
 from sqlalchemy import exc
 from fastapi import HTTPException
 
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 
 def read_creds(db: Session, owner_email: int = None):
@@ -21,15 +23,16 @@ def read_creds(db: Session, owner_email: int = None):
         return db.query(models.CreditsDB).filter(models.CreditsDB.email == owner_email).all()
     return db.query(models.CreditsDB).all()
 
+async def read_creds_async(db, owner_email: str = None):
+    """read_creds for an AsyncSession"""
+    query = select(models.CreditsDB)
+    if owner_email:
+        query = query.where(models.CreditsDB.email == owner_email)
+    return (await db.execute(query)).scalars().all()
+
 def update_cred_by_id(owner_email: str, cred: UpdateCreditsRequest, db: Session):
-    current_cred_db = db.query(models.CreditsDB).filter(models.CreditsDB.email == owner_email).first()
-    current_cred_db.credits = current_cred_db.credits + cred.credits_inc
-    current_cred_db.last_updated = datetime.now()
-    db.add(current_cred_db)
-    
     try:
-        db.commit()
-        db.refresh(current_cred_db)
+        ledger.adjust(db, owner_email, cred.credits_inc)
     except:
         db.rollback()
         raise
@@ -43,34 +46,24 @@ def update_cred(owner_email: str, cred_inc: int, db: Session):
         cred_inc: The new credits.
     '''
     
-    current_cred_db = db.query(models.CreditsDB).filter(models.CreditsDB.email == owner_email).first()
-    current_cred_db.credits = current_cred_db.credits + cred_inc
-    current_cred_db.last_updated = datetime.now()
-    db.add(current_cred_db)
-    
-    update_cred_db = models.CreditsUpdateDB()
-    update_cred_db.email = owner_email
-    update_cred_db.credits_inc = cred_inc
-    update_cred_db.updated = current_cred_db.last_updated
-    db.add(update_cred_db)
-    
-    
+    # 잔액은 UPDATE 한 번으로 바꾸고, credits_update 기록은 원장이 모아서 insert 한다
     try:
-        db.commit()
-        db.refresh(current_cred_db)
+        current_credits = ledger.adjust(db, owner_email, cred_inc)
     except Exception as e:
         db.rollback()
         print("Error: ", e)
         return -1
     
-    return current_cred_db.credits
+    return -1 if current_credits is None else current_credits
 
-def create_new_credit_db(owner_email: str):
+def create_new_credit_db(owner_email: str, db: Session = None):
     ''' Create a new credit database for a user.
     args:
         owner_email: The user to create a new credit database.
+        db: The session to use; the request's session if not given.
     '''
-    db = next(get_db())
+    if db is None:
+        db = next(get_db())
     
     # 신규 유저 생성시, 기본적으로 1000 credits를 부여한다.
     new_credit = models.CreditsDB()
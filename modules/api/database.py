@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-from sqlalchemy import create_engine
+from contextvars import ContextVar
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import os
@@ -10,16 +11,105 @@ IMEZYEB_PW = os.getenv("imezy_db")
 # IMEZY_DATABASE_URL = "mysql+pymysql://admin:{}@imezy.cfrm6ylsjgcg.ap-northeast-2.rds.amazonaws.com:3306/imezy?charset=utf8mb4".format(os.environ["imezy_db"])
 IMEZY_DATABASE_URL = "mysql+pymysql://admin:{}@imezy.cfrm6ylsjgcg.ap-northeast-2.rds.amazonaws.com:3306/imezy?charset=utf8mb4".format(settings.IMEZY_DB_PW)
 
+# 커넥션 풀 설정: pre-ping으로 끊어진 커넥션을 걸러내고, RDS가 idle 커넥션을 끊기 전에 recycle 한다
+pool_options = {
+    "pool_size": settings.DB_POOL_SIZE,
+    "max_overflow": settings.DB_MAX_OVERFLOW,
+    "pool_timeout": settings.DB_POOL_TIMEOUT,
+    "pool_recycle": settings.DB_POOL_RECYCLE,
+    "pool_pre_ping": True,
+}
 
-engine = create_engine(IMEZY_DATABASE_URL)
+engine = create_engine(IMEZY_DATABASE_URL, **pool_options)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+
+class RequestScope:
+    """Database state of a single API request: the session shared by every dependency and helper that asks for one
+    while handling the request, and the number of queries they ran."""
+
+    def __init__(self):
+        self.session = None
+        self.queries = 0
+
+    def get_session(self):
+        if self.session is None:
+            self.session = SessionLocal()
+
+        return self.session
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+request_scope: ContextVar = ContextVar("request_scope", default=None)
+
+
+def count_query(*args, **kwargs):
+    scope = request_scope.get()
+    if scope is not None:
+        scope.queries += 1
+
+
+event.listen(engine, "before_cursor_execute", count_query)
+
+
 def get_db():
+    # 요청 처리 중에는 요청마다 세션 하나를 함께 쓴다. 세션은 요청이 끝날 때 미들웨어가 닫는다.
+    scope = request_scope.get()
+    if scope is not None:
+        yield scope.get_session()
+        return
+
     try:
         db = SessionLocal()
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+# 비동기 드라이버 (GPU를 쓰지 않는 엔드포인트용). DB_ASYNC_DRIVER가 비어 있으면 사용하지 않는다.
+async_engine = None
+AsyncSessionLocal = None
+
+if settings.DB_ASYNC_DRIVER:
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+    async_engine = create_async_engine(IMEZY_DATABASE_URL.replace("mysql+pymysql://", f"mysql+{settings.DB_ASYNC_DRIVER}://"), **pool_options)
+    AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count_query)
+
+
+async def get_async_db():
+    if AsyncSessionLocal is None:
+        yield None
+        return
+
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# 엔드포인트별 쿼리 수 통계: endpoint -> [requests, queries, max_queries]
+query_stats = {}
+
+
+def record_queries(endpoint: str, queries: int):
+    stats = query_stats.setdefault(endpoint, [0, 0, 0])
+    stats[0] += 1
+    stats[1] += queries
+    stats[2] = max(stats[2], queries)
+
+
+def pool_status():
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checked_in": pool.checkedin(),
+    }
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# 갤러리 조회
+# (email, updated, id) 복합 인덱스를 따라 최신순으로 커서 기반 페이지네이션을 한다.
+# 한 번에 최대 MAX_LIMIT개 행만 읽고, 이미지 대신 메타데이터와 썸네일 URL만 돌려주므로 사용자의 생성 기록이 많아도 응답 시간이 일정하다.
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+
+from . import models, image_store
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def encode_cursor(row) -> str:
+    return base64.urlsafe_b64encode(f"{row.updated.strftime('%Y%m%d%H%M%S')}:{row.id}".encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """returns (updated, id) of the last row of the previous page; raises ValueError for a malformed cursor"""
+    try:
+        updated, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return datetime.strptime(updated, "%Y%m%d%H%M%S"), int(row_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def query_gallery(db: Session, email: str, limit: int = DEFAULT_LIMIT, cursor: str = None, imezy_type: int = None,
+                  date_from: datetime = None, date_to: datetime = None):
+    """returns (rows, next_cursor); next_cursor is None on the last page"""
+    limit = max(1, min(limit, MAX_LIMIT))
+    table = models.ImezyUpdateDB
+
+    query = db.query(table).filter(table.email == email)
+    if imezy_type is not None:
+        query = query.filter(table.imezy_type == imezy_type)
+    if date_from is not None:
+        query = query.filter(table.updated >= date_from)
+    if date_to is not None:
+        query = query.filter(table.updated < date_to)
+    if cursor is not None:
+        updated, row_id = decode_cursor(cursor)
+        query = query.filter(or_(table.updated < updated, and_(table.updated == updated, table.id < row_id)))
+
+    # 다음 페이지가 있는지 알기 위해 하나 더 읽는다
+    rows = query.order_by(table.updated.desc(), table.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+
+    return rows[:limit], next_cursor
+
+
+def gallery_item(row, gen: str) -> dict:
+    item = {
+        "image_id": row.id,
+        "updated": row.updated,
+        "imezy_type": row.imezy_type,
+        "gen": gen,
+        "num_imgs": row.num_imgs,
+        "info": None,
+        "images": [],
+        "thumbnails": [],
+        "legacy": False,
+    }
+
+    meta = image_store.load_generation(gen, row.email, row.updated)
+    if meta is None:
+        # 이미지 저장소 도입 전의 생성 기록은 큰 json 파일을 읽지 않고 /image/download로 받도록 한다
+        item["legacy"] = True
+        return item
+
+    store = image_store.get_store()
+    item["info"] = meta.get("info")
+    item["images"] = [store.url(key) for key in meta["images"]]
+    item["thumbnails"] = [store.url(key) for key in meta["images_compressed"]]
+
+    return item
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# 생성된 이미지 저장소
+# 이미지는 생성 시 한 번만 바이너리 파일로 저장하고, 생성 정보(info, parameters)는 작은 meta.json으로 따로 저장한다.
+# 갤러리 API는 base64 대신 이미지 URL을 돌려준다.
+# 이미지 URL은 서명된 키라서 URL을 아는 사람은 로그인 없이 이미지를 받을 수 있다. 키는 생성 기록마다 만들어지고
+# 사용자 세션과 무관하며, 1년 동안 캐시되도록 제공되므로 URL을 공유하면 이미지를 공유한 것과 같다.
+import abc
+import base64
+import hashlib
+import hmac
+import json
+import mimetypes
+import os
+import shutil
+from datetime import datetime
+
+from .config import settings
+
+META_FILENAME = "meta.json"
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp"}
+
+
+class ImageStoreBackend(abc.ABC):
+    """Stores byte blobs under '/'-separated keys. Subclasses implement the actual storage."""
+
+    @abc.abstractmethod
+    def write(self, key: str, data: bytes):
+        pass
+
+    @abc.abstractmethod
+    def read(self, key: str) -> bytes:
+        """returns the data stored under key, or raises FileNotFoundError"""
+        pass
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def delete_prefix(self, prefix: str):
+        """deletes every key that starts with prefix + '/'"""
+        pass
+
+    @abc.abstractmethod
+    def url(self, key: str) -> str:
+        """returns a URL clients can download the data stored under key from"""
+        pass
+
+
+class LocalImageStore(ImageStoreBackend):
+    """Keeps blobs as files under root; files are served by the API at url_prefix + key."""
+
+    def __init__(self, root: str, url_prefix: str = "/image/file/"):
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix
+
+    def path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise FileNotFoundError(key)
+
+        return path
+
+    def write(self, key: str, data: bytes):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # 쓰는 도중에 읽히지 않도록 임시 파일에 쓴 뒤 교체
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def read(self, key: str) -> bytes:
+        with open(self.path(key), "rb") as f:
+            return f.read()
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def delete_prefix(self, prefix: str):
+        shutil.rmtree(self.path(prefix), ignore_errors=True)
+
+    def url(self, key: str) -> str:
+        return self.url_prefix + key
+
+
+backends = {
+    "local": lambda: LocalImageStore(settings.IMAGE_STORE_ROOT),
+}
+
+store = None
+
+
+def get_store() -> ImageStoreBackend:
+    global store
+
+    if store is None:
+        store = backends[settings.IMAGE_STORE_BACKEND]()
+
+    return store
+
+
+def updated_str(updated) -> str:
+    """db의 updated(datetime) 또는 'YYYYmmddHHMMSS' 문자열을 키에 쓰는 형식으로 변환"""
+    if isinstance(updated, datetime):
+        return updated.strftime("%Y%m%d%H%M%S")
+
+    return datetime.strptime(str(updated), "%Y-%m-%d %H:%M:%S").strftime("%Y%m%d%H%M%S") if "-" in str(updated) else str(updated)
+
+
+def signing_key() -> bytes:
+    """IMAGE_STORE_SIGNING_KEY, or if it is not set, a key derived from JWT_ACCESS_KEY for this purpose only, so that
+    image keys never sign with the key that signs access tokens"""
+    if settings.IMAGE_STORE_SIGNING_KEY:
+        return settings.IMAGE_STORE_SIGNING_KEY.encode()
+
+    return hmac.new(settings.JWT_ACCESS_KEY.encode(), b"imezy image store key", hashlib.sha256).digest()
+
+
+def generation_key(gen: str, email: str, updated) -> str:
+    # 키를 추측할 수 없도록 email과 시간으로 만든 서명을 붙인다. URL을 아는 사람만 이미지를 받을 수 있다 (맨 위 주석 참고)
+    updated = updated_str(updated)
+    signature = hmac.new(signing_key(), f"{gen}/{email}/{updated}".encode(), hashlib.sha256).hexdigest()[:24]
+
+    return f"{gen}/{updated}-{signature}"
+
+
+def legacy_filename(gen: str, email: str, updated) -> str:
+    return f"generated/{gen}/{email}/{updated_str(updated)}.json"
+
+
+def image_extension(data: bytes) -> str:
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+
+    return "bin"
+
+
+def save_generation(gen: str, email: str, updated, response_json: dict) -> dict:
+    """response_json의 base64 이미지를 바이너리 파일로 저장하고, 이미지 대신 키가 들어간 메타데이터를 저장해 돌려준다"""
+    image_store = get_store()
+    key = generation_key(gen, email, updated)
+
+    meta = {k: v for k, v in response_json.items() if k not in ("images", "images_compressed")}
+    meta["email"] = email
+    meta["images"] = []
+    meta["images_compressed"] = []
+
+    for field, suffix in (("images", ""), ("images_compressed", ".compressed")):
+        for i, image_b64 in enumerate(response_json.get(field) or []):
+            data = base64.b64decode(image_b64)
+            image_key = f"{key}/{i}{suffix}.{image_extension(data)}"
+            image_store.write(image_key, data)
+            meta[field].append(image_key)
+
+    image_store.write(f"{key}/{META_FILENAME}", json.dumps(meta).encode("utf-8"))
+
+    return meta
+
+
+def load_generation(gen: str, email: str, updated):
+    """저장소의 메타데이터를 돌려준다. 저장소에 없으면 None"""
+    try:
+        return json.loads(get_store().read(f"{generation_key(gen, email, updated)}/{META_FILENAME}"))
+    except FileNotFoundError:
+        return None
+
+
+def load_legacy_generation(gen: str, email: str, updated):
+    """이미지 저장소 도입 전에 저장된 json 파일(base64 이미지 포함)을 읽는다. 없으면 None"""
+    try:
+        with open(legacy_filename(gen, email, updated), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def delete_generation(gen: str, email: str, updated) -> bool:
+    """returns False if there was nothing to delete"""
+    deleted = False
+
+    image_store = get_store()
+    key = generation_key(gen, email, updated)
+    if image_store.exists(f"{key}/{META_FILENAME}"):
+        image_store.delete_prefix(key)
+        deleted = True
+
+    try:
+        os.remove(legacy_filename(gen, email, updated))
+        deleted = True
+    except FileNotFoundError:
+        pass
+
+    return deleted
+
+
+def read_image(key: str):
+    """returns (data, media type) for an image key from a URL; raises FileNotFoundError for anything else"""
+    if os.path.splitext(key)[1].lower() not in IMAGE_EXTENSIONS:
+        raise FileNotFoundError(key)
+
+    return get_store().read(key), mimetypes.guess_type(key)[0] or "application/octet-stream"
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# 크레딧 원장
+# 잔액(credits)은 조건부 UPDATE 한 번으로 원자적으로 바꾸고, 변경 내역(credits_update)은 모아서 백그라운드에서 한꺼번에 insert 한다.
+# 이미지 생성은 샘플링 전에 크레딧을 예약(reserve)하고, 작업이 끝나면 확정(commit)하거나 환불(refund)한다.
+import atexit
+import threading
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from . import models, exceptions
+from .config import settings
+from .database import SessionLocal
+from .logs import print_message
+
+
+class Reservation:
+    """Credits taken from a user's balance for a job that has not finished yet; id is its credits_reservation row."""
+
+    def __init__(self, email: str, amount: int, id: int = None):
+        self.email = email
+        self.amount = amount
+        self.id = id
+        self.settled = False
+
+
+class CreditLedger:
+    """Keeps credit balances and the credits_update ledger consistent.
+
+    Every balance change is a single UPDATE of the credits row, so concurrent requests of one user cannot spend the
+    same credits twice. Ledger rows of committed reservations are queued and inserted by a background thread in
+    batches of up to CREDITS_LEDGER_BATCH_SIZE, at least every CREDITS_LEDGER_FLUSH_SECONDS. Direct adjustments
+    (purchases, admin changes) are rare and insert their ledger row in the same transaction as the balance change. Reserved credits are already taken from
+    the balance but get their ledger row only when committed; refunded reservations leave no ledger row. Until then
+    every reservation has a credits_reservation row, written in the same transaction as the balance change and deleted
+    together with the insert of its ledger row or with the refund, so that every process sees reservations in flight.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.writer = None
+
+    def update_balance(self, db, email: str, credits_inc: int, minimum: int = None, commit: bool = True) -> bool:
+        query = db.query(models.CreditsDB).filter(models.CreditsDB.email == email)
+        if minimum is not None:
+            query = query.filter(models.CreditsDB.credits >= minimum)
+
+        updated = query.update({models.CreditsDB.credits: models.CreditsDB.credits + credits_inc, models.CreditsDB.updated: datetime.now()}, synchronize_session=False)
+        if commit:
+            db.commit()
+
+        return updated == 1
+
+    def balance(self, db, email: str) -> int:
+        return db.query(models.CreditsDB.credits).filter(models.CreditsDB.email == email).scalar()
+
+    def reserve(self, db, email: str, amount: int) -> Reservation:
+        """takes amount credits from the user's balance, or raises not_enough_credits_exception"""
+
+        reservation_id = None
+        try:
+            if self.update_balance(db, email, -amount, minimum=amount, commit=False):
+                row = models.CreditsReservationDB(email=email, amount=amount)
+                db.add(row)
+                db.flush()
+                reservation_id = row.id
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        if reservation_id is None:
+            if self.balance(db, email) is None:
+                print_message("user is None exception")
+                raise exceptions.get_user_exception()
+            raise exceptions.not_enough_credits_exception()
+
+        return Reservation(email, amount, reservation_id)
+
+    def settle(self, reservation: Reservation) -> bool:
+        """marks the reservation as settled; returns False if it already was"""
+
+        with self.lock:
+            if reservation.settled:
+                return False
+
+            reservation.settled = True
+            return True
+
+    def commit(self, db, reservation: Reservation, amount: int = None) -> int:
+        """charges amount (the whole reservation by default) and refunds the rest; returns the user's balance"""
+
+        amount = reservation.amount if amount is None else min(amount, reservation.amount)
+
+        if self.settle(reservation):
+            if amount < reservation.amount:
+                self.update_balance(db, reservation.email, reservation.amount - amount)
+
+            # 예약 행은 원장 행을 insert 할 때 같이 지운다
+            self.record(reservation.email, -amount, reservation.id)
+
+        return self.balance(db, reservation.email)
+
+    def refund(self, db, reservation: Reservation):
+        """gives reserved credits back; does nothing if the reservation was already committed or refunded"""
+
+        if not self.settle(reservation):
+            return
+
+        try:
+            self.update_balance(db, reservation.email, reservation.amount, commit=False)
+            db.query(models.CreditsReservationDB).filter(models.CreditsReservationDB.id == reservation.id).delete(synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        print_message(f"Refunded {reservation.amount} credits to {reservation.email}")
+
+    def refund_in_new_session(self, reservation: Reservation):
+        with closing(self.session_factory()) as db:
+            self.refund(db, reservation)
+
+    def adjust(self, db, email: str, credits_inc: int) -> int:
+        """adds credits_inc (may be negative) to the balance and records it in the ledger; returns the balance, or None if
+        the user has no credits row"""
+
+        # 다른 프로세스의 대조(reconcile)가 잔액만 바뀐 상태를 보지 않도록 원장 행을 같은 트랜잭션에서 insert 한다
+        try:
+            if not self.update_balance(db, email, credits_inc, commit=False):
+                db.rollback()
+                return None
+
+            db.add(models.CreditsUpdateDB(email=email, credits_inc=credits_inc, updated=datetime.now()))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+        return self.balance(db, email)
+
+    def record(self, email: str, credits_inc: int, reservation_id: int = None):
+        with self.lock:
+            self.pending.append(({"email": email, "credits_inc": credits_inc, "updated": datetime.now()}, reservation_id))
+
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self.writer_loop, name="credit-ledger", daemon=True)
+                self.writer.start()
+
+            if len(self.pending) >= settings.CREDITS_LEDGER_BATCH_SIZE:
+                self.condition.notify_all()
+
+    def write(self, db, rows):
+        """inserts ledger rows and deletes the reservations they settle in one transaction"""
+
+        db.bulk_insert_mappings(models.CreditsUpdateDB, [row for row, _ in rows])
+
+        settled = [reservation_id for _, reservation_id in rows if reservation_id is not None]
+        if settled:
+            db.query(models.CreditsReservationDB).filter(models.CreditsReservationDB.id.in_(settled)).delete(synchronize_session=False)
+
+        db.commit()
+
+    def flush(self):
+        """inserts all queued ledger rows; rows that could not be inserted stay queued"""
+
+        with self.flush_lock:
+            with self.lock:
+                rows, self.pending = self.pending, []
+
+            if not rows:
+                return
+
+            try:
+                with closing(self.session_factory()) as db:
+                    self.write(db, rows)
+            except Exception as e:
+                print_message(f"Failed to write {len(rows)} credit ledger rows, will retry: {e}")
+                with self.lock:
+                    self.pending = rows + self.pending
+                raise
+
+    def writer_loop(self):
+        while True:
+            with self.lock:
+                self.condition.wait(timeout=settings.CREDITS_LEDGER_FLUSH_SECONDS)
+
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def reconcile(self, db, apply: bool = False) -> dict:
+        """compares every balance with the user's opening balance plus the sum of their ledger rows. With apply,
+        mismatching balances are corrected by the difference.
+
+        Balance changes made before the ledger was kept completely are not in credits_update, so the first call records
+        the balance of every user without an opening balance as their opening balance, minus the ledger sum, and does
+        not compare them. Users with a reservation in flight in any process are skipped; reservations older than
+        CREDITS_RESERVATION_TIMEOUT_SECONDS were left by a process that died and count as spent."""
+
+        with self.flush_lock, self.lock:
+            rows, self.pending = self.pending, []
+            if rows:
+                self.write(db, rows)
+
+            balances = db.query(models.CreditsDB.email, models.CreditsDB.credits).all()
+
+            cutoff = datetime.now() - timedelta(seconds=settings.CREDITS_RESERVATION_TIMEOUT_SECONDS)
+            skipped = set()
+            stale = {}
+            for email, amount, created in db.query(models.CreditsReservationDB.email, models.CreditsReservationDB.amount, models.CreditsReservationDB.created).all():
+                if created is None or created >= cutoff:
+                    skipped.add(email)
+                else:
+                    stale[email] = stale.get(email, 0) + amount
+
+            ledger = dict(db.query(models.CreditsUpdateDB.email, func.sum(models.CreditsUpdateDB.credits_inc)).group_by(models.CreditsUpdateDB.email).all())
+            openings = dict(db.query(models.CreditsOpeningDB.email, models.CreditsOpeningDB.credits).all())
+
+            mismatches = []
+            opened = []
+            checked = 0
+            for email, credits in balances:
+                if email in skipped:
+                    continue
+
+                accounted = int(ledger.get(email) or 0) - stale.get(email, 0)
+                if email not in openings:
+                    opened.append({"email": email, "credits": credits - accounted, "created": datetime.now()})
+                    continue
+
+                checked += 1
+                expected = openings[email] + accounted
+                if credits != expected:
+                    mismatches.append({"email": email, "credits": credits, "expected": expected})
+
+            if opened:
+                db.bulk_insert_mappings(models.CreditsOpeningDB, opened)
+
+            if apply:
+                # 대조하는 동안 바뀐 잔액을 덮어쓰지 않도록 차이만큼 더한다
+                for mismatch in mismatches:
+                    db.query(models.CreditsDB).filter(models.CreditsDB.email == mismatch["email"]).update({models.CreditsDB.credits: models.CreditsDB.credits + (mismatch["expected"] - mismatch["credits"])}, synchronize_session=False)
+                print_message(f"Reconciled credits of {len(mismatches)} users from the ledger")
+
+            db.commit()
+
+        return {"checked": checked, "skipped": len(skipped), "opened": len(opened), "mismatches": mismatches, "applied": apply}
+
+
+ledger = CreditLedger()
+
+
+@atexit.register
+def flush_on_exit():
+    try:
+        ledger.flush()
+    except Exception:
+        pass
@@ -9,7 +9,7 @@ from typing import Dict, List
 from datetime import datetime, timedelta
 
 from .database import Base, SessionLocal, engine
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Table, JSON
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Table, JSON, Index
 from sqlalchemy.orm import relationship
 
 from .config import settings
@@ -151,6 +151,21 @@ class ImageToImageAuthResponse(BaseModel):
     info: dict
     credits: int
 
+class JobSubmitResponse(BaseModel):
+    id_task: str = Field(title="Task ID", description="Id to poll /sdapi/v1/jobs/{id_task} with")
+    queue_position: Optional[int] = Field(default=None, title="Queue position", description="Number of jobs that will run before this one")
+
+class JobStatusResponse(BaseModel):
+    id_task: str = Field(title="Task ID")
+    status: str = Field(title="Status", description="One of queued, running, finished, failed, cancelled")
+    priority: int = Field(title="Priority class", description="0 for paid users, 1 for free users")
+    queue_position: Optional[int] = Field(default=None, title="Queue position", description="Number of jobs that will run before this one")
+    time_queued: float = Field(title="Time queued")
+    time_started: Optional[float] = Field(default=None, title="Time started")
+    time_finished: Optional[float] = Field(default=None, title="Time finished")
+    error: Optional[str] = Field(default=None, title="Error")
+    result: Optional[Any] = Field(default=None, title="Result", description="The endpoint's regular response once the job has finished")
+
 class ExtrasBaseRequest(BaseModel):
     resize_mode: Literal[0, 1] = Field(default=0, title="Resize Mode", description="Sets the resize mode: 0 to upscale by upscaling_resize amount, 1 to upscale up to upscaling_resize_h x upscaling_resize_w.")
     show_extras_results: bool = Field(default=True, title="Show results", description="Should the backend return the generated image?")
@@ -253,6 +268,10 @@ class UpscalerItem(BaseModel):
     model_path: Optional[str] = Field(title="Path")
     model_url: Optional[str] = Field(title="URL")
     scale: Optional[float] = Field(title="Scale")
+    loads: int = Field(default=0, title="Loads", description="Number of upscales that had to load the model first")
+    load_time: float = Field(default=0.0, title="Load time", description="Total time spent loading the model, in seconds")
+    upscales: int = Field(default=0, title="Upscales")
+    upscale_time: float = Field(default=0.0, title="Upscale time", description="Total time spent upscaling, not counting loading the model, in seconds")
 
 class SDModelItem(BaseModel):
     title: str = Field(title="Title")
@@ -262,6 +281,13 @@ class SDModelItem(BaseModel):
     filename: str = Field(title="Filename")
     config: Optional[str] = Field(title="Config file")
 
+class ResidentSDModelItem(BaseModel):
+    title: str = Field(title="Title")
+    size: int = Field(title="Size", description="Size of the model's weights in bytes")
+    on_device: bool = Field(title="On device", description="Whether the model is kept in VRAM rather than RAM")
+    pinned: bool = Field(title="Pinned")
+    active: bool = Field(title="Active", description="Whether this is the model currently used for generation")
+
 class HypernetworkItem(BaseModel):
     name: str = Field(title="Name")
     path: Optional[str] = Field(title="Path")
@@ -347,6 +373,28 @@ class UpdateCreditsResponse(BaseModel):
 class DownloadImageRequest(BaseModel):
     index: int = Field(title="Image Index")    
 
+class GalleryRequest(BaseModel):
+    limit: int = Field(default=20, title="Limit", description="Number of generations per page, at most 100")
+    cursor: Optional[str] = Field(default=None, title="Cursor", description="next_cursor from the previous page")
+    imezy_type: Optional[int] = Field(default=None, title="Imezy Type", description="Only return generations of this type")
+    date_from: Optional[datetime] = Field(default=None, title="Date From", description="Only return generations made at or after this time")
+    date_to: Optional[datetime] = Field(default=None, title="Date To", description="Only return generations made before this time")
+
+class GalleryItem(BaseModel):
+    image_id: int = Field(title="Image ID")
+    updated: datetime = Field(title="Updated")
+    imezy_type: int = Field(title="Imezy Type")
+    gen: str = Field(title="Generation Type", description="t2i or i2i")
+    num_imgs: int = Field(title="Number of Images")
+    info: Optional[dict] = Field(title="Generation Info")
+    images: List[str] = Field(title="Image URLs")
+    thumbnails: List[str] = Field(title="Thumbnail URLs")
+    legacy: bool = Field(title="Legacy", description="Stored before the image store; images must be fetched with /image/download")
+
+class GalleryResponse(BaseModel):
+    items: List[GalleryItem] = Field(title="Items")
+    next_cursor: Optional[str] = Field(title="Next Cursor", description="Pass as cursor to get the next page; null on the last page")
+
 class EmailVerificaionSendRequest(BaseModel):
     email_to: Optional[str] = Field(title="Email To", description="Email to send verification code to", default=None)
 
@@ -438,8 +486,27 @@ class CreditsUpdateDB(Base):
     credits_inc = Column(Integer, default=0)
     updated = Column(DateTime, default=datetime.now)
     
+class CreditsReservationDB(Base):
+    __tablename__ = "credits_reservation" # 예약했지만 아직 확정/환불하지 않은 크레딧. 모든 프로세스가 같이 본다
+    
+    id = Column(Integer, primary_key=True, index=True)
+    email = Column(String, ForeignKey("users.email"), index=True)
+    amount = Column(Integer, nullable=False)
+    created = Column(DateTime, default=datetime.now)
+    
+class CreditsOpeningDB(Base):
+    __tablename__ = "credits_opening" # 원장 대조를 시작할 때의 잔액. 그 전의 변경은 credits_update에 없을 수 있다
+    
+    id = Column(Integer, primary_key=True, index=True)
+    email = Column(String, ForeignKey("users.email"), unique=True, index=True)
+    credits = Column(Integer, nullable=False)
+    created = Column(DateTime, default=datetime.now)
+    
 class ImezyUpdateDB(Base):
     __tablename__ = "imezy_update"
+    __table_args__ = (
+        Index("ix_imezy_update_email_updated_id", "email", "updated", "id"), # 갤러리 페이지네이션용
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, ForeignKey("users.email"))
@@ -547,3 +614,95 @@ class PresetsDB(Base):
 class MemoryResponse(BaseModel):
     ram: dict = Field(title="RAM", description="System memory stats")
     cuda: dict = Field(title="CUDA", description="nVidia CUDA memory stats")
+
+class ReconcileCreditsItem(BaseModel):
+    email: str = Field(title="Email")
+    credits: int = Field(title="Credits", description="Balance in the credits table")
+    expected: int = Field(title="Expected credits", description="Balance rebuilt from the credits_update ledger")
+
+class ReconcileCreditsResponse(BaseModel):
+    checked: int = Field(title="Checked", description="Number of balances compared with the ledger")
+    skipped: int = Field(title="Skipped", description="Number of users skipped because they have reservations in flight")
+    opened: int = Field(title="Opened", description="Number of users whose opening balance was recorded by this call and who were not compared yet")
+    mismatches: List[ReconcileCreditsItem] = Field(title="Mismatches")
+    applied: bool = Field(title="Applied", description="Whether mismatching balances were overwritten")
+
+class DbEndpointStatsItem(BaseModel):
+    endpoint: str = Field(title="Endpoint")
+    requests: int = Field(title="Requests")
+    queries: int = Field(title="Queries", description="Total number of queries run by all requests")
+    avg_queries: float = Field(title="Average queries per request")
+    max_queries: int = Field(title="Most queries run by a single request")
+
+class DbStatsResponse(BaseModel):
+    pool: dict = Field(title="Pool", description="Connection pool status")
+    endpoints: List[DbEndpointStatsItem] = Field(title="Endpoints")
+
+class CacheStatsItem(BaseModel):
+    name: str = Field(title="Name")
+    items: int = Field(title="Items", description="Number of cached values")
+    size: int = Field(title="Size", description="Total size of cached values, in the cache's own units")
+    max_size: int = Field(title="Max size")
+    hits: int = Field(title="Hits")
+    misses: int = Field(title="Misses")
+    hit_rate: float = Field(title="Hit rate")
+    evictions: int = Field(title="Evictions")
+    loads: int = Field(default=0, title="Loads", description="Number of values loaded on a miss, for caches that record it")
+    load_time: float = Field(default=0.0, title="Load time", description="Total time spent loading values on misses, in seconds")
+
+class StyleCacheResponse(BaseModel):
+    version: int = Field(title="Version", description="Incremented every time presets and modifiers are read from the database")
+    presets: int = Field(title="Presets")
+    modifier_categories: int = Field(title="Modifier categories")
+    modifiers: int = Field(title="Modifiers")
+    stats: CacheStatsItem = Field(title="Cache stats")
+
+class WorkerHealthResponse(BaseModel):
+    device: str = Field(title="Device")
+    checkpoint: Optional[str] = Field(default=None, title="Checkpoint", description="Title of the checkpoint currently used for generation")
+    checkpoints: List[str] = Field(title="Checkpoints", description="Titles and aliases of every loaded checkpoint, active or resident")
+    queued: int = Field(title="Queued", description="Number of jobs queued or running")
+    busy: bool = Field(title="Busy")
+
+class DeviceWorkerItem(BaseModel):
+    name: str = Field(title="Name")
+    url: str = Field(title="URL")
+    healthy: bool = Field(title="Healthy", description="Whether the worker answered its last health check")
+    draining: bool = Field(title="Draining", description="Whether the worker is kept from getting new jobs")
+    device: Optional[str] = Field(default=None, title="Device")
+    checkpoint: Optional[str] = Field(default=None, title="Checkpoint")
+    queued: int = Field(title="Queued", description="Number of jobs queued or running, as of the last health check")
+    in_flight: int = Field(title="In flight", description="Number of jobs sent to the worker that have not returned yet")
+    jobs: int = Field(title="Jobs", description="Number of jobs the worker has completed")
+    failures: int = Field(title="Failures", description="Number of failed health checks or deliveries in a row")
+    last_error: Optional[str] = Field(default=None, title="Last error")
+    last_seen: Optional[float] = Field(default=None, title="Last seen")
+
+
+class ExtrasBatchImageItem(BaseModel):
+    index: int = Field(title="Index", description="Position of the image in imageList")
+    name: str = Field(title="File name")
+    image: str = Field(title="Image", description="The processed image in base64 format")
+    info: str = Field(title="Info", description="Postprocessing parameters of the image")
+
+class SDUpscaleRequest(StableDiffusionImg2ImgProcessingAPI):
+    upscaler: str = Field(default="None", title="Upscaler", description="Upscaler that enlarges the image before it is redrawn in tiles of width x height")
+    scale_factor: float = Field(default=2.0, ge=1.0, le=8.0, title="Scale factor")
+    overlap: int = Field(default=64, ge=0, title="Tile overlap", description="Overlap between neighbouring tiles, in pixels")
+
+class SDUpscaleStats(BaseModel):
+    width: int = Field(title="Width", description="Width of the result")
+    height: int = Field(title="Height", description="Height of the result")
+    tiles: int = Field(title="Tiles", description="Number of tiles the image is denoised in")
+    tile_batch_size: int = Field(title="Tile batch size", description="Number of tiles denoised at once, as fit into memory")
+    unet_calls: int = Field(title="UNet calls")
+    tile_evaluations: int = Field(title="Tile evaluations", description="Number of tiles run through the UNet, counting conditional and unconditional passes")
+    time: float = Field(title="Time", description="Seconds from the start of encoding to the end of decoding")
+    tiles_per_second: float = Field(title="Tiles per second")
+
+class SDUpscaleResponse(BaseModel):
+    images: List[str] = Field(default=None, title="Image", description="The generated image in base64 format.")
+    images_compressed: List[str] = Field(default=None, title="Image", description="The generated image compressed in base64 format.")
+    parameters: dict
+    info: dict
+    stats: SDUpscaleStats = Field(title="Tile stats")
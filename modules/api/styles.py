@@ -1,61 +1,197 @@
 # -*- coding: utf-8 -*-
+import threading
+import time
+from contextlib import closing
+
+from fastapi import HTTPException
+
+from modules import lru_cache
+
 from . import models
 from .config import settings
+from .database import SessionLocal
+from .logs import print_message
+
+
+def preset_id(preset) -> int:
+    """Preset ids come as int from txt2img and as str from img2img, where the default is "none". The old query
+    compared them to the id column in MySQL, which casts a string that is not a number to 0, so this does the same."""
+
+    if isinstance(preset, int):
+        return preset
+
+    try:
+        return int(str(preset).strip())
+    except ValueError:
+        return 0
+
+
+class StyleSnapshot:
+    """Presets and modifiers as read from the database at one point in time."""
+
+    def __init__(self, version: int, presets: list, categories: list, modifiers: list):
+        self.version = version
+        self.loaded_at = time.time()
+        self.presets = presets
+        self.presets_by_id = {x.id: x for x in presets}
+        self.presets_by_name = {}
+        for x in presets:
+            self.presets_by_name.setdefault(x.name, x)
+        self.categories = categories
+        self.categories_by_id = {x.id: x for x in categories}
+        self.modifiers = modifiers
+        self.modifiers_by_category = {}
+        for x in modifiers:
+            self.modifiers_by_category.setdefault(x.modifier, []).append(x)
+
+
+class StyleCache:
+    """In-process copy of the presets, modifiers_class and modifiers tables.
+
+    The tables are read in full with a session of the cache's own, and the rows are kept detached from it. A
+    snapshot is reloaded after STYLE_CACHE_TTL_SECONDS, when invalidate() is called, or when a preset id that is
+    not in it is asked for (at most once every STYLE_CACHE_MISS_RELOAD_SECONDS). Each reload gets a new version.
+    """
+
+    def __init__(self):
+        self.name = "styles"
+        self.snapshot = None
+        self.version = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+        lru_cache.caches[self.name] = self
+
+    def is_fresh(self, snapshot) -> bool:
+        return snapshot is not None and time.time() - snapshot.loaded_at < settings.STYLE_CACHE_TTL_SECONDS
+
+    def load(self) -> StyleSnapshot:
+        with closing(SessionLocal()) as db:
+            presets = db.query(models.PresetsDB).order_by(models.PresetsDB.id).all()
+            categories = db.query(models.ModifiersClassDB).order_by(models.ModifiersClassDB.id).all()
+            modifiers = db.query(models.ModifiersDB).order_by(models.ModifiersDB.id).all()
+
+        self.version += 1
+        self.reloads += 1
+        self.snapshot = StyleSnapshot(self.version, presets, categories, modifiers)
+
+        print_message(f"Loaded styles version {self.version}: {len(presets)} presets, {len(categories)} modifier categories, {len(modifiers)} modifiers")
+
+        return self.snapshot
+
+    def reload(self) -> StyleSnapshot:
+        with self.lock:
+            return self.load()
+
+    def warm_up(self):
+        # 서버 시작을 늦추지 않도록 백그라운드에서 읽는다
+        def load():
+            try:
+                self.reload()
+            except Exception as e:
+                print_message(f"Failed to load styles: {e}")
+
+        threading.Thread(target=load, name="styles-warm-up", daemon=True).start()
+
+    def invalidate(self):
+        self.snapshot = None
+
+    def get(self) -> StyleSnapshot:
+        snapshot = self.snapshot
+        if self.is_fresh(snapshot):
+            self.hits += 1
+            return snapshot
+
+        self.misses += 1
+        with self.lock:
+            # 기다리는 동안 다른 요청이 이미 다시 읽었을 수 있다
+            snapshot = self.snapshot
+            return snapshot if self.is_fresh(snapshot) else self.load()
+
+    def get_preset(self, preset):
+        key = preset_id(preset)
+        snapshot = self.get()
+        preset = snapshot.presets_by_id.get(key)
+        if preset is None and time.time() - snapshot.loaded_at >= settings.STYLE_CACHE_MISS_RELOAD_SECONDS:
+            # 캐시를 읽은 뒤에 추가된 프리셋일 수 있다
+            preset = self.reload().presets_by_id.get(key)
+
+        return preset
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        snapshot = self.snapshot
+
+        return {
+            "name": self.name,
+            "items": 0 if snapshot is None else len(snapshot.presets) + len(snapshot.categories) + len(snapshot.modifiers),
+            "size": 0 if snapshot is None else 1,
+            "max_size": 1,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests > 0 else 0.0,
+            "evictions": self.reloads,
+        }
+
+
+style_cache = StyleCache()
 
 
 def read_modifier(db, mod: int = None):
     """
-    Read modifier from database
+    Read modifier from the style cache
     args:
-        db: database session
+        db: database session (unused, kept for compatibility)
         mod: modifier id
             None: return all modifier categories
             0: return all modifiers
             else: return modifier with id
     """
-    
+    snapshot = style_cache.get()
+
     if mod == None:
-        modifier_catetory = db.query(models.ModifiersClassDB).all()
-        return modifier_catetory
-        
+        return snapshot.categories
+
     elif mod == 0:
-        modifier = db.query(models.ModifiersDB).all()
-        return modifier
+        return snapshot.modifiers
     else: # mod: 1, ..., n
-        mod_category = db.query(models.ModifiersClassDB).filter(models.ModifiersClassDB.id == mod).first().modifier
-        modifier = db.query(models.ModifiersDB).filter(models.ModifiersDB.modifier == mod_category).all()
-        return modifier
+        if (mod_category := snapshot.categories_by_id.get(mod)) is None:
+            raise HTTPException(status_code=404, detail=f"Modifier category {mod} not found")
+        return snapshot.modifiers_by_category.get(mod_category.modifier, [])
 
 def read_presets(db, preset: str = None):
     """
-    Read presets from database
+    Read presets from the style cache
     args:
-        db: database session
+        db: database session (unused, kept for compatibility)
     """
+    snapshot = style_cache.get()
     if preset:
-        preset = db.query(models.PresetsDB).filter(models.PresetsDB.name == preset).first()
-        return preset
+        return snapshot.presets_by_name.get(preset)
     else:
-        presets = db.query(models.PresetsDB).all()
-        return presets
+        return snapshot.presets
 
 def load_prompts(db, preset: int, user_prompt:str = "", user_negative_prompt:str = ""):
         """
             프리셋 설정
-            DB에서 프리셋 설정을 불러와 유저가 입력한 prompt와 db상에서 사전 입력된 base prompt(prompt_b)를 ', '로 합친다.
+            캐시된 프리셋 설정을 불러와 유저가 입력한 prompt와 db상에서 사전 입력된 base prompt(prompt_b)를 ', '로 합친다.
             negative prompt도 마찬가지
 
         Args:
-            db (Session): database
+            db (Session): database (사용하지 않음)
 
         Returns:
             prompt_sum, negative_prompt_sum: prompt + prompt_b, negative_prompt + negative_prompt_b
-        """    
-        preset_db = db.query(models.PresetsDB).filter(models.PresetsDB.id == preset).first()
-       
+        """
+        preset_db = style_cache.get_preset(preset)
+        if preset_db is None:
+            raise HTTPException(status_code=404, detail=f"Preset {preset} not found")
+
         prompt_b = preset_db.prompt_b if preset_db.prompt_b is not None else ""
         negative_prompt_b = preset_db.negative_prompt_b if preset_db.negative_prompt_b is not None else ""
-        
+
         prompt_sum = ', '.join([user_prompt, prompt_b])
         negative_prompt_sum = ', '.join([user_negative_prompt, negative_prompt_b])
-        return prompt_sum, negative_prompt_sum
\ No newline at end of file
+        return prompt_sum, negative_prompt_sum
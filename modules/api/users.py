@@ -73,6 +73,7 @@ def delete_user(db: Session, user_id):
     user = db.query(models.UsersDB).filter(models.UsersDB.id == user_id).first()
     db.delete(user)
     db.commit()
+    auths.invalidate_identity(user_id=user_id)
     return user
 
 def create_user_kakao(new_user:dict):
@@ -164,7 +165,7 @@ def create_user(new_user):
                             detail=f"Failed to create user {new_user_db.email}, Error: {e}")
     
     # 신규 유저의 크래딧 정보를 생성
-    create_credits = credits.create_new_credit_db(new_user_db.email)
+    create_credits = credits.create_new_credit_db(new_user_db.email, db)
     print(f"creating credits: {create_credits}")
 
     return {"message": f'User {new_user["username"]} created successfully'}
@@ -234,11 +235,13 @@ def verify_user(email: dict) -> dict:
             verify_email_db.verified = True
             db.add(verify_email_db)
             db.commit()
+            auths.invalidate_identity(email=email)
             print_message(f"User {email} verified successfully")
             return {"message": f"User {email} verified successfully"}
         else: # 이메일 인증 DB 테이블에 있는 경우
             verify_email_db.verified = True
             db.commit()
+            auths.invalidate_identity(email=email)
             print_message(f"User {email} verified successfully")
             return {"message": f"User {email} verified successfully"}
     except AttributeError: # auth에 email 값이 없는 경우
@@ -1,12 +1,10 @@
 import os
 
-import numpy as np
 import torch
-from PIL import Image
 from basicsr.utils.download_util import load_file_from_url
 
 import modules.esrgan_model_arch as arch
-from modules import shared, modelloader, images, devices
+from modules import shared, modelloader, devices, upscaler_tiling
 from modules.upscaler import Upscaler, UpscalerData
 from modules.shared import opts
 
@@ -147,12 +145,14 @@ class UpscalerESRGAN(Upscaler):
             self.scalers.append(scaler_data)
 
     def do_upscale(self, img, selected_model):
-        model = self.load_model(selected_model)
+        return self.do_upscale_batch([img], selected_model)[0]
+
+    def do_upscale_batch(self, imgs, selected_model):
+        model = self.load_model_cached(selected_model)
         if model is None:
-            return img
+            return imgs
         model.to(devices.device_esrgan)
-        img = esrgan_upscale(model, img)
-        return img
+        return esrgan_upscale_batch(model, imgs)
 
     def load_model(self, path: str):
         if "http" in path:
@@ -195,39 +195,12 @@ class UpscalerESRGAN(Upscaler):
 
 
 def upscale_without_tiling(model, img):
-    img = np.array(img)
-    img = img[:, :, ::-1]
-    img = np.ascontiguousarray(np.transpose(img, (2, 0, 1))) / 255
-    img = torch.from_numpy(img).float()
-    img = img.unsqueeze(0).to(devices.device_esrgan)
-    with torch.no_grad():
-        output = model(img)
-    output = output.squeeze().float().cpu().clamp_(0, 1).numpy()
-    output = 255. * np.moveaxis(output, 0, 2)
-    output = output.astype(np.uint8)
-    output = output[:, :, ::-1]
-    return Image.fromarray(output, 'RGB')
+    return upscaler_tiling.upscale(model, img, 0, 0, devices.device_esrgan)
 
 
 def esrgan_upscale(model, img):
-    if opts.ESRGAN_tile == 0:
-        return upscale_without_tiling(model, img)
-
-    grid = images.split_grid(img, opts.ESRGAN_tile, opts.ESRGAN_tile, opts.ESRGAN_tile_overlap)
-    newtiles = []
-    scale_factor = 1
-
-    for y, h, row in grid.tiles:
-        newrow = []
-        for tiledata in row:
-            x, w, tile = tiledata
-
-            output = upscale_without_tiling(model, tile)
-            scale_factor = output.width // tile.width
+    return esrgan_upscale_batch(model, [img])[0]
 
-            newrow.append([x * scale_factor, w * scale_factor, output])
-        newtiles.append([y * scale_factor, h * scale_factor, newrow])
 
-    newgrid = images.Grid(newtiles, grid.tile_w * scale_factor, grid.tile_h * scale_factor, grid.image_w * scale_factor, grid.image_h * scale_factor, grid.overlap * scale_factor)
-    output = images.combine_grid(newgrid)
-    return output
+def esrgan_upscale_batch(model, imgs):
+    return upscaler_tiling.upscale_batch(model, imgs, opts.ESRGAN_tile, opts.ESRGAN_tile_overlap, devices.device_esrgan)
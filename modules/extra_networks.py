@@ -5,6 +5,10 @@ from modules import errors
 
 extra_network_registry = {}
 
+# hashable description of the extra networks passed to the last activate() call; used as part of the key for
+# cached text encoder results, since networks like LoRA change what the text encoder returns
+active_key = ()
+
 
 def initialize():
     extra_network_registry.clear()
@@ -65,6 +69,9 @@ def activate(p, extra_network_data):
     """call activate for extra networks in extra_network_data in specified order, then call
     activate for all remaining registered networks with an empty argument list"""
 
+    global active_key
+    active_key = tuple(sorted((name, tuple(tuple(x.items) for x in args)) for name, args in extra_network_data.items()))
+
     for extra_network_name, extra_network_args in extra_network_data.items():
         extra_network = extra_network_registry.get(extra_network_name, None)
         if extra_network is None:
@@ -1,6 +1,8 @@
+import concurrent.futures
 import hashlib
 import json
 import os.path
+import threading
 
 import filelock
 
@@ -11,28 +13,89 @@ from modules.paths import data_path
 cache_filename = os.path.join(data_path, "cache.json")
 cache_data = None
 
+# changes to the cache are appended to this file as JSON lines instead of rewriting cache.json every time;
+# they are merged into cache.json when the log grows past cache_log_max_entries
+cache_log_filename = os.path.join(data_path, "cache.log.jsonl")
+cache_log_max_entries = 1000
+cache_log_entries = 0
+
+cache_lock = threading.RLock()
+
+hashing_executor = None
+hashing_pending = {}
+
+
+def read_cache_log():
+    """applies changes recorded in the log to cache_data and returns the number of changes read"""
+
+    if not os.path.isfile(cache_log_filename):
+        return 0
+
+    count = 0
+    with open(cache_log_filename, "r", encoding="utf8") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by an interrupted write
+
+            cache_data.setdefault(entry["subsection"], {})[entry["key"]] = entry["value"]
+            count += 1
+
+    return count
+
 
 def dump_cache():
-    with filelock.FileLock(cache_filename+".lock"):
-        with open(cache_filename, "w", encoding="utf8") as file:
-            json.dump(cache_data, file, indent=4)
+    global cache_log_entries
+
+    with cache_lock:
+        with filelock.FileLock(cache_filename+".lock"):
+            read_cache_log()  # other processes may have logged changes we don't have yet
+
+            with open(cache_filename, "w", encoding="utf8") as file:
+                json.dump(cache_data, file, indent=4)
+
+            if os.path.isfile(cache_log_filename):
+                os.remove(cache_log_filename)
+
+        cache_log_entries = 0
 
 
 def cache(subsection):
-    global cache_data
+    global cache_data, cache_log_entries
+
+    with cache_lock:
+        if cache_data is None:
+            with filelock.FileLock(cache_filename+".lock"):
+                if not os.path.isfile(cache_filename):
+                    cache_data = {}
+                else:
+                    with open(cache_filename, "r", encoding="utf8") as file:
+                        cache_data = json.load(file)
+
+                cache_log_entries = read_cache_log()
+
+        s = cache_data.get(subsection, {})
+        cache_data[subsection] = s
+
+        return s
 
-    if cache_data is None:
-        with filelock.FileLock(cache_filename+".lock"):
-            if not os.path.isfile(cache_filename):
-                cache_data = {}
-            else:
-                with open(cache_filename, "r", encoding="utf8") as file:
-                    cache_data = json.load(file)
 
-    s = cache_data.get(subsection, {})
-    cache_data[subsection] = s
+def update_cache(subsection, key, value):
+    """sets cache(subsection)[key] to value and saves the change by appending it to the log"""
 
-    return s
+    global cache_log_entries
+
+    with cache_lock:
+        cache(subsection)[key] = value
+
+        with filelock.FileLock(cache_filename+".lock"):
+            with open(cache_log_filename, "a", encoding="utf8") as file:
+                file.write(json.dumps({"subsection": subsection, "key": key, "value": value}) + "\n")
+
+        cache_log_entries += 1
+        if cache_log_entries >= cache_log_max_entries:
+            dump_cache()
 
 
 def calculate_sha256(filename):
@@ -46,6 +109,21 @@ def calculate_sha256(filename):
     return hash_sha256.hexdigest()
 
 
+def fingerprint(filename, blocks=16, block_size=64 * 1024):
+    """a cheap identifier for the contents of a file, made from its size and a few blocks sampled evenly across it;
+    it takes a few reads regardless of file size, so it can be used before the full sha256 is known"""
+
+    size = os.path.getsize(filename)
+    hash_sha256 = hashlib.sha256(str(size).encode())
+
+    with open(filename, "rb") as f:
+        for i in range(blocks):
+            f.seek(size * i // blocks)
+            hash_sha256.update(f.read(block_size))
+
+    return hash_sha256.hexdigest()[0:16]
+
+
 def sha256_from_cache(filename, title):
     hashes = cache("hashes")
     ondisk_mtime = os.path.getmtime(filename)
@@ -56,15 +134,31 @@ def sha256_from_cache(filename, title):
     cached_sha256 = hashes[title].get("sha256", None)
     cached_mtime = hashes[title].get("mtime", 0)
 
-    if ondisk_mtime > cached_mtime or cached_sha256 is None:
+    if cached_sha256 is None:
         return None
 
+    if ondisk_mtime > cached_mtime:
+        # copying model files to another machine changes their mtime; if the size and sampled blocks are still the
+        # same, keep the hash instead of reading the whole file again
+        cached_fingerprint = hashes[title].get("fingerprint", None)
+        if cached_fingerprint is None or hashes[title].get("size", None) != os.path.getsize(filename) or cached_fingerprint != fingerprint(filename):
+            return None
+
+        update_cache("hashes", title, {**hashes[title], "mtime": ondisk_mtime})
+
     return cached_sha256
 
 
-def sha256(filename, title):
-    hashes = cache("hashes")
+def store_sha256(filename, title, sha256_value):
+    update_cache("hashes", title, {
+        "mtime": os.path.getmtime(filename),
+        "sha256": sha256_value,
+        "size": os.path.getsize(filename),
+        "fingerprint": fingerprint(filename),
+    })
 
+
+def sha256(filename, title):
     sha256_value = sha256_from_cache(filename, title)
     if sha256_value is not None:
         return sha256_value
@@ -72,20 +166,58 @@ def sha256(filename, title):
     if shared.cmd_opts.no_hashing:
         return None
 
+    with cache_lock:
+        future = hashing_pending.get(title, None)
+
+    # if the file is already being hashed in background, wait for that; if it is only queued, hash it here instead
+    if future is not None:
+        if not future.cancel():
+            return future.result()
+
+        with cache_lock:
+            hashing_pending.pop(title, None)
+
     print(f"Calculating sha256 for {filename}: ", end='')
     sha256_value = calculate_sha256(filename)
     print(f"{sha256_value}")
 
-    hashes[title] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value,
-    }
-
-    dump_cache()
+    store_sha256(filename, title, sha256_value)
 
     return sha256_value
 
 
+def background_sha256(filename, title):
+    try:
+        sha256_value = calculate_sha256(filename)
+        store_sha256(filename, title, sha256_value)
+        print(f"Calculated sha256 for {filename}: {sha256_value}")
+
+        return sha256_value
+    finally:
+        with cache_lock:
+            hashing_pending.pop(title, None)
+
+
+def sha256_in_background(filename, title):
+    """queues calculating sha256 for the file on the hashing thread pool, unless it's already known or queued;
+    the result goes into the cache, so that a later sha256() call for the same title returns immediately"""
+
+    global hashing_executor
+
+    if shared.cmd_opts.no_hashing or shared.opts.hashing_threads <= 0:
+        return
+
+    try:
+        if sha256_from_cache(filename, title) is not None:
+            return
+    except OSError:
+        return
 
+    with cache_lock:
+        if title in hashing_pending:
+            return
 
+        if hashing_executor is None:
+            hashing_executor = concurrent.futures.ThreadPoolExecutor(max_workers=shared.opts.hashing_threads, thread_name_prefix="hashing")
 
+        hashing_pending[title] = hashing_executor.submit(background_sha256, filename, title)
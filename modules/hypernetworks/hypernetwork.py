@@ -317,6 +317,7 @@ def list_hypernetworks(path):
         # Prevent a hypothetical "None.pt" from being listed.
         if name != "None":
             res[name] = filename
+            hashes.sha256_in_background(filename, f'hypernet/{name}')
     return res
 
 
@@ -0,0 +1,395 @@
+import collections
+import concurrent.futures
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from modules import shared, progress
+
+class JobCancelled(Exception):
+    pass
+
+
+PRIORITY_PAID = 0
+PRIORITY_FREE = 1
+
+priority_classes = [PRIORITY_PAID, PRIORITY_FREE]
+
+
+class Job:
+    def __init__(self, id_task, func, args=(), kwargs=None, user=None, priority=PRIORITY_FREE, finalize=None, batch_key=None, batch_func=None, batch_size=1, checkpoint=None, on_fail=None, remote=False):
+        self.id_task = id_task
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.user = user
+        self.priority = priority
+        self.finalize = finalize
+        self.on_fail = on_fail
+        self.batch_key = batch_key
+        self.batch_func = batch_func
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.remote = remote
+
+        self.status = "queued"
+        self.cancelled = False
+        self.batch = None
+        self.result = None
+        self.error = None
+        self.time_queued = time.time()
+        self.time_started = None
+        self.time_finished = None
+        self.done = threading.Event()
+
+    def dict(self):
+        return {
+            "id_task": self.id_task,
+            "status": self.status,
+            "priority": self.priority,
+            "time_queued": self.time_queued,
+            "time_started": self.time_started,
+            "time_finished": self.time_finished,
+            "error": None if self.error is None else f"{type(self.error).__name__}: {self.error}",
+        }
+
+
+class JobScheduler:
+    """Runs submitted jobs one at a time while holding the generation lock.
+
+    Jobs are taken by priority class first; within a class, users are served round-robin so that one user
+    submitting many jobs does not starve everyone else. Job progress is mirrored into modules.progress so that
+    existing progress endpoints see scheduler jobs as regular tasks.
+
+    Jobs submitted with the same batch_key may be merged: when such a job is started, other queued jobs with that
+    key are taken along (up to api_coalesce_max_batch_size in total batch_size) and run with a single call to
+    batch_func, which receives the list of their args and must return one result per job.
+
+    A job's checkpoint is the sd_model_checkpoint it overrides, if any. Within a priority class, a user whose next job
+    can run on an already resident model may go ahead of one that needs a checkpoint switch, but only until the
+    waiting job has been queued for api_swap_defer_seconds.
+
+    In remote mode (see use_remote_workers) jobs submitted with remote=True only hand the work to device worker
+    processes, so several run at once, without the generation lock and without touching shared.state. Other jobs
+    still run in this process and take the generation lock, one at a time.
+
+    A running job that is cancelled ends as cancelled, not finished: its result is dropped, finalize does not run and
+    on_fail does. Finished jobs are kept for api_jobs_keep_finished_seconds.
+    """
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.condition = threading.Condition()
+        self.queues = {priority: collections.OrderedDict() for priority in priority_classes}
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.running = set()
+        self.workers = []
+        self.concurrency = 1
+        self.remote = False
+        self.finalizers = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="job-finalize")
+
+    def start(self):
+        with self.condition:
+            self.workers = [x for x in self.workers if x.is_alive()]
+            while len(self.workers) < self.concurrency:
+                worker = threading.Thread(target=self.worker_loop, name=f"job-scheduler-{len(self.workers)}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def use_remote_workers(self, concurrency):
+        """switches to remote mode, running up to concurrency jobs at once"""
+
+        with self.condition:
+            self.remote = True
+            self.concurrency = max(concurrency, 1)
+
+        self.start()
+
+    def submit(self, func, args=(), kwargs=None, user=None, priority=PRIORITY_FREE, finalize=None, id_task=None, batch_key=None, batch_func=None, batch_size=1, checkpoint=None, on_fail=None, remote=False):
+        """queues func(*args, **kwargs) and returns the Job immediately; finalize(result), if given, runs after the
+        generation lock is released and its return value becomes the job's result; on_fail(), if given, runs in the
+        background if the job fails or is cancelled; remote tells that func only sends the work to a device worker"""
+
+        if priority not in self.queues:
+            priority = PRIORITY_FREE
+
+        if batch_func is None:
+            batch_key = None
+
+        job = Job(id_task or f"task({uuid.uuid4().hex})", func, args, kwargs, user=user, priority=priority, finalize=finalize, batch_key=batch_key, batch_func=batch_func, batch_size=batch_size, checkpoint=checkpoint, on_fail=on_fail, remote=remote)
+
+        with self.condition:
+            self.jobs[job.id_task] = job
+            self.queues[priority].setdefault(user, collections.deque()).append(job)
+            progress.add_task_to_queue(job.id_task)
+            self.condition.notify()
+
+        self.start()
+        self.notify_prefetcher()
+
+        return job
+
+    def run(self, func, args=(), kwargs=None, user=None, priority=PRIORITY_FREE, batch_key=None, batch_func=None, batch_size=1, checkpoint=None, remote=False):
+        """submits a job and blocks until it finishes, returning its result or re-raising its exception"""
+
+        job = self.submit(func, args, kwargs, user=user, priority=priority, batch_key=batch_key, batch_func=batch_func, batch_size=batch_size, checkpoint=checkpoint, remote=remote)
+
+        return self.wait(job)
+
+    def wait(self, job):
+        job.done.wait()
+
+        if job.error is not None:
+            raise job.error
+
+        if job.status == "cancelled":
+            raise JobCancelled(f"Job {job.id_task} was cancelled")
+
+        return job.result
+
+    def get(self, id_task):
+        with self.condition:
+            self.evict_finished()
+            return self.jobs.get(id_task)
+
+    def cancel(self, id_task):
+        with self.condition:
+            job = self.jobs.get(id_task)
+            if job is None:
+                return False
+
+            if job.status == "running":
+                # once the job has left self.running its result is being finalized and it can not be cancelled
+                if job not in self.running:
+                    return False
+
+                job.cancelled = True
+
+                # jobs merged into one batch share the sampling run, so it is only interrupted when all of them are cancelled
+                if not job.remote and all(x.cancelled for x in job.batch):
+                    shared.state.interrupt()
+
+                return True
+
+            if job.status != "queued":
+                return False
+
+            self.remove_queued(job)
+            progress.pending_tasks.pop(id_task, None)
+            self.mark_finished(job, "cancelled")
+
+        return True
+
+    def remove_queued(self, job):
+        user_queue = self.queues[job.priority].get(job.user)
+        if user_queue is not None and job in user_queue:
+            user_queue.remove(job)
+            if not user_queue:
+                del self.queues[job.priority][job.user]
+
+    def pending_count(self):
+        with self.condition:
+            return sum(len(user_queue) for queues in self.queues.values() for user_queue in queues.values())
+
+    def running_count(self):
+        """returns the number of jobs being run, counting every job of a merged batch"""
+
+        with self.condition:
+            return len(self.running)
+
+    def position(self, id_task):
+        """returns the number of jobs that will run before this one, or None if it is not queued"""
+
+        with self.condition:
+            for index, job in enumerate(self.planned_order()):
+                if job.id_task == id_task:
+                    return index
+
+        return None
+
+    def planned_order(self):
+        order = []
+        for priority in priority_classes:
+            user_queues = [list(user_queue) for user_queue in self.queues[priority].values()]
+            depth = max([len(x) for x in user_queues], default=0)
+            for i in range(depth):
+                order += [user_queue[i] for user_queue in user_queues if i < len(user_queue)]
+
+        return order
+
+    def queued_checkpoints(self):
+        """returns checkpoints requested by queued jobs, in the order the jobs are expected to run"""
+
+        with self.condition:
+            return [job.checkpoint for job in self.planned_order() if job.checkpoint is not None]
+
+    def notify_prefetcher(self):
+        if self.remote:
+            return
+
+        from modules.sd_models_prefetch import prefetcher
+
+        prefetcher.notify()
+
+    def next_job(self):
+        for priority in priority_classes:
+            queues = self.queues[priority]
+            if not queues:
+                continue
+
+            user = self.pick_user(queues)
+            user_queue = queues.pop(user)
+            job = user_queue.popleft()
+            if user_queue:
+                queues[user] = user_queue
+
+            return job
+
+        return None
+
+    def pick_user(self, queues):
+        """returns the user whose turn it is, preferring users whose next job needs the cheapest checkpoint switch"""
+
+        from modules.sd_models_residency import residency
+
+        users = list(queues.keys())
+        first_job = queues[users[0]][0]
+        if self.remote or len(users) == 1 or time.time() - first_job.time_queued >= shared.opts.api_swap_defer_seconds:
+            return users[0]
+
+        return min(users, key=lambda user: residency.swap_cost(queues[user][0].checkpoint))
+
+    def take_batch_companions(self, job):
+        """removes queued jobs that can run in one batch together with job from the queue and returns them"""
+
+        limit = shared.opts.api_coalesce_max_batch_size
+        if self.remote or job.batch_key is None or job.batch_size >= limit:
+            return []
+
+        total = job.batch_size
+        companions = []
+        for other in self.planned_order():
+            if other.batch_key != job.batch_key or total + other.batch_size > limit:
+                continue
+
+            self.remove_queued(other)
+            companions.append(other)
+            total += other.batch_size
+
+        return companions
+
+    def mark_finished(self, job, status):
+        job.status = status
+        job.time_finished = time.time()
+        job.func = job.args = job.kwargs = job.batch_func = job.batch = None
+        job.done.set()
+
+        if status != "finished" and job.on_fail is not None:
+            self.finalizers.submit(job.on_fail)
+        job.on_fail = None
+
+        self.finished.append(job)
+        self.evict_finished()
+
+    def evict_finished(self):
+        cutoff = time.time() - shared.opts.api_jobs_keep_finished_seconds
+        while self.finished and self.finished[0].time_finished < cutoff:
+            self.jobs.pop(self.finished.popleft().id_task, None)
+
+    def finish(self, job, result):
+        try:
+            if job.finalize is not None:
+                result = job.finalize(result)
+            job.result = result
+        except Exception as e:
+            job.error = e
+            print(f"Error finalizing job {job.id_task}", file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+
+        with self.condition:
+            self.mark_finished(job, "finished" if job.error is None else "failed")
+
+    def run_jobs(self, jobs):
+        """calls the function of the first job, or its batch_func for several jobs; sets the jobs' error if that fails"""
+
+        job = jobs[0]
+        results = [None] * len(jobs)
+        for x in jobs:
+            progress.start_task(x.id_task)
+
+        try:
+            if len(jobs) == 1:
+                results = [job.func(*job.args, **job.kwargs)]
+            else:
+                results = job.batch_func([x.args for x in jobs])
+                if len(results) != len(jobs):
+                    raise RuntimeError(f"batch function returned {len(results)} results for {len(jobs)} jobs")
+        except Exception as e:
+            for x in jobs:
+                x.error = e
+            print(f"Error running job {job.id_task}", file=sys.stderr)
+            print(traceback.format_exc(), file=sys.stderr)
+        finally:
+            for x in jobs:
+                progress.finish_task(x.id_task)
+
+        return results
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                while job is None:
+                    self.condition.wait()
+                    job = self.next_job()
+
+                jobs = [job] + self.take_batch_companions(job)
+                for x in jobs:
+                    x.status = "running"
+                    x.time_started = time.time()
+                    x.batch = jobs
+                self.running.update(jobs)
+
+            self.notify_prefetcher()
+
+            if self.remote and all(x.remote for x in jobs):
+                results = self.run_jobs(jobs)
+            else:
+                with self.lock:
+                    shared.state.begin()
+                    try:
+                        results = self.run_jobs(jobs)
+                    finally:
+                        shared.state.end()
+
+            with self.condition:
+                self.running.difference_update(jobs)
+
+            for x, result in zip(jobs, results):
+                if x.cancelled:
+                    x.error = None
+                    with self.condition:
+                        self.mark_finished(x, "cancelled")
+                elif x.error is not None:
+                    with self.condition:
+                        self.mark_finished(x, "failed")
+                elif x.finalize is not None:
+                    self.finalizers.submit(self.finish, x, result)
+                else:
+                    self.finish(x, result)
+
+
+scheduler = None
+
+
+def get_scheduler():
+    global scheduler
+
+    if scheduler is None:
+        from modules.call_queue import queue_lock
+        scheduler = JobScheduler(queue_lock)
+
+    return scheduler
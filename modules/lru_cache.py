@@ -0,0 +1,131 @@
+import collections
+import threading
+
+# all caches by name, for reporting their stats
+caches = {}
+
+
+class LruCache:
+    """Thread-safe least-recently-used mapping bounded by the total size of its values.
+
+    size_of(value) gives the size of a single value in the same units as max_size; by default every value counts
+    as 1, so max_size is a limit on the number of items. max_size can be a callable so that the limit can follow
+    a setting that changes at runtime. on_evict(key, value), if given, is called for every value pushed out of the
+    cache to make room for new ones.
+    """
+
+    def __init__(self, name, max_size, size_of=None, on_evict=None):
+        self.name = name
+        self.max_size = max_size
+        self.size_of = size_of or (lambda value: 1)
+        self.on_evict = on_evict
+        self.lock = threading.RLock()
+        self.data = collections.OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.load_time = 0.0
+
+        caches[name] = self
+
+    def limit(self):
+        return self.max_size() if callable(self.max_size) else self.max_size
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+
+            self.misses += 1
+            return default
+
+    def record_load(self, seconds):
+        """counts the time it took to produce a value that was not in the cache, for the stats"""
+
+        with self.lock:
+            self.loads += 1
+            self.load_time += seconds
+
+    def put(self, key, value):
+        """adds value to the cache and returns True, or returns False if the value alone is larger than the limit"""
+
+        size = self.size_of(value)
+
+        with self.lock:
+            self.pop(key)
+
+            limit = self.limit()
+            if size > limit:
+                return False
+
+            self.data[key] = value
+            self.sizes[key] = size
+            self.size += size
+
+            self.shrink(limit)
+
+        return True
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+
+            self.size -= self.sizes.pop(key)
+            return self.data.pop(key)
+
+    def shrink(self, limit=None):
+        with self.lock:
+            limit = self.limit() if limit is None else limit
+
+            while self.size > limit and self.data:
+                key, value = self.data.popitem(last=False)
+                self.size -= self.sizes.pop(key)
+                self.evictions += 1
+
+                if self.on_evict is not None:
+                    self.on_evict(key, value)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def keys(self):
+        with self.lock:
+            return list(self.data.keys())
+
+    def items(self):
+        """returns (key, value) pairs without counting them as hits or changing their order"""
+
+        with self.lock:
+            return list(self.data.items())
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+
+            return {
+                "name": self.name,
+                "items": len(self.data),
+                "size": self.size,
+                "max_size": self.limit(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests > 0 else 0.0,
+                "evictions": self.evictions,
+                "loads": self.loads,
+                "load_time": self.load_time,
+            }
@@ -1,26 +1,19 @@
 import os
+import queue
+import threading
 
 from PIL import Image
 
-from modules import shared, images, devices, scripts, scripts_postprocessing, ui_common, generation_parameters_copypaste
+from modules import shared, images, devices, scripts, scripts_postprocessing, ui_common, generation_parameters_copypaste, processing_pipeline
 from modules.shared import opts
 
 
-def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output: bool = True):
-    devices.torch_gc()
-
-    shared.state.begin()
-    shared.state.job = 'extras'
-
-    image_data = []
-    image_names = []
-    outputs = []
+def load_images(extras_mode, image, image_folder, input_dir):
+    """yields (image, name) for every image to work on; files are only opened when their turn comes"""
 
     if extras_mode == 1:
         for img in image_folder:
-            image = Image.open(img)
-            image_data.append(image)
-            image_names.append(os.path.splitext(img.orig_name)[0])
+            yield Image.open(img), os.path.splitext(img.orig_name)[0]
     elif extras_mode == 2:
         assert not shared.cmd_opts.hide_ui_dir_config, '--hide-ui-dir-config option must be disabled'
         assert input_dir, 'input directory not selected'
@@ -31,29 +24,71 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
                 image = Image.open(filename)
             except Exception:
                 continue
-            image_data.append(image)
-            image_names.append(filename)
+            yield image, filename
     else:
         assert image, 'image not selected'
 
-        image_data.append(image)
-        image_names.append(None)
+        yield image, None
 
-    if extras_mode == 2 and output_dir != '':
-        outpath = output_dir
-    else:
-        outpath = opts.outdir_samples or opts.outdir_extras_samples
 
-    infotext = ''
+def prefetch(items, count):
+    """iterates over (image, name) pairs from items in a background thread, keeping at most count of them decoded
+    ahead of the caller; errors raised by items are re-raised to the caller"""
 
-    for image, name in zip(image_data, image_names):
-        shared.state.textinfo = name
+    if count <= 0:
+        yield from items
+        return
 
-        existing_pnginfo = image.info or {}
+    ready = queue.Queue(maxsize=count)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def read():
+        try:
+            for image, name in items:
+                image.load()
+                if not put((image, name)):
+                    return
+        except Exception as e:
+            put(e)
+            return
 
-        pp = scripts_postprocessing.PostprocessedImage(image.convert("RGB"))
+        put(finished)
 
-        scripts.scripts_postproc.run(pp, args)
+    threading.Thread(target=read, daemon=True, name="postprocessing-prefetch").start()
+
+    try:
+        while True:
+            item = ready.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+
+            yield item
+    finally:
+        stop.set()
+
+
+def process_batch(batch, args, outpath, save_output, pipeline):
+    shared.state.textinfo = batch[0][1]
+
+    pps = [scripts_postprocessing.PostprocessedImage(image.convert("RGB")) for image, name in batch]
+
+    scripts.scripts_postproc.run_batch(pps, args)
+
+    for (image, name), pp in zip(batch, pps):
+        existing_pnginfo = image.info or {}
 
         if opts.use_original_name_batch and name is not None:
             basename = os.path.splitext(os.path.basename(name))[0]
@@ -67,20 +102,83 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
             pp.image.info["postprocessing"] = infotext
 
         if save_output:
-            images.save_image(pp.image, path=outpath, basename=basename, seed=None, prompt=None, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=None)
+            pipeline.save(images.save_image, pp.image, path=outpath, basename=basename, seed=None, prompt=None, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=None)
+
+        yield pp.image, infotext
+
+
+def postprocess_images(items, args, outpath=None, save_output=True):
+    """runs postprocessing scripts over (image, name) pairs from items and yields (image, infotext) for each image as
+    soon as its batch is done.
+
+    Images are read postprocessing_prefetch ahead in a background thread and worked on postprocessing_batch_size at a
+    time, so only that many are held in memory besides what the caller keeps. Saving happens on the image saving
+    thread of processing_pipeline while the next batch is processed.
+    """
+
+    pipeline = processing_pipeline.ImagePipeline()
+    batch_size = max(opts.postprocessing_batch_size, 1)
+
+    batch = []
+    for item in prefetch(items, opts.postprocessing_prefetch):
+        batch.append(item)
+
+        if len(batch) >= batch_size:
+            yield from process_batch(batch, args, outpath, save_output, pipeline)
+            batch = []
+
+        if shared.state.interrupted:
+            break
+
+    if batch:
+        yield from process_batch(batch, args, outpath, save_output, pipeline)
 
+    pipeline.results()
+
+
+def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output: bool = True):
+    devices.torch_gc()
+
+    shared.state.begin()
+    shared.state.job = 'extras'
+
+    outputs = []
+
+    if extras_mode == 2 and output_dir != '':
+        outpath = output_dir
+    else:
+        outpath = opts.outdir_samples or opts.outdir_extras_samples
+
+    infotext = ''
+
+    for processed, infotext in postprocess_images(load_images(extras_mode, image, image_folder, input_dir), args, outpath, save_output):
         if extras_mode != 2 or show_extras_results:
-            outputs.append(pp.image)
+            outputs.append(processed)
 
     devices.torch_gc()
 
     return outputs, ui_common.plaintext_to_html(infotext), ''
 
 
-def run_extras(extras_mode, resize_mode, image, image_folder, input_dir, output_dir, show_extras_results, gfpgan_visibility, codeformer_visibility, codeformer_weight, upscaling_resize, upscaling_resize_w, upscaling_resize_h, upscaling_crop, extras_upscaler_1, extras_upscaler_2, extras_upscaler_2_visibility, upscale_first: bool, save_output: bool = True):
-    """old handler for API"""
+def run_postprocessing_stream(items, args):
+    """run_postprocessing() for (image, name) pairs from any iterable, without saving; yields (image, infotext) for
+    each image as soon as it is done"""
 
-    args = scripts.scripts_postproc.create_args_for_run({
+    devices.torch_gc()
+
+    shared.state.begin()
+    shared.state.job = 'extras'
+
+    yield from postprocess_images(items, args, save_output=False)
+
+    devices.torch_gc()
+
+
+def create_extras_args(resize_mode, gfpgan_visibility, codeformer_visibility, codeformer_weight, upscaling_resize, upscaling_resize_w, upscaling_resize_h, upscaling_crop, extras_upscaler_1, extras_upscaler_2, extras_upscaler_2_visibility, **kwargs):
+    """script arguments for run_postprocessing() from the parameters of the old API; other keyword arguments are
+    ignored"""
+
+    return scripts.scripts_postproc.create_args_for_run({
         "Upscale": {
             "upscale_mode": resize_mode,
             "upscale_by": upscaling_resize,
@@ -100,4 +198,10 @@ def run_extras(extras_mode, resize_mode, image, image_folder, input_dir, output_
         },
     })
 
+
+def run_extras(extras_mode, resize_mode, image, image_folder, input_dir, output_dir, show_extras_results, gfpgan_visibility, codeformer_visibility, codeformer_weight, upscaling_resize, upscaling_resize_w, upscaling_resize_h, upscaling_crop, extras_upscaler_1, extras_upscaler_2, extras_upscaler_2_visibility, upscale_first: bool, save_output: bool = True):
+    """old handler for API"""
+
+    args = create_extras_args(resize_mode, gfpgan_visibility, codeformer_visibility, codeformer_weight, upscaling_resize, upscaling_resize_w, upscaling_resize_h, upscaling_crop, extras_upscaler_1, extras_upscaler_2, extras_upscaler_2_visibility)
+
     return run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output=save_output)
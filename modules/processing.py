@@ -1,3 +1,4 @@
+import copy
 import json
 import math
 import os
@@ -23,6 +24,8 @@ import modules.images as images
 import modules.styles
 import modules.sd_models as sd_models
 import modules.sd_vae as sd_vae
+import modules.processing_pipeline as processing_pipeline
+import modules.sd_vae_decode as sd_vae_decode
 import logging
 from ldm.data.util import AddMiDaS
 from ldm.models.diffusion.ddpm import LatentDepth2ImageDiffusion
@@ -77,6 +80,36 @@ def apply_overlay(image, paste_loc, index, overlays):
     return image
 
 
+def finish_image(p, image, index, color_correction, text, save_before_color_correction):
+    """the CPU-bound part of making an output image, run by the image pipeline: color correction, overlay, infotext and
+    the encodings requested in p.image_encoders; returns (image, encoded, image before color correction)"""
+
+    image_without_cc = None
+    if color_correction is not None:
+        if save_before_color_correction:
+            image_without_cc = apply_overlay(image, p.paste_to, index, p.overlay_images)
+        image = apply_color_correction(color_correction, image)
+
+    image = apply_overlay(image, p.paste_to, index, p.overlay_images)
+
+    if opts.enable_pnginfo:
+        image.info["parameters"] = text
+
+    encoded = [encode(image) for encode in p.image_encoders] if p.image_encoders else None
+
+    return image, encoded, image_without_cc
+
+
+def save_finished_image(p, finished, seed, prompt, text):
+    image, _, image_without_cc = finished.result()
+
+    if image_without_cc is not None:
+        images.save_image(image_without_cc, p.outpath_samples, "", seed, prompt, opts.samples_format, info=text, p=p, suffix="-before-color-correction")
+
+    if opts.samples_save and not p.do_not_save_samples:
+        images.save_image(image, p.outpath_samples, "", seed, prompt, opts.samples_format, info=text, p=p)
+
+
 def txt2img_image_conditioning(sd_model, x, width, height):
     if sd_model.model.conditioning_key not in {'hybrid', 'concat'}:
         # Dummy zero conditioning if we're not using inpainting model.
@@ -99,7 +132,7 @@ class StableDiffusionProcessing:
     """
     The first set of paramaters: sd_models -> do_not_reload_embeddings represent the minimum required to create a StableDiffusionProcessing
     """
-    def __init__(self, sd_model=None, outpath_samples=None, outpath_grids=None, prompt: str = "", styles: List[str] = None, seed: int = -1, subseed: int = -1, subseed_strength: float = 0, seed_resize_from_h: int = -1, seed_resize_from_w: int = -1, seed_enable_extras: bool = True, sampler_name: str = None, batch_size: int = 1, n_iter: int = 1, steps: int = 50, cfg_scale: float = 7.0, width: int = 512, height: int = 512, restore_faces: bool = False, tiling: bool = False, do_not_save_samples: bool = False, do_not_save_grid: bool = False, extra_generation_params: Dict[Any, Any] = None, overlay_images: Any = None, negative_prompt: str = None, eta: float = None, do_not_reload_embeddings: bool = False, denoising_strength: float = 0, ddim_discretize: str = None, s_churn: float = 0.0, s_tmax: float = None, s_tmin: float = 0.0, s_noise: float = 1.0, override_settings: Dict[str, Any] = None, override_settings_restore_afterwards: bool = True, sampler_index: int = None, script_args: list = None, preset: int = 0):
+    def __init__(self, sd_model=None, outpath_samples=None, outpath_grids=None, prompt: str = "", styles: List[str] = None, seed: int = -1, subseed: int = -1, subseed_strength: float = 0, seed_resize_from_h: int = -1, seed_resize_from_w: int = -1, seed_enable_extras: bool = True, sampler_name: str = None, batch_size: int = 1, n_iter: int = 1, steps: int = 50, cfg_scale: float = 7.0, width: int = 512, height: int = 512, restore_faces: bool = False, tiling: bool = False, do_not_save_samples: bool = False, do_not_save_grid: bool = False, extra_generation_params: Dict[Any, Any] = None, overlay_images: Any = None, negative_prompt: str = None, eta: float = None, do_not_reload_embeddings: bool = False, denoising_strength: float = 0, ddim_discretize: str = None, s_churn: float = 0.0, s_tmax: float = None, s_tmin: float = 0.0, s_noise: float = 1.0, override_settings: Dict[str, Any] = None, override_settings_restore_afterwards: bool = True, sampler_index: int = None, script_args: list = None, preset: int = 0, vae_decode: str = "full"):
         if sampler_index is not None:
             print("sampler_index argument for StableDiffusionProcessing does not do anything; use sampler_name", file=sys.stderr)
 
@@ -142,6 +175,8 @@ class StableDiffusionProcessing:
         self.override_settings_restore_afterwards = override_settings_restore_afterwards
         self.is_using_inpainting_conditioning = False
         self.disable_extra_networks = False
+        self.vae_decode = vae_decode
+        self.image_encoders = None  # functions of an output image whose results go to Processed.encoded_images
 
         if not seed_enable_extras:
             self.subseed = -1
@@ -255,7 +290,7 @@ class StableDiffusionProcessing:
 
 
 class Processed:
-    def __init__(self, p: StableDiffusionProcessing, images_list, seed=-1, info="", subseed=None, all_prompts=None, all_negative_prompts=None, all_seeds=None, all_subseeds=None, index_of_first_image=0, infotexts=None, comments=""):
+    def __init__(self, p: StableDiffusionProcessing, images_list, seed=-1, info="", subseed=None, all_prompts=None, all_negative_prompts=None, all_seeds=None, all_subseeds=None, index_of_first_image=0, infotexts=None, comments="", encoded_images=None):
         self.images = images_list
         self.prompt = p.prompt
         self.negative_prompt = p.negative_prompt
@@ -302,6 +337,9 @@ class Processed:
         self.all_subseeds = all_subseeds or p.all_subseeds or [self.subseed]
         self.infotexts = infotexts or [info]
 
+        # id(image) -> (image, [encoder(image) for encoder in p.image_encoders]), made while the images were finished
+        self.encoded_images = encoded_images or {}
+
     def js(self):
         obj = {
             "prompt": self.all_prompts[0],
@@ -537,6 +575,10 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     else:
         p.all_subseeds = [int(subseed) + x for x in range(len(p.all_prompts))]
 
+    assert p.vae_decode in sd_vae_decode.decode_modes, f"unknown VAE decode mode: {p.vae_decode}; use one of {', '.join(sd_vae_decode.decode_modes)}"
+    if p.vae_decode != "full":
+        p.extra_generation_params["VAE decode"] = p.vae_decode
+
     def infotext(iteration=0, position_in_batch=0):
         return create_infotext(p, p.all_prompts, p.all_seeds, p.all_subseeds, comments, iteration, position_in_batch)
 
@@ -550,6 +592,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
     infotexts = []
     output_images = []
+    encoded_images = {}
+    pipeline = processing_pipeline.ImagePipeline()
 
     cached_uc = [None, None]
     cached_c = [None, None]
@@ -574,146 +618,244 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         cache[0] = (required_prompts, steps)
         return cache[1]
 
-    with torch.no_grad(), p.sd_model.ema_scope():
-        with devices.autocast():
-            p.init(p.all_prompts, p.all_seeds, p.all_subseeds)
+    try:
+        with torch.no_grad(), p.sd_model.ema_scope():
+            with devices.autocast():
+                p.init(p.all_prompts, p.all_seeds, p.all_subseeds)
 
-            # for OSX, loading the model during sampling changes the generated picture, so it is loaded here
-            if shared.opts.live_previews_enable and opts.show_progress_type == "Approx NN":
-                sd_vae_approx.model()
+                # for OSX, loading the model during sampling changes the generated picture, so it is loaded here
+                if (shared.opts.live_previews_enable and opts.show_progress_type == "Approx NN") or p.vae_decode == "approx":
+                    sd_vae_approx.model()
 
-            if not p.disable_extra_networks:
-                extra_networks.activate(p, extra_network_data)
+                if not p.disable_extra_networks:
+                    extra_networks.activate(p, extra_network_data)
 
-        with open(os.path.join(paths.data_path, "params.txt"), "w", encoding="utf8") as file:
-            processed = Processed(p, [], p.seed, "")
-            file.write(processed.infotext(p, 0))
+            with open(os.path.join(paths.data_path, "params.txt"), "w", encoding="utf8") as file:
+                processed = Processed(p, [], p.seed, "")
+                file.write(processed.infotext(p, 0))
 
-        if state.job_count == -1:
-            state.job_count = p.n_iter
+            if state.job_count == -1:
+                state.job_count = p.n_iter
 
-        for n in range(p.n_iter):
-            p.iteration = n
+            for n in range(p.n_iter):
+                p.iteration = n
 
-            if state.skipped:
-                state.skipped = False
+                if state.skipped:
+                    state.skipped = False
 
-            if state.interrupted:
-                break
+                if state.interrupted:
+                    break
 
-            prompts = p.all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
-            negative_prompts = p.all_negative_prompts[n * p.batch_size:(n + 1) * p.batch_size]
-            seeds = p.all_seeds[n * p.batch_size:(n + 1) * p.batch_size]
-            subseeds = p.all_subseeds[n * p.batch_size:(n + 1) * p.batch_size]
+                prompts = p.all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
+                negative_prompts = p.all_negative_prompts[n * p.batch_size:(n + 1) * p.batch_size]
+                seeds = p.all_seeds[n * p.batch_size:(n + 1) * p.batch_size]
+                subseeds = p.all_subseeds[n * p.batch_size:(n + 1) * p.batch_size]
 
-            if len(prompts) == 0:
-                break
+                if len(prompts) == 0:
+                    break
 
-            prompts, _ = extra_networks.parse_prompts(prompts)
+                prompts, _ = extra_networks.parse_prompts(prompts)
 
-            if p.scripts is not None:
-                p.scripts.process_batch(p, batch_number=n, prompts=prompts, seeds=seeds, subseeds=subseeds)
+                if p.scripts is not None:
+                    p.scripts.process_batch(p, batch_number=n, prompts=prompts, seeds=seeds, subseeds=subseeds)
 
-            uc = get_conds_with_caching(prompt_parser.get_learned_conditioning, negative_prompts, p.steps, cached_uc)
-            c = get_conds_with_caching(prompt_parser.get_multicond_learned_conditioning, prompts, p.steps, cached_c)
+                uc = get_conds_with_caching(prompt_parser.get_learned_conditioning, negative_prompts, p.steps, cached_uc)
+                c = get_conds_with_caching(prompt_parser.get_multicond_learned_conditioning, prompts, p.steps, cached_c)
 
-            if len(model_hijack.comments) > 0:
-                for comment in model_hijack.comments:
-                    comments[comment] = 1
+                if len(model_hijack.comments) > 0:
+                    for comment in model_hijack.comments:
+                        comments[comment] = 1
 
-            if p.n_iter > 1:
-                shared.state.job = f"Batch {n+1} out of {p.n_iter}"
+                if p.n_iter > 1:
+                    shared.state.job = f"Batch {n+1} out of {p.n_iter}"
 
-            with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
-                samples_ddim = p.sample(conditioning=c, unconditional_conditioning=uc, seeds=seeds, subseeds=subseeds, subseed_strength=p.subseed_strength, prompts=prompts)
+                with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
+                    samples_ddim = p.sample(conditioning=c, unconditional_conditioning=uc, seeds=seeds, subseeds=subseeds, subseed_strength=p.subseed_strength, prompts=prompts)
 
-            x_samples_ddim = [decode_first_stage(p.sd_model, samples_ddim[i:i+1].to(dtype=devices.dtype_vae))[0].cpu() for i in range(samples_ddim.size(0))]
-            for x in x_samples_ddim:
-                devices.test_for_nans(x, "vae")
+                x_samples_ddim = sd_vae_decode.decode(p.sd_model, samples_ddim, p.vae_decode)
+                for x in x_samples_ddim:
+                    devices.test_for_nans(x, "vae")
 
-            x_samples_ddim = torch.stack(x_samples_ddim).float()
-            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+                x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
 
-            del samples_ddim
+                del samples_ddim
 
-            if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
-                lowvram.send_everything_to_cpu()
+                if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
+                    lowvram.send_everything_to_cpu()
 
-            devices.torch_gc()
+                devices.torch_gc()
 
-            if p.scripts is not None:
-                p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
+                if p.scripts is not None:
+                    p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
 
-            for i, x_sample in enumerate(x_samples_ddim):
-                x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
-                x_sample = x_sample.astype(np.uint8)
+                for i, x_sample in enumerate(x_samples_ddim):
+                    x_sample = 255. * np.moveaxis(x_sample.cpu().numpy(), 0, 2)
+                    x_sample = x_sample.astype(np.uint8)
 
-                if p.restore_faces:
-                    if opts.save and not p.do_not_save_samples and opts.save_images_before_face_restoration:
-                        images.save_image(Image.fromarray(x_sample), p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-face-restoration")
+                    if p.restore_faces:
+                        if opts.save and not p.do_not_save_samples and opts.save_images_before_face_restoration:
+                            pipeline.save(images.save_image, Image.fromarray(x_sample), p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-face-restoration")
 
-                    devices.torch_gc()
+                        devices.torch_gc()
 
-                    x_sample = modules.face_restoration.restore_faces(x_sample)
-                    devices.torch_gc()
+                        x_sample = modules.face_restoration.restore_faces(x_sample)
+                        devices.torch_gc()
 
-                image = Image.fromarray(x_sample)
+                    image = Image.fromarray(x_sample)
 
-                if p.scripts is not None:
-                    pp = scripts.PostprocessImageArgs(image)
-                    p.scripts.postprocess_image(p, pp)
-                    image = pp.image
+                    if p.scripts is not None:
+                        pp = scripts.PostprocessImageArgs(image)
+                        p.scripts.postprocess_image(p, pp)
+                        image = pp.image
+
+                    # the rest is CPU work; it runs in the image pipeline while the next batch is being sampled
+                    color_correction = p.color_corrections[i] if p.color_corrections is not None and i < len(p.color_corrections) else None
+                    save_before_color_correction = opts.save and not p.do_not_save_samples and opts.save_images_before_color_correction
 
-                if p.color_corrections is not None and i < len(p.color_corrections):
-                    if opts.save and not p.do_not_save_samples and opts.save_images_before_color_correction:
-                        image_without_cc = apply_overlay(image, p.paste_to, i, p.overlay_images)
-                        images.save_image(image_without_cc, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p, suffix="-before-color-correction")
-                    image = apply_color_correction(p.color_corrections[i], image)
+                    text = infotext(n, i)
+                    infotexts.append(text)
+                    finished = pipeline.finish(finish_image, p, image, i, color_correction, text, save_before_color_correction)
+                    pipeline.save(save_finished_image, p, finished, seeds[i], prompts[i], text)
 
-                image = apply_overlay(image, p.paste_to, i, p.overlay_images)
+                del x_samples_ddim
 
-                if opts.samples_save and not p.do_not_save_samples:
-                    images.save_image(image, p.outpath_samples, "", seeds[i], prompts[i], opts.samples_format, info=infotext(n, i), p=p)
+                devices.torch_gc()
 
-                text = infotext(n, i)
-                infotexts.append(text)
-                if opts.enable_pnginfo:
-                    image.info["parameters"] = text
+                state.nextjob()
+
+            p.color_corrections = None
+
+            for image, encoded, _ in pipeline.results():
                 output_images.append(image)
+                if encoded is not None:
+                    encoded_images[id(image)] = (image, encoded)
+
+            index_of_first_image = 0
+            unwanted_grid_because_of_img_count = len(output_images) < 2 and opts.grid_only_if_multiple
+            if (opts.return_grid or opts.grid_save) and not p.do_not_save_grid and not unwanted_grid_because_of_img_count:
+                grid = images.image_grid(output_images, p.batch_size)
+
+                if opts.return_grid:
+                    text = infotext()
+                    infotexts.insert(0, text)
+                    if opts.enable_pnginfo:
+                        grid.info["parameters"] = text
+                    output_images.insert(0, grid)
+                    index_of_first_image = 1
+
+                if opts.grid_save:
+                    images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(), short_filename=not opts.grid_extended_filename, p=p, grid=True)
+    finally:
+        # also after an error, so that nothing an extra network did to the model (such as merged Lora weights) outlives the generation
+        if not p.disable_extra_networks:
+            extra_networks.deactivate(p, extra_network_data)
 
-            del x_samples_ddim
+    devices.torch_gc()
 
-            devices.torch_gc()
+    res = Processed(p, output_images, p.all_seeds[0], infotext(), comments="".join(["\n\n" + x for x in comments]), subseed=p.all_subseeds[0], index_of_first_image=index_of_first_image, infotexts=infotexts, encoded_images=encoded_images)
 
-            state.nextjob()
+    if p.scripts is not None:
+        p.scripts.postprocess(p, res)
 
-        p.color_corrections = None
+    return res
 
-        index_of_first_image = 0
-        unwanted_grid_because_of_img_count = len(output_images) < 2 and opts.grid_only_if_multiple
-        if (opts.return_grid or opts.grid_save) and not p.do_not_save_grid and not unwanted_grid_because_of_img_count:
-            grid = images.image_grid(output_images, p.batch_size)
 
-            if opts.return_grid:
-                text = infotext()
-                infotexts.insert(0, text)
-                if opts.enable_pnginfo:
-                    grid.info["parameters"] = text
-                output_images.insert(0, grid)
-                index_of_first_image = 1
+coalesce_ignored_fields = {"prompt", "negative_prompt", "seed", "subseed", "batch_size", "script_args", "prompt_for_display", "all_prompts", "all_negative_prompts", "all_seeds", "all_subseeds", "iteration", "image_encoders"}
 
-            if opts.grid_save:
-                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(), short_filename=not opts.grid_extended_filename, p=p, grid=True)
+# fields holding objects that are compared by identity; a repr of the whole model would be huge
+coalesce_identity_fields = {"sd_model", "scripts"}
 
-    if not p.disable_extra_networks:
-        extra_networks.deactivate(p, extra_network_data)
 
-    devices.torch_gc()
+def coalesce_key(p: StableDiffusionProcessing, allow_scripts=False):
+    """returns a key such that processing objects with equal keys can be sampled together by process_images_batched,
+    or None if p can not be merged with others; allow_scripts lets through objects with scripts, for callers whose
+    objects all come from one script run and so share its arguments"""
 
-    res = Processed(p, output_images, p.all_seeds[0], infotext(), comments="".join(["\n\n" + x for x in comments]), subseed=p.all_subseeds[0], index_of_first_image=index_of_first_image, infotexts=infotexts)
+    if type(p) != StableDiffusionProcessingTxt2Img or p.n_iter != 1 or (p.scripts is not None and not allow_scripts):
+        return None
 
-    if p.scripts is not None:
-        p.scripts.postprocess(p, res)
+    if any(type(x) == list for x in [p.prompt, p.negative_prompt, p.seed, p.subseed]):
+        return None
+
+    # only the extra networks from the first prompt of a batch get activated, so they must match exactly
+    _, extra_network_data = extra_networks.parse_prompts([p.prompt])
+    networks = sorted((name, [params.items for params in params_list]) for name, params_list in extra_network_data.items())
+
+    fields = sorted((k, id(v) if k in coalesce_identity_fields else v) for k, v in vars(p).items() if k not in coalesce_ignored_fields)
+
+    return repr((fields, networks))
+
+
+def process_images_batched(ps: List[StableDiffusionProcessing]) -> List[Processed]:
+    """samples several processing objects with equal coalesce_key() as one batch, and splits the result back into
+    one Processed per object, with the same seeds, prompts and infotexts as if each was processed on its own"""
+
+    if len(ps) == 1:
+        return [process_images(ps[0])]
+
+    batch = copy.copy(ps[0])
+    batch.extra_generation_params = dict(ps[0].extra_generation_params)
+    batch.prompt, batch.negative_prompt, batch.seed, batch.subseed = [], [], [], []
+
+    for p in ps:
+        fix_seed(p)
+
+        batch.prompt += [p.prompt] * p.batch_size
+        batch.negative_prompt += [p.negative_prompt] * p.batch_size
+        batch.seed += [int(p.seed) + (x if p.subseed_strength == 0 else 0) for x in range(p.batch_size)]
+        batch.subseed += [int(p.subseed) + x for x in range(p.batch_size)]
+
+    batch.batch_size = len(batch.prompt)
+
+    processed = process_images(batch)
+
+    res = []
+    offset = 0
+    for p in ps:
+        start, end = offset, offset + p.batch_size
+        first_image = processed.index_of_first_image + start
+        offset = end
+
+        p.all_prompts = batch.all_prompts[start:end]
+        p.all_negative_prompts = batch.all_negative_prompts[start:end]
+        p.all_seeds = batch.all_seeds[start:end]
+        p.all_subseeds = batch.all_subseeds[start:end]
+
+        # the infotexts of the merged run count positions in the merged batch; these are made as for p on its own,
+        # from a copy of the batch so that parameters added while processing are kept
+        own = copy.copy(batch)
+        own.prompt, own.negative_prompt, own.seed, own.subseed, own.batch_size = p.prompt, p.negative_prompt, p.seed, p.subseed, p.batch_size
+        own.all_prompts, own.all_negative_prompts, own.all_seeds, own.all_subseeds = p.all_prompts, p.all_negative_prompts, p.all_seeds, p.all_subseeds
+
+        part = copy.copy(processed)
+        part.images = processed.images[first_image:first_image + p.batch_size]
+        part.infotexts = [create_infotext(own, own.all_prompts, own.all_seeds, own.all_subseeds, position_in_batch=i) for i in range(len(part.images))]
+        part.info = part.infotexts[0] if part.infotexts else processed.info
+
+        # encodings made while the merged batch was finished embed its infotext, so images whose text changed are
+        # encoded again
+        part.encoded_images = {}
+        for image, text in zip(part.images, part.infotexts):
+            encoded = processed.encoded_images.get(id(image))
+            if opts.enable_pnginfo and image.info.get("parameters") != text:
+                image.info["parameters"] = text
+                encoded = None
+
+            if encoded is not None and encoded[0] is image:
+                part.encoded_images[id(image)] = encoded
+            elif p.image_encoders:
+                part.encoded_images[id(image)] = (image, [encode(image) for encode in p.image_encoders])
+        part.index_of_first_image = 0
+        part.batch_size = p.batch_size
+        part.prompt = p.prompt
+        part.negative_prompt = p.negative_prompt
+        part.seed = int(p.seed)
+        part.subseed = int(p.subseed)
+        part.all_prompts = p.all_prompts
+        part.all_negative_prompts = p.all_negative_prompts
+        part.all_seeds = p.all_seeds
+        part.all_subseeds = p.all_subseeds
+        res.append(part)
 
     return res
 
@@ -858,7 +1000,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
             else:
                 image_conditioning = self.txt2img_image_conditioning(samples)
         else:
-            decoded_samples = decode_first_stage(self.sd_model, samples)
+            decoded_samples = sd_vae_decode.decode(self.sd_model, samples)
             lowres_samples = torch.clamp((decoded_samples + 1.0) / 2.0, min=0.0, max=1.0)
 
             batch_images = []
@@ -0,0 +1,70 @@
+import concurrent.futures
+import threading
+
+from modules import shared
+
+lock = threading.Lock()
+finishers = None
+saver = None
+
+
+def get_executors():
+    """returns the pool that finishes images and the single thread that writes them to disk in the order they were
+    submitted, so that file sequence numbers stay in generation order"""
+
+    global finishers, saver
+
+    with lock:
+        if finishers is None:
+            finishers = concurrent.futures.ThreadPoolExecutor(max_workers=max(shared.opts.processing_pipeline_threads, 1), thread_name_prefix="image-finish")
+            saver = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-save")
+
+    return finishers, saver
+
+
+def run_inline(func, *args, **kwargs):
+    future = concurrent.futures.Future()
+
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+
+    return future
+
+
+class ImagePipeline:
+    """Finishes and saves the images of a batch in background threads while the sampling thread goes on with the next
+    batch.
+
+    Results of finish() are returned by results() in the order finish() was called, whichever thread gets done first,
+    so images stay paired with their infotexts. Saves run one at a time in the order save() was called. With
+    processing_pipeline_threads set to 0 everything runs right away on the calling thread.
+    """
+
+    def __init__(self):
+        self.enabled = shared.opts.processing_pipeline_threads > 0
+        self.finished = []
+        self.saved = []
+
+    def finish(self, func, *args, **kwargs):
+        future = get_executors()[0].submit(func, *args, **kwargs) if self.enabled else run_inline(func, *args, **kwargs)
+        self.finished.append(future)
+
+        return future
+
+    def save(self, func, *args, **kwargs):
+        future = get_executors()[1].submit(func, *args, **kwargs) if self.enabled else run_inline(func, *args, **kwargs)
+        self.saved.append(future)
+
+        return future
+
+    def results(self):
+        """waits for everything submitted and returns the results of finish() calls; re-raises the first error"""
+
+        concurrent.futures.wait(self.finished + self.saved)
+
+        for future in self.saved:
+            future.result()
+
+        return [future.result() for future in self.finished]
@@ -0,0 +1,200 @@
+import asyncio
+import base64
+import io
+import json
+import threading
+import time
+
+from modules import shared, progress, job_queue
+
+FINISHED_STATUSES = ("finished", "failed", "cancelled")
+
+
+class Subscriber:
+    """One client listening to the progress of a task. Only the latest message of each kind is kept, so a slow
+    client skips intermediate updates instead of making them pile up."""
+
+    def __init__(self, id_task, loop):
+        self.id_task = id_task
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.messages = {}
+        self.lock = threading.Lock()
+
+    def send(self, kind, data):
+        with self.lock:
+            self.messages[kind] = data
+
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def receive(self, timeout):
+        """waits for new messages and returns them as a list of (kind, data); returns an empty list on timeout"""
+
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        self.event.clear()
+        with self.lock:
+            messages = list(self.messages.items())
+            self.messages.clear()
+
+        return messages
+
+
+class ProgressBroadcaster:
+    """Pushes task progress and live previews to subscribed clients.
+
+    A single thread looks at shared.state every progress_stream_interval_ms while anyone is subscribed, builds one
+    progress message per watched task and hands it to every subscriber of that task. The live preview is decoded and
+    encoded at most once every progress_stream_preview_interval_ms, and only when it has changed, no matter how many
+    clients are watching; it is sent as a separate message so that progress updates stay small.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.worker = None
+        self.last_messages = {}
+        self.preview_time = 0
+        self.preview_source = None
+        self.preview_id = -1
+        self.preview_task = None
+        self.preview = None
+
+    def subscribe(self, id_task):
+        subscriber = Subscriber(id_task, asyncio.get_running_loop())
+
+        with self.lock:
+            self.subscribers.setdefault(id_task, []).append(subscriber)
+
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.worker_loop, name="progress-stream", daemon=True)
+                self.worker.start()
+
+        # a new client gets the current state right away, without waiting for it to change
+        message = self.last_messages.get(id_task)
+        if message is not None:
+            subscriber.send("progress", message)
+        if self.preview is not None and id_task == progress.current_task == self.preview_task:
+            subscriber.send("preview", self.preview)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.id_task, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self.subscribers.pop(subscriber.id_task, None)
+
+    def worker_loop(self):
+        while True:
+            time.sleep(max(shared.opts.progress_stream_interval_ms, 50) / 1000)
+
+            with self.lock:
+                watched = {id_task: list(subscribers) for id_task, subscribers in self.subscribers.items()}
+
+            for id_task in list(self.last_messages):
+                if id_task not in watched:
+                    del self.last_messages[id_task]
+
+            if not watched:
+                continue
+
+            preview = self.update_preview() if progress.current_task in watched else None
+
+            for id_task, subscribers in watched.items():
+                message = json.dumps(self.task_state(id_task))
+                if message != self.last_messages.get(id_task):
+                    self.last_messages[id_task] = message
+                    for subscriber in subscribers:
+                        subscriber.send("progress", message)
+
+                if preview is not None and id_task == progress.current_task:
+                    for subscriber in subscribers:
+                        subscriber.send("preview", preview)
+
+    def task_state(self, id_task):
+        job = job_queue.get_scheduler().get(id_task)
+        status = job.status if job is not None else None
+
+        active = id_task == progress.current_task or status == "running"
+        completed = status in FINISHED_STATUSES or (status is None and id_task in progress.finished_tasks)
+        queued = not active and not completed and (status == "queued" or id_task in progress.pending_tasks)
+
+        res = {"id_task": id_task, "active": active, "queued": queued, "completed": completed, "status": status}
+
+        if queued:
+            res["queue_position"] = job_queue.get_scheduler().position(id_task) if job is not None else None
+            res["textinfo"] = "In queue..."
+        elif active:
+            res["progress"], res["eta"] = progress.current_progress()
+            res["textinfo"] = shared.state.textinfo
+            res["id_live_preview"] = self.preview_id if self.preview_task == id_task else -1
+        elif not completed:
+            res["textinfo"] = "Waiting..."
+
+        if job is not None and job.error is not None:
+            res["error"] = job.dict()["error"]
+
+        return res
+
+    def update_preview(self):
+        """returns a preview message with the newly encoded live preview, or None if it has not changed since last call"""
+
+        if not shared.opts.live_previews_enable:
+            return None
+
+        now = time.time()
+        if now - self.preview_time < shared.opts.progress_stream_preview_interval_ms / 1000:
+            return None
+        self.preview_time = now
+
+        shared.state.set_current_image()
+        image = shared.state.current_image
+        if image is None or image is self.preview_source:
+            return None
+
+        image_format = shared.opts.progress_stream_preview_format
+        buffered = io.BytesIO()
+        image.convert("RGB").save(buffered, format=image_format, quality=shared.opts.progress_stream_preview_quality)
+        data = f"data:image/{image_format.lower()};base64," + base64.b64encode(buffered.getvalue()).decode("ascii")
+
+        self.preview_source = image
+        self.preview_id = shared.state.id_live_preview
+        self.preview_task = progress.current_task
+        self.preview = json.dumps({"id_live_preview": self.preview_id, "live_preview": data})
+
+        return self.preview
+
+
+broadcaster = ProgressBroadcaster()
+
+
+async def sse_events(request, id_task):
+    """yields server-sent events with the progress of id_task until it is completed or the client disconnects"""
+
+    subscriber = broadcaster.subscribe(id_task)
+
+    try:
+        yield "retry: 1000\n\n"
+
+        while not await request.is_disconnected():
+            messages = await subscriber.receive(timeout=15)
+            if not messages:
+                # a comment line keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+
+            completed = False
+            for kind, data in messages:
+                yield f"event: {kind}\ndata: {data}\n\n"
+                completed = completed or (kind == "progress" and json.loads(data)["completed"])
+
+            if completed:
+                break
+    finally:
+        broadcaster.unsubscribe(subscriber)
@@ -3,6 +3,8 @@ from collections import namedtuple
 from typing import List
 import lark
 
+from modules.lru_cache import LruCache
+
 # a prompt like this: "fantasy landscape with a [mountain:lake:0.25] and [an oak:a christmas tree:0.75][ in foreground::0.6][ in background:0.25] [shoddy:masterful:0.5]"
 # will be represented with prompt_schedule like this (assuming steps=100):
 # [25, 'fantasy landscape with a mountain and an oak in foreground shoddy']
@@ -106,6 +108,42 @@ def get_learned_conditioning_prompt_schedules(prompts, steps):
 ScheduledPromptConditioning = namedtuple("ScheduledPromptConditioning", ["end_at_step", "cond"])
 
 
+def tensor_size(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+conditioning_cache = LruCache("conditioning", lambda: conditioning_cache_limit(), size_of=tensor_size)
+
+
+def conditioning_cache_limit():
+    from modules import shared
+
+    return int(shared.opts.cond_cache_size_mb * 1024 * 1024)
+
+
+def conditioning_cache_key(model):
+    """returns everything besides the prompt text that the output of the text encoder depends on, or None if
+    results must not be cached right now"""
+
+    from modules import shared, sd_hijack, extra_networks
+
+    if shared.opts.cond_cache_size_mb <= 0 or shared.state.job.startswith("train-"):
+        return None
+
+    checkpoint_info = getattr(model, "sd_checkpoint_info", None)
+
+    return (
+        getattr(checkpoint_info, "filename", None),
+        getattr(model, "sd_model_hash", None),
+        sd_hijack.model_hijack.embedding_db.version,
+        extra_networks.active_key,
+        shared.opts.CLIP_stop_at_last_layers,
+        shared.opts.enable_emphasis,
+        shared.opts.use_old_emphasis_implementation,
+        shared.opts.comma_padding_backtrack,
+    )
+
+
 def get_learned_conditioning(model, prompts, steps):
     """converts a list of prompts into a list of prompt schedules - each schedule is a list of ScheduledPromptConditioning, specifying the comdition (cond),
     and the sampling step at which this condition is to be replaced by the next one.
@@ -128,6 +166,7 @@ def get_learned_conditioning(model, prompts, steps):
 
     prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps)
     cache = {}
+    cache_key = conditioning_cache_key(model)
 
     for prompt, prompt_schedule in zip(prompts, prompt_schedules):
 
@@ -137,7 +176,13 @@ def get_learned_conditioning(model, prompts, steps):
             continue
 
         texts = [x[1] for x in prompt_schedule]
-        conds = model.get_learned_conditioning(texts)
+
+        conds = None if cache_key is None else conditioning_cache.get((cache_key, tuple(texts)))
+        if conds is None:
+            conds = model.get_learned_conditioning(texts)
+
+            if cache_key is not None:
+                conditioning_cache.put((cache_key, tuple(texts)), conds)
 
         cond_schedule = []
         for i, (end_at_step, text) in enumerate(prompt_schedule):
@@ -3,10 +3,12 @@ import sys
 import traceback
 
 import numpy as np
+import torch
 from PIL import Image
 from basicsr.utils.download_util import load_file_from_url
 from realesrgan import RealESRGANer
 
+from modules import upscaler_tiling
 from modules.upscaler import Upscaler, UpscalerData
 from modules.shared import cmd_opts, opts
 
@@ -34,27 +36,37 @@ class UpscalerRealESRGAN(Upscaler):
             self.scalers = []
 
     def do_upscale(self, img, path):
+        return self.do_upscale_batch([img], path)[0]
+
+    def do_upscale_batch(self, imgs, path):
         if not self.enable:
-            return img
+            return imgs
+
+        upsampler = self.load_model_cached(path)
+        if upsampler is None:
+            return imgs
+
+        res = list(imgs)
 
-        info = self.load_model(path)
-        if not os.path.exists(info.local_data_path):
-            print("Unable to load RealESRGAN model: %s" % info.name)
-            return img
+        rgb = [i for i, img in enumerate(imgs) if img.mode == "RGB"]
+        if rgb:
+            dtype = torch.float16 if upsampler.half else torch.float32
 
-        upsampler = RealESRGANer(
-            scale=info.scale,
-            model_path=info.local_data_path,
-            model=info.model(),
-            half=not cmd_opts.no_half and not cmd_opts.upcast_sampling,
-            tile=opts.ESRGAN_tile,
-            tile_pad=opts.ESRGAN_tile_overlap,
-        )
+            # x2 models unshuffle their input into 2x2 blocks and need even sizes
+            upscaled = upscaler_tiling.upscale_batch(upsampler.model, [imgs[i] for i in rgb], opts.ESRGAN_tile, opts.ESRGAN_tile_overlap, upsampler.device, dtype, pad_to=2 if upsampler.scale == 2 else 1)
+            for i, image in zip(rgb, upscaled):
+                res[i] = image
 
-        upsampled = upsampler.enhance(np.array(img), outscale=info.scale)[0]
+        # the upsampler may come from the cache, made when the tile settings were different
+        upsampler.tile_size = opts.ESRGAN_tile
+        upsampler.tile_pad = opts.ESRGAN_tile_overlap
 
-        image = Image.fromarray(upsampled)
-        return image
+        for i, img in enumerate(imgs):
+            if img.mode != "RGB":
+                upsampled = upsampler.enhance(np.array(img), outscale=upsampler.scale)[0]
+                res[i] = Image.fromarray(upsampled)
+
+        return res
 
     def load_model(self, path):
         try:
@@ -65,7 +77,18 @@ class UpscalerRealESRGAN(Upscaler):
                 return None
 
             info.local_data_path = load_file_from_url(url=info.data_path, model_dir=self.model_path, progress=True)
-            return info
+            if not os.path.exists(info.local_data_path):
+                print("Unable to load RealESRGAN model: %s" % info.name)
+                return None
+
+            return RealESRGANer(
+                scale=info.scale,
+                model_path=info.local_data_path,
+                model=info.model(),
+                half=not cmd_opts.no_half and not cmd_opts.upcast_sampling,
+                tile=opts.ESRGAN_tile,
+                tile_pad=opts.ESRGAN_tile_overlap,
+            )
         except Exception as e:
             print(f"Error making Real-ESRGAN models list: {e}", file=sys.stderr)
             print(traceback.format_exc(), file=sys.stderr)
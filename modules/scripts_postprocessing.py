@@ -42,6 +42,15 @@ class ScriptPostprocessing:
 
         pass
 
+    def process_batch(self, pps, **args):
+        """
+        This function is called to postprocess several images with the same arguments.
+        By default it calls process() for each; scripts that can work on the images together override it.
+        """
+
+        for pp in pps:
+            self.process(pp, **args)
+
     def image_changed(self):
         pass
 
@@ -118,6 +127,9 @@ class ScriptPostprocessingRunner:
         return inputs
 
     def run(self, pp: PostprocessedImage, args):
+        self.run_batch([pp], args)
+
+    def run_batch(self, pps, args):
         for script in self.scripts_in_preferred_order():
             shared.state.job = script.name
 
@@ -127,7 +139,7 @@ class ScriptPostprocessingRunner:
             for (name, component), value in zip(script.controls.items(), script_args):
                 process_args[name] = value
 
-            script.process(pp, **process_args)
+            script.process_batch(pps, **process_args)
 
     def create_args_for_run(self, scripts_args):
         if not self.ui_created:
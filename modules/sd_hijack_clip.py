@@ -4,6 +4,7 @@ from collections import namedtuple
 import torch
 
 from modules import prompt_parser, devices, sd_hijack
+from modules.lru_cache import LruCache
 from modules.shared import opts
 
 
@@ -26,6 +27,11 @@ PromptChunkFix = namedtuple('PromptChunkFix', ['offset', 'embedding'])
 chunk. Thos objects are found in PromptChunk.fixes and, are placed into FrozenCLIPEmbedderWithCustomWordsBase.hijack.fixes, and finally
 are applied by sd_hijack.EmbeddingsWithFixes's forward function."""
 
+tokenization_cache = LruCache("tokenization", lambda: opts.tokenization_cache_size)
+"""Results of tokenize_line() shared by all prompts processed since startup. Cached PromptChunk objects must not be modified."""
+
+tokenization_cache_embeddings_version = None
+
 
 class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
     """A pytorch module that is a wrapper for FrozenCLIPEmbedder module. it enhances FrozenCLIPEmbedder, making it possible to
@@ -172,6 +178,28 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
         return chunks, token_count
 
+    def tokenize_line_cached(self, line):
+        """same as tokenize_line(), but remembers results across calls; the cache is emptied whenever the set of
+        textual inversion embeddings changes, because embeddings change how text is split into tokens"""
+
+        global tokenization_cache_embeddings_version
+
+        if opts.tokenization_cache_size <= 0:
+            return self.tokenize_line(line)
+
+        embeddings_version = self.hijack.embedding_db.version
+        if tokenization_cache_embeddings_version != embeddings_version:
+            tokenization_cache.clear()
+            tokenization_cache_embeddings_version = embeddings_version
+
+        key = (type(self.wrapped).__name__, opts.enable_emphasis, opts.comma_padding_backtrack, line)
+        res = tokenization_cache.get(key)
+        if res is None:
+            res = self.tokenize_line(line)
+            tokenization_cache.put(key, res)
+
+        return res
+
     def process_texts(self, texts):
         """
         Accepts a list of texts and calls tokenize_line() on each, with cache. Returns the list of results and maximum
@@ -186,7 +214,7 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
             if line in cache:
                 chunks = cache[line]
             else:
-                chunks, current_token_count = self.tokenize_line(line)
+                chunks, current_token_count = self.tokenize_line_cached(line)
                 token_count = max(current_token_count, token_count)
 
                 cache[line] = chunks
@@ -1,4 +1,5 @@
 import collections
+import collections.abc
 import os.path
 import sys
 import gc
@@ -120,6 +121,10 @@ def list_models():
         checkpoint_info = CheckpointInfo(filename)
         checkpoint_info.register()
 
+    for checkpoint_info in list(checkpoints_list.values()):
+        if checkpoint_info.sha256 is None:
+            hashes.sha256_in_background(checkpoint_info.filename, "checkpoint/" + checkpoint_info.name)
+
 
 def get_closet_checkpoint_match(search_string):
     checkpoint_info = checkpoint_alisases.get(search_string, None)
@@ -204,6 +209,42 @@ def get_state_dict_from_checkpoint(pl_sd):
     return pl_sd
 
 
+class SafetensorsStateDict(collections.abc.Mapping):
+    """Read-only state dict backed by a memory-mapped .safetensors file; a tensor is only read from the file when it
+    is accessed, so the whole state dict never has to be in memory at once."""
+
+    def __init__(self, filename):
+        self.file = safetensors.safe_open(filename, framework="pt", device="cpu")
+        self.names = {transform_checkpoint_dict_key(k): k for k in self.file.keys()}
+
+    def __getitem__(self, key):
+        return self.file.get_tensor(self.names[key])
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def load_into(self, model):
+        """copies tensors from the file into matching parameters and buffers of model one at a time; like
+        model.load_state_dict(self, strict=False), but without making a full copy of the state dict first"""
+
+        params = model.state_dict()
+
+        with torch.no_grad():
+            for key in self.names:
+                target = params.get(key, None)
+                if target is None:
+                    continue
+
+                tensor = self[key]
+                if tensor.shape != target.shape:
+                    raise RuntimeError(f"size mismatch for {key}: copying a param with shape {tuple(tensor.shape)} from checkpoint, the shape in current model is {tuple(target.shape)}")
+
+                target.copy_(tensor)
+
+
 def read_state_dict(checkpoint_file, print_global_state=False, map_location=None):
     _, extension = os.path.splitext(checkpoint_file)
     if extension.lower() == ".safetensors":
@@ -228,8 +269,18 @@ def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
         print(f"Loading weights [{sd_model_hash}] from cache")
         return checkpoints_loaded[checkpoint_info]
 
+    from modules.sd_models_prefetch import prefetcher
+    res = prefetcher.take(checkpoint_info)
+    if res is not None:
+        print(f"Loading weights [{sd_model_hash}] from prefetched copy")
+        timer.record("wait for prefetched weights")
+        return res
+
     print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
-    res = read_state_dict(checkpoint_info.filename)
+    if shared.opts.sd_checkpoint_mmap_load and os.path.splitext(checkpoint_info.filename)[1].lower() == ".safetensors":
+        res = SafetensorsStateDict(checkpoint_info.filename)
+    else:
+        res = read_state_dict(checkpoint_info.filename)
     timer.record("load weights from disk")
 
     return res
@@ -244,7 +295,10 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     if state_dict is None:
         state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
 
-    model.load_state_dict(state_dict, strict=False)
+    if isinstance(state_dict, SafetensorsStateDict):
+        state_dict.load_into(model)
+    else:
+        model.load_state_dict(state_dict, strict=False)
     del state_dict
     timer.record("apply weights to model")
 
@@ -369,7 +423,7 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None, time_taken_
 
     do_inpainting_hijack()
 
-    timer = Timer()
+    timer = Timer(track_memory=True)
 
     if already_loaded_state_dict is not None:
         state_dict = already_loaded_state_dict
@@ -434,6 +488,7 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None, time_taken_
 
 def reload_model_weights(sd_model=None, info=None):
     from modules import lowvram, devices, sd_hijack
+    from modules.sd_models_residency import residency
     checkpoint_info = info or select_checkpoint()
 
     if not sd_model:
@@ -446,6 +501,22 @@ def reload_model_weights(sd_model=None, info=None):
         if sd_model.sd_model_checkpoint == checkpoint_info.filename:
             return
 
+    if residency.enabled() and sd_model is shared.sd_model:
+        # keep the current model around instead of overwriting its weights
+        timer = Timer(track_memory=True)
+
+        if sd_model is not None:
+            residency.park(sd_model)
+            del sd_model
+            timer.record("park model")
+
+        if residency.activate(checkpoint_info, timer):
+            print(f"Resident model switched in {timer.summary()}.")
+            return shared.sd_model
+
+        return load_model(checkpoint_info)
+
+    if sd_model is not None:
         if shared.cmd_opts.lowvram or shared.cmd_opts.medvram:
             lowvram.send_everything_to_cpu()
         else:
@@ -453,7 +524,7 @@ def reload_model_weights(sd_model=None, info=None):
 
         sd_hijack.model_hijack.undo_hijack(sd_model)
 
-    timer = Timer()
+    timer = Timer(track_memory=True)
 
     state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
 
@@ -464,7 +535,7 @@ def reload_model_weights(sd_model=None, info=None):
     if sd_model is None or checkpoint_config != sd_model.used_config:
         del sd_model
         checkpoints_loaded.clear()
-        load_model(checkpoint_info, already_loaded_state_dict=state_dict, time_taken_to_load_state_dict=timer.records["load weights from disk"])
+        load_model(checkpoint_info, already_loaded_state_dict=state_dict, time_taken_to_load_state_dict=timer.records.get("load weights from disk", 0))
         return shared.sd_model
 
     try:
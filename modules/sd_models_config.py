@@ -50,8 +50,26 @@ def is_using_v_parameterization_for_sd2(state_dict):
         unet.eval()
 
     with torch.no_grad():
-        unet_sd = {k.replace("model.diffusion_model.", ""): v for k, v in state_dict.items() if "model.diffusion_model." in k}
-        unet.load_state_dict(unet_sd, strict=True)
+        # only the UNet tensors are read, one at a time, so a lazily loaded state dict never reads the rest of the model
+        prefix = "model.diffusion_model."
+        params = unet.state_dict()
+        keys = [k for k in state_dict.keys() if k.startswith(prefix)]
+
+        missing = set(params) - {k[len(prefix):] for k in keys}
+        if missing:
+            raise RuntimeError(f"Missing key(s) in state_dict: {', '.join(sorted(missing))}")
+
+        for key in keys:
+            target = params.get(key[len(prefix):], None)
+            if target is None:
+                raise RuntimeError(f"Unexpected key in state_dict: {key}")
+
+            tensor = state_dict[key]
+            if tensor.shape != target.shape:
+                raise RuntimeError(f"size mismatch for {key}: copying a param with shape {tuple(tensor.shape)} from checkpoint, the shape in current model is {tuple(target.shape)}")
+
+            target.copy_(tensor)
+
         unet.to(device=device, dtype=torch.float)
 
         test_cond = torch.ones((1, 2, 1024), device=device) * 0.5
@@ -0,0 +1,116 @@
+import os
+import sys
+import threading
+import traceback
+
+from modules import shared, sd_models, hashes
+from modules.lru_cache import LruCache
+
+
+def state_dict_size(state_dict):
+    return sum(v.numel() * v.element_size() for v in state_dict.values() if hasattr(v, "numel"))
+
+
+class CheckpointPrefetcher:
+    """Reads checkpoints that queued jobs will switch to into RAM on a background thread, so that the switch itself
+    does not have to wait for the disk.
+
+    The job scheduler calls notify() whenever its queue changes. The prefetcher then looks for the first queued job,
+    in the order jobs will run, whose checkpoint is neither active nor resident nor already prefetched, hashes its file
+    and reads its state dict. Prefetched state dicts are kept within sd_checkpoint_prefetch_ram_mb and are handed over
+    to get_checkpoint_state_dict() by take().
+    """
+
+    def __init__(self):
+        self.cache = LruCache("checkpoint prefetch", lambda: int(shared.opts.sd_checkpoint_prefetch_ram_mb * 1024 * 1024), size_of=state_dict_size)
+        self.condition = threading.Condition()
+        self.worker = None
+        self.loading = None
+        self.failed = set()
+
+    def enabled(self):
+        return shared.opts.sd_checkpoint_prefetch_ram_mb > 0
+
+    def notify(self):
+        if not self.enabled():
+            return
+
+        with self.condition:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.worker_loop, name="checkpoint-prefetch", daemon=True)
+                self.worker.start()
+
+            self.condition.notify_all()
+
+    def wanted(self):
+        """returns CheckpointInfo for the next checkpoint that should be prefetched, or None"""
+
+        from modules import job_queue
+        from modules.sd_models_residency import residency, SWAP_FROM_DISK
+
+        if not self.enabled():
+            return None
+
+        for checkpoint in job_queue.get_scheduler().queued_checkpoints():
+            if residency.swap_cost(checkpoint) != SWAP_FROM_DISK:
+                continue
+
+            checkpoint_info = sd_models.checkpoint_alisases.get(checkpoint, None) or sd_models.get_closet_checkpoint_match(checkpoint)
+            if checkpoint_info is None or checkpoint_info.filename in self.failed:
+                continue
+
+            if checkpoint_info.filename in self.cache or checkpoint_info in sd_models.checkpoints_loaded:
+                continue
+
+            if not os.path.isfile(checkpoint_info.filename) or os.path.getsize(checkpoint_info.filename) > self.cache.limit():
+                continue
+
+            return checkpoint_info
+
+        return None
+
+    def worker_loop(self):
+        while True:
+            with self.condition:
+                checkpoint_info = self.wanted()
+                while checkpoint_info is None:
+                    self.condition.wait()
+                    checkpoint_info = self.wanted()
+
+                self.loading = checkpoint_info.filename
+
+            try:
+                # the hash is what the switch spends most time on after reading the file; this puts it into the hash cache
+                hashes.sha256(checkpoint_info.filename, "checkpoint/" + checkpoint_info.name)
+
+                state_dict = sd_models.read_state_dict(checkpoint_info.filename, map_location="cpu")
+                self.cache.put(checkpoint_info.filename, state_dict)
+                del state_dict
+            except Exception:
+                self.failed.add(checkpoint_info.filename)
+                print(f"Error prefetching checkpoint {checkpoint_info.filename}", file=sys.stderr)
+                print(traceback.format_exc(), file=sys.stderr)
+
+            with self.condition:
+                self.loading = None
+                self.condition.notify_all()
+
+    def take(self, checkpoint_info):
+        """returns the prefetched state dict for checkpoint_info and forgets it, or None if it has not been prefetched;
+        waits if the checkpoint is being read right now"""
+
+        if not self.enabled():
+            return None
+
+        with self.condition:
+            while self.loading == checkpoint_info.filename:
+                self.condition.wait()
+
+        state_dict = self.cache.get(checkpoint_info.filename)
+        if state_dict is not None:
+            self.cache.pop(checkpoint_info.filename)
+
+        return state_dict
+
+
+prefetcher = CheckpointPrefetcher()
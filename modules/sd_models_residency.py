@@ -0,0 +1,232 @@
+import collections
+import gc
+import itertools
+import threading
+
+import torch
+
+from modules import shared, devices, sd_models, sd_vae, script_callbacks, lowvram
+
+# how expensive it is to make a checkpoint the active one, from cheapest to most expensive
+SWAP_NONE = 0
+SWAP_ON_DEVICE = 1
+SWAP_FROM_RAM = 2
+SWAP_FROM_DISK = 3
+
+
+def model_size(model):
+    return sum(t.numel() * t.element_size() for t in itertools.chain(model.parameters(), model.buffers()))
+
+
+class Resident:
+    def __init__(self, model):
+        self.model = model
+        self.checkpoint_info = model.sd_checkpoint_info
+        self.size = model_size(model)
+        self.on_device = False
+        self.vae_state = None
+
+
+class ResidencyManager:
+    """Keeps fully instantiated models for recently used checkpoints so that switching back to one of them does
+    not require reading and applying its weights again.
+
+    The model in shared.sd_model is the active one; other resident models are parked either on the device or in
+    RAM. Parked models stay on the device while their total size together with the active model fits into
+    sd_model_residency_vram_mb; least recently used ones are moved to RAM after that. Models in RAM are dropped,
+    least recently used first, when their total size exceeds sd_model_residency_ram_mb. Checkpoints listed in
+    sd_model_residency_pinned are never moved or dropped.
+
+    lock only guards residents and is never held while a model is moved, since the job scheduler reads swap costs
+    while holding its own lock; moves are serialized by move_lock instead.
+    """
+
+    def __init__(self):
+        self.residents = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.move_lock = threading.Lock()
+        self.parked_config = None
+
+    def low_vram(self):
+        return shared.cmd_opts.lowvram or shared.cmd_opts.medvram
+
+    def ram_budget(self):
+        return int(shared.opts.sd_model_residency_ram_mb * 1024 * 1024)
+
+    def device_budget(self):
+        return 0 if self.low_vram() else int(shared.opts.sd_model_residency_vram_mb * 1024 * 1024)
+
+    def enabled(self):
+        return self.ram_budget() > 0 or self.device_budget() > 0
+
+    def is_pinned(self, checkpoint_info):
+        for name in shared.opts.sd_model_residency_pinned:
+            info = sd_models.checkpoint_alisases.get(name, None)
+            if info is not None and info.filename == checkpoint_info.filename:
+                return True
+
+        return False
+
+    def swap_cost(self, checkpoint=None):
+        """tells how much work is needed before a job requesting checkpoint (a title or alias, as used in
+        override_settings; None for whatever is loaded) can start sampling; see SWAP_* constants"""
+
+        if checkpoint is None:
+            return SWAP_NONE
+
+        checkpoint_info = sd_models.checkpoint_alisases.get(checkpoint, None) or sd_models.get_closet_checkpoint_match(checkpoint)
+        if checkpoint_info is None:
+            return SWAP_NONE
+
+        active = shared.sd_model
+        if active is not None and active.sd_model_checkpoint == checkpoint_info.filename:
+            return SWAP_NONE
+
+        with self.lock:
+            resident = self.residents.get(checkpoint_info.filename, None)
+
+        if resident is None:
+            return SWAP_FROM_DISK
+
+        return SWAP_ON_DEVICE if resident.on_device else SWAP_FROM_RAM
+
+    def can_run_without_swap(self, checkpoint=None):
+        return self.swap_cost(checkpoint) == SWAP_NONE
+
+    def park(self, model):
+        """deactivates model, which must be shared.sd_model, and keeps it as a resident"""
+
+        from modules import sd_hijack
+
+        sd_hijack.model_hijack.undo_hijack(model)
+
+        if self.low_vram():
+            lowvram.send_everything_to_cpu()
+
+        resident = Resident(model)
+        resident.on_device = not self.low_vram()
+        resident.vae_state = (sd_vae.base_vae, sd_vae.checkpoint_info, sd_vae.loaded_vae_file)
+
+        sd_vae.delete_base_vae()
+        sd_vae.clear_loaded_vae()
+        shared.sd_model = None
+        self.parked_config = model.used_config
+
+        with self.lock:
+            self.residents[resident.checkpoint_info.filename] = resident
+
+        # the next model is most likely about as big as this one
+        self.enforce_budget(extra_device_size=resident.size)
+
+    def activate(self, checkpoint_info, timer):
+        """makes the resident model for checkpoint_info the active one; returns False if it is not resident"""
+
+        from modules import sd_hijack
+
+        # taking move_lock first makes sure the model is not being moved to RAM while it is taken out
+        with self.move_lock, self.lock:
+            resident = self.residents.pop(checkpoint_info.filename, None)
+
+        if resident is None:
+            return False
+
+        model = resident.model
+
+        if not resident.on_device and not self.low_vram():
+            self.enforce_budget(extra_device_size=resident.size)
+            model.to(devices.device)
+            timer.record("move model to device")
+
+        sd_vae.base_vae, sd_vae.checkpoint_info, sd_vae.loaded_vae_file = resident.vae_state
+        vae_file, vae_source = sd_vae.resolve_vae(checkpoint_info.filename)
+        if vae_file != sd_vae.loaded_vae_file:
+            sd_vae.load_vae(model, vae_file, vae_source)
+            timer.record("load VAE")
+
+        devices.dtype_unet = model.model.diffusion_model.dtype
+        devices.unet_needs_upcast = shared.cmd_opts.upcast_sampling and devices.dtype == torch.float16 and devices.dtype_unet == torch.float16
+
+        shared.opts.data["sd_model_checkpoint"] = checkpoint_info.title
+        shared.opts.data["sd_checkpoint_hash"] = checkpoint_info.sha256
+
+        sd_hijack.model_hijack.hijack(model)
+        shared.sd_model = model
+        timer.record("hijack")
+
+        if self.parked_config != model.used_config:
+            sd_hijack.model_hijack.embedding_db.load_textual_inversion_embeddings(force_reload=True)
+            timer.record("load textual inversion embeddings")
+
+        script_callbacks.model_loaded_callback(model)
+        timer.record("script callbacks")
+
+        self.enforce_budget()
+
+        return True
+
+    def enforce_budget(self, extra_device_size=0):
+        """moves parked models from device to RAM and drops them from RAM, least recently used first, until both
+        budgets are met; extra_device_size is reserved on the device for a model that is about to be placed there"""
+
+        dropped = False
+
+        with self.move_lock:
+            active = shared.sd_model
+            active_size = model_size(active) if active is not None and not self.low_vram() else 0
+
+            with self.lock:
+                device_size = extra_device_size + active_size + sum(x.size for x in self.residents.values() if x.on_device)
+
+                to_ram = []
+                for resident in self.residents.values():
+                    if device_size <= self.device_budget():
+                        break
+
+                    if resident.on_device and not self.is_pinned(resident.checkpoint_info):
+                        to_ram.append(resident)
+                        device_size -= resident.size
+
+            for resident in to_ram:
+                resident.model.to(devices.cpu)
+
+                with self.lock:
+                    resident.on_device = False
+
+            with self.lock:
+                ram_size = sum(x.size for x in self.residents.values() if not x.on_device)
+
+                for filename, resident in list(self.residents.items()):
+                    if ram_size <= self.ram_budget():
+                        break
+
+                    if not resident.on_device and not self.is_pinned(resident.checkpoint_info):
+                        del self.residents[filename]
+                        ram_size -= resident.size
+                        dropped = True
+
+        if dropped:
+            gc.collect()
+
+        devices.torch_gc()
+
+    def clear(self):
+        with self.lock:
+            self.residents.clear()
+
+        gc.collect()
+        devices.torch_gc()
+
+    def list(self):
+        with self.lock:
+            residents = list(self.residents.values())
+
+        res = [{"title": x.checkpoint_info.title, "size": x.size, "on_device": x.on_device, "pinned": self.is_pinned(x.checkpoint_info), "active": False} for x in reversed(residents)]
+
+        active = shared.sd_model
+        if active is not None:
+            res.insert(0, {"title": active.sd_checkpoint_info.title, "size": model_size(active), "on_device": not self.low_vram(), "pinned": self.is_pinned(active.sd_checkpoint_info), "active": True})
+
+        return res
+
+
+residency = ResidencyManager()
@@ -0,0 +1,138 @@
+import torch
+
+import ldm.modules.diffusionmodules.model
+from modules import devices, shared, sd_hijack, sd_vae_approx
+from modules.tiling import is_out_of_memory, tile_positions, blend_ramp
+
+decode_modes = ["full", "approx", "cheap"]
+
+# rough VAE decoder memory use per output pixel and per byte of element size: the last up block keeps a few
+# 128-channel feature maps at full resolution alive at once
+bytes_per_pixel = 1024
+
+
+def memory_budget():
+    """returns how many bytes a decode may use, or None if it can not be told (not on CUDA)"""
+
+    if shared.opts.vae_decode_memory_budget_mb > 0:
+        return shared.opts.vae_decode_memory_budget_mb * 1024 * 1024
+
+    if devices.device.type != "cuda":
+        return None
+
+    free, _ = torch.cuda.mem_get_info(devices.device)
+    cached = torch.cuda.memory_reserved(devices.device) - torch.cuda.memory_allocated(devices.device)
+
+    return int((free + cached) * 0.9)
+
+
+def estimate_memory(height, width):
+    """returns the approximate number of bytes needed to decode one latent of height x width"""
+
+    element_size = torch.finfo(devices.dtype_vae).bits // 8
+    res = height * width * 64 * bytes_per_pixel * element_size
+
+    # the attention block in the middle of the decoder builds the full attention matrix unless an optimization is on
+    if ldm.modules.diffusionmodules.model.AttnBlock.forward is sd_hijack.diffusionmodules_model_AttnBlock_forward:
+        res += (height * width) ** 2 * element_size
+
+    return res
+
+
+def max_batch_size(samples):
+    """returns how many of the latents fit into the memory budget at once; 0 if one does not fit and must be tiled"""
+
+    budget = memory_budget()
+    if budget is None:
+        return len(samples)
+
+    return min(len(samples), budget // estimate_memory(samples.shape[2], samples.shape[3]))
+
+
+def decode_full(model, x):
+    from modules.processing import decode_first_stage
+
+    return decode_first_stage(model, x).cpu().float()
+
+
+def decode_tiled(model, samples, tile):
+    """decodes overlapping tile x tile pieces of the latents one at a time and blends them across the overlaps"""
+
+    height, width = samples.shape[2], samples.shape[3]
+    tile = max(min(tile, max(height, width)), 8)
+    overlap = min(shared.opts.vae_decode_tile_overlap, tile // 4)
+
+    ys = tile_positions(height, tile, overlap)
+    xs = tile_positions(width, tile, overlap)
+
+    result = torch.zeros((samples.shape[0], 3, height * 8, width * 8))
+    weights = torch.zeros((1, 1, height * 8, width * 8))
+
+    for y in ys:
+        for x in xs:
+            decoded = decode_full(model, samples[:, :, y:y + tile, x:x + tile])
+            tile_height, tile_width = decoded.shape[2], decoded.shape[3]
+
+            weight = blend_ramp(tile_height, overlap * 8, y > 0, y + tile < height)[:, None] * blend_ramp(tile_width, overlap * 8, x > 0, x + tile < width)[None, :]
+            result[:, :, y * 8:y * 8 + tile_height, x * 8:x * 8 + tile_width] += decoded * weight
+            weights[:, :, y * 8:y * 8 + tile_height, x * 8:x * 8 + tile_width] += weight
+
+            del decoded
+
+    return result / weights
+
+
+def decode_approximate(samples, mode):
+    """decodes with the small approximation network (approx) or a linear mix of latent channels (cheap) and scales
+    the result to the size a full decode would have"""
+
+    if mode == "cheap":
+        x = torch.stack([sd_vae_approx.cheap_approximation(sample) for sample in samples])
+    else:
+        x = sd_vae_approx.model()(samples.to(devices.device, devices.dtype)).detach()
+
+    x = torch.nn.functional.interpolate(x.float(), size=(samples.shape[2] * 8, samples.shape[3] * 8), mode="bilinear", align_corners=False)
+
+    return x.cpu()
+
+
+def decode(model, samples, mode="full"):
+    """decodes a batch of latents into images in the -1..1 range, returned as a float tensor on the CPU.
+
+    Full decodes take as many latents at once as fit into the memory budget. If that runs out of memory anyway, the
+    batch is halved, and latents too large to decode even one at a time are decoded in overlapping tiles.
+    """
+
+    if mode != "full":
+        return decode_approximate(samples, mode)
+
+    samples = samples.to(dtype=devices.dtype_vae)
+    batch_size = max_batch_size(samples)
+    tile = shared.opts.vae_decode_tile_size
+
+    results = []
+    i = 0
+    while i < len(samples):
+        try:
+            if batch_size > 0:
+                chunk = samples[i:i + batch_size]
+                results.append(decode_full(model, chunk))
+            else:
+                chunk = samples[i:i + 1]
+                results.append(decode_tiled(model, chunk, tile))
+
+            i += len(chunk)
+            continue
+        except RuntimeError as e:
+            if not is_out_of_memory(e) or (batch_size == 0 and tile <= 16):
+                raise
+
+        # the exception is out of scope here, so the memory its traceback held on to can be freed
+        devices.torch_gc()
+        if batch_size > 0:
+            batch_size //= 2
+        else:
+            tile //= 2
+        print(f"VAE decode ran out of memory, retrying with {f'batch size {batch_size}' if batch_size > 0 else f'tiles of {tile * 8}px'}")
+
+    return torch.cat(results)
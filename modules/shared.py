@@ -98,6 +98,9 @@ parser.add_argument("--api-log", action='store_true', help="use api-log=True to
 parser.add_argument("--nowebui", action='store_true', help="use api=True to launch the API instead of the webui")
 parser.add_argument("--ui-debug-mode", action='store_true', help="Don't load model to quickly launch UI")
 parser.add_argument("--device-id", type=str, help="Select the default CUDA device to use (export CUDA_VISIBLE_DEVICES=0,1,etc might be needed before)", default=None)
+parser.add_argument("--worker-devices", type=str, help="with --nowebui, start an API-only worker process for each of these comma-separated CUDA device ids and dispatch generation jobs to them instead of loading a model in this process", default=None)
+parser.add_argument("--worker-urls", type=str, help="with --nowebui, dispatch generation jobs to already running API-only workers at these comma-separated URLs", default=None)
+parser.add_argument("--worker-base-port", type=int, help="port of the first worker started by --worker-devices; the others use the following ports", default=7870)
 parser.add_argument("--administrator", action='store_true', help="Administrator rights", default=False)
 parser.add_argument("--cors-allow-origins", type=str, help="Allowed CORS origin(s) in the form of a comma-separated list (no spaces)", default=None)
 parser.add_argument("--cors-allow-origins-regex", type=str, help="Allowed CORS origin(s) in the form of a single regular expression", default=None)
@@ -361,6 +364,10 @@ options_templates.update(options_section(('upscaling', "Upscaling"), {
     "ESRGAN_tile_overlap": OptionInfo(8, "Tile overlap, in pixels for ESRGAN upscalers. Low values = visible seam.", gr.Slider, {"minimum": 0, "maximum": 48, "step": 1}),
     "realesrgan_enabled_models": OptionInfo(["R-ESRGAN 4x+", "R-ESRGAN 4x+ Anime6B"], "Select which Real-ESRGAN models to show in the web UI. (Requires restart)", gr.CheckboxGroup, lambda: {"choices": shared_items.realesrgan_models_names()}),
     "upscaler_for_img2img": OptionInfo(None, "Upscaler for img2img", gr.Dropdown, lambda: {"choices": [x.name for x in sd_upscalers]}),
+    "upscaler_tile_batch_size": OptionInfo(8, "Maximum number of tiles ESRGAN-like upscalers run at once on the GPU; fewer are used if they don't fit in memory", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
+    "upscaler_cpu_threads": OptionInfo(4, "Number of tiles ESRGAN-like upscalers run in parallel on the CPU", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}),
+    "upscaler_model_cache_mb": OptionInfo(1024, "Memory for keeping recently used upscaler models loaded, in MB; 0 = load the model for every upscale", gr.Slider, {"minimum": 0, "maximum": 8192, "step": 128}),
+    "sd_upscale_max_tile_batch": OptionInfo(8, "Maximum number of tiles SD upscale denoises at once on the GPU; fewer are used if they don't fit in memory", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
 }))
 
 options_templates.update(options_section(('face-restoration', "Face restoration"), {
@@ -375,6 +382,14 @@ options_templates.update(options_section(('system', "System"), {
     "samples_log_stdout": OptionInfo(False, "Always print all generation info to standard output"),
     "multiple_tqdm": OptionInfo(True, "Add a second progress bar to the console that shows progress for an entire job."),
     "print_hypernet_extra": OptionInfo(False, "Print extra hypernetwork information to console."),
+    "api_jobs_keep_finished_seconds": OptionInfo(3600, "Keep results of finished API jobs for this many seconds", gr.Slider, {"minimum": 60, "maximum": 86400, "step": 60}),
+    "api_coalesce_max_batch_size": OptionInfo(4, "Maximum batch size when merging compatible queued txt2img API requests into one sampling pass; 1 = do not merge", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}),
+    "xyz_grid_max_batch_size": OptionInfo(4, "Maximum number of X/Y/Z plot cells that differ only in prompt or seed to sample together in one batch; 1 = one cell at a time", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}),
+    "api_swap_defer_seconds": OptionInfo(30, "Let API jobs for an already loaded checkpoint go ahead of a job that needs a checkpoint switch for up to this many seconds; 0 = keep fair order", gr.Slider, {"minimum": 0, "maximum": 600, "step": 5}),
+    "api_worker_swap_penalty": OptionInfo(2, "Device workers: count a worker without the requested checkpoint loaded as having this many more jobs queued (requires restart)", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}),
+    "api_worker_health_interval": OptionInfo(5, "Device workers: seconds between worker health checks (requires restart)", gr.Slider, {"minimum": 1, "maximum": 60, "step": 1}),
+    "hashing_threads": OptionInfo(2, "Number of threads for calculating hashes of model files in background; 0 = only calculate hashes when needed (requires restart)", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}),
+    "processing_pipeline_threads": OptionInfo(2, "Number of threads for color correction, saving and API encoding of generated images while the next batch is sampled; 0 = do it on the sampling thread (requires restart)", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}),
 }))
 
 options_templates.update(options_section(('training', "Training"), {
@@ -395,9 +410,17 @@ options_templates.update(options_section(('training', "Training"), {
 options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "sd_model_checkpoint": OptionInfo(None, "Stable Diffusion checkpoint", gr.Dropdown, lambda: {"choices": list_checkpoint_tiles()}, refresh=refresh_checkpoints),
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    "sd_checkpoint_mmap_load": OptionInfo(False, "Load .safetensors checkpoints by memory-mapping the file and copying weights into the model one tensor at a time"),
+    "sd_checkpoint_prefetch_ram_mb": OptionInfo(0, "RAM for reading checkpoints requested by queued API jobs ahead of time, in MB; 0 = disable", gr.Slider, {"minimum": 0, "maximum": 65536, "step": 512}),
+    "sd_model_residency_ram_mb": OptionInfo(0, "RAM for keeping recently used checkpoints loaded as complete models, in MB; 0 = only keep the active model", gr.Slider, {"minimum": 0, "maximum": 65536, "step": 512}),
+    "sd_model_residency_vram_mb": OptionInfo(0, "VRAM for keeping recently used checkpoints on the device, including the active one, in MB", gr.Slider, {"minimum": 0, "maximum": 81920, "step": 512}),
+    "sd_model_residency_pinned": OptionInfo([], "Checkpoints to never unload once loaded", gr.CheckboxGroup, lambda: {"choices": list_checkpoint_tiles()}, refresh=refresh_checkpoints),
     "sd_vae_checkpoint_cache": OptionInfo(0, "VAE Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
     "sd_vae": OptionInfo("Automatic", "SD VAE", gr.Dropdown, lambda: {"choices": shared_items.sd_vae_items()}, refresh=shared_items.refresh_vae_list),
     "sd_vae_as_default": OptionInfo(True, "Ignore selected VAE for stable diffusion checkpoints that have their own .vae.pt next to them"),
+    "vae_decode_memory_budget_mb": OptionInfo(0, "VAE decode: memory to use for decoding several images at once, in MB; 0 = free VRAM", gr.Slider, {"minimum": 0, "maximum": 49152, "step": 256}),
+    "vae_decode_tile_size": OptionInfo(128, "VAE decode: tile size in latent pixels (x8 in the image) for images too large to decode at once", gr.Slider, {"minimum": 16, "maximum": 512, "step": 8}),
+    "vae_decode_tile_overlap": OptionInfo(16, "VAE decode: overlap of neighbouring tiles in latent pixels, blended to hide seams", gr.Slider, {"minimum": 0, "maximum": 64, "step": 4}),
     "inpainting_mask_weight": OptionInfo(1.0, "Inpainting conditioning mask strength", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.01}),
     "initial_noise_multiplier": OptionInfo(1.0, "Noise multiplier for img2img", gr.Slider, {"minimum": 0.5, "maximum": 1.5, "step": 0.01}),
     "img2img_color_correction": OptionInfo(False, "Apply color correction to img2img results to match original colors."),
@@ -408,6 +431,8 @@ options_templates.update(options_section(('sd', "Stable Diffusion"), {
     "enable_batch_seeds": OptionInfo(True, "Make K-diffusion samplers produce same images in a batch as when making a single image"),
     "comma_padding_backtrack": OptionInfo(20, "Increase coherency by padding from the last comma within n tokens when using more than 75 tokens", gr.Slider, {"minimum": 0, "maximum": 74, "step": 1 }),
     "CLIP_stop_at_last_layers": OptionInfo(1, "Clip skip", gr.Slider, {"minimum": 1, "maximum": 12, "step": 1}),
+    "cond_cache_size_mb": OptionInfo(64, "Memory for caching text encoder results of recent prompts, in MB; 0 = disable", gr.Slider, {"minimum": 0, "maximum": 1024, "step": 16}),
+    "tokenization_cache_size": OptionInfo(1024, "Number of recent prompts to keep tokenized; 0 = disable", gr.Slider, {"minimum": 0, "maximum": 16384, "step": 64}),
     "upcast_attn": OptionInfo(False, "Upcast cross attention layer to float32"),
 }))
 
@@ -467,7 +492,11 @@ options_templates.update(options_section(('ui', "Live previews"), {
     "show_progress_every_n_steps": OptionInfo(10, "Show new live preview image every N sampling steps. Set to -1 to show after completion of batch.", gr.Slider, {"minimum": -1, "maximum": 32, "step": 1}),
     "show_progress_type": OptionInfo("Approx NN", "Image creation progress preview mode", gr.Radio, {"choices": ["Full", "Approx NN", "Approx cheap"]}),
     "live_preview_content": OptionInfo("Prompt", "Live preview subject", gr.Radio, {"choices": ["Combined", "Prompt", "Negative prompt"]}),
-    "live_preview_refresh_period": OptionInfo(1000, "Progressbar/preview update period, in milliseconds")
+    "live_preview_refresh_period": OptionInfo(1000, "Progressbar/preview update period, in milliseconds"),
+    "progress_stream_interval_ms": OptionInfo(250, "Progress stream (API): how often to push progress to subscribed clients, in milliseconds", gr.Slider, {"minimum": 50, "maximum": 2000, "step": 50}),
+    "progress_stream_preview_interval_ms": OptionInfo(1000, "Progress stream (API): how often to encode a new live preview, in milliseconds", gr.Slider, {"minimum": 100, "maximum": 10000, "step": 100}),
+    "progress_stream_preview_format": OptionInfo("JPEG", "Progress stream (API): live preview image format", gr.Radio, {"choices": ["JPEG", "WEBP"]}),
+    "progress_stream_preview_quality": OptionInfo(80, "Progress stream (API): live preview image quality", gr.Slider, {"minimum": 1, "maximum": 100, "step": 1}),
 }))
 
 options_templates.update(options_section(('sampler-params', "Sampler parameters"), {
@@ -486,6 +515,8 @@ options_templates.update(options_section(('postprocessing', "Postprocessing"), {
     'postprocessing_enable_in_main_ui': OptionInfo([], "Enable postprocessing operations in txt2img and img2img tabs", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
     'postprocessing_operation_order': OptionInfo([], "Postprocessing operation order", ui_components.DropdownMulti, lambda: {"choices": [x.name for x in shared_items.postprocessing_scripts()]}),
     'upscaling_max_images_in_cache': OptionInfo(5, "Maximum number of images in upscaling cache", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}),
+    'postprocessing_batch_size': OptionInfo(4, "Number of images postprocessed together in batch mode; upscalers run them through their networks at once", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}),
+    'postprocessing_prefetch': OptionInfo(4, "Number of images read ahead in the background in batch mode; 0 = read each when it is needed", gr.Slider, {"minimum": 0, "maximum": 32, "step": 1}),
 }))
 
 options_templates.update(options_section((None, "Hidden options"), {
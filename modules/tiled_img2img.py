@@ -0,0 +1,253 @@
+import contextlib
+import time
+
+import torch
+from ldm.modules.distributions.distributions import DiagonalGaussianDistribution
+
+from modules import devices, images, processing, shared
+from modules.processing import StableDiffusionProcessingImg2Img
+from modules.tiling import is_out_of_memory, tile_positions, blend_ramp
+from modules.upscaler_tiling import memory_budget
+
+
+def tile_weights(height, width, tile_h, tile_w, overlap):
+    """returns the tile positions covering a height x width area, the blending weight of every tile and the sum of all
+    weights over the area"""
+
+    positions = [(y, x) for y in tile_positions(height, tile_h, overlap) for x in tile_positions(width, tile_w, overlap)]
+
+    weights = []
+    total = torch.zeros((height, width))
+    for y, x in positions:
+        weight = blend_ramp(tile_h, overlap, y > 0, y + tile_h < height)[:, None] * blend_ramp(tile_w, overlap, x > 0, x + tile_w < width)[None, :]
+        total[y:y + tile_h, x:x + tile_w] += weight
+        weights.append(weight)
+
+    return positions, weights, total
+
+
+def split(value, positions, height, width, tile_h, tile_w):
+    """cuts the tiles at positions out of tensors as large as the latent and repeats smaller ones once per tile, so
+    that the conditioning for a batch of tiles lines up with the batch; goes into lists and dicts"""
+
+    if isinstance(value, dict):
+        return {k: split(v, positions, height, width, tile_h, tile_w) for k, v in value.items()}
+
+    if isinstance(value, list):
+        return [split(v, positions, height, width, tile_h, tile_w) for v in value]
+
+    if not isinstance(value, torch.Tensor):
+        return value
+
+    if value.dim() == 4 and value.shape[2] == height and value.shape[3] == width:
+        return torch.cat([value[:, :, y:y + tile_h, x:x + tile_w] for y, x in positions])
+
+    return torch.cat([value] * len(positions))
+
+
+class TiledDenoiser:
+    """Stands in for sd_model.apply_model and runs the UNet over overlapping tiles of the latent.
+
+    Tiles go through the UNet several at a time: as many as the memory left over fits, judging by what the first tile
+    took, up to the sd_upscale_max_tile_batch setting. The outputs are blended into one prediction for the whole latent
+    on every step, so the sampler works on a single latent and tiles agree with their neighbours where they overlap.
+    """
+
+    def __init__(self, apply_model, tile_h, tile_w, overlap):
+        self.apply_model = apply_model
+        self.tile_h = tile_h
+        self.tile_w = tile_w
+        self.overlap = overlap
+        self.batch_size = None
+        self.layout = None
+
+        self.tiles = 0
+        self.calls = 0
+        self.evaluations = 0
+
+    def __call__(self, x, t, cond, *args, **kwargs):
+        height, width = x.shape[2], x.shape[3]
+        if height <= self.tile_h and width <= self.tile_w:
+            return self.apply_model(x, t, cond, *args, **kwargs)
+
+        tile_h = min(self.tile_h, height)
+        tile_w = min(self.tile_w, width)
+
+        if self.layout is None or self.layout[0] != (height, width):
+            overlap = min(self.overlap, tile_h // 2, tile_w // 2)
+            positions, weights, total = tile_weights(height, width, tile_h, tile_w, overlap)
+            self.layout = ((height, width), positions, [w.to(x.device) for w in weights], total.to(x.device))
+            self.tiles = len(positions)
+
+        _, positions, weights, total = self.layout
+        rows = x.shape[0]
+        result = torch.zeros(x.shape, device=x.device, dtype=torch.float32)
+
+        def run(batch):
+            x_in = split(x, batch, height, width, tile_h, tile_w)
+            t_in = split(t, batch, height, width, tile_h, tile_w)
+            cond_in = split(cond, batch, height, width, tile_h, tile_w)
+
+            self.calls += 1
+            self.evaluations += len(batch) * rows
+
+            return self.apply_model(x_in, t_in, cond_in, *args, **kwargs)
+
+        i = 0
+        if self.batch_size is None:
+            # the first tile goes alone to find out how much memory a tile takes
+            if x.device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(x.device)
+            allocated = torch.cuda.memory_allocated(x.device) if x.device.type == "cuda" else 0
+
+            output = run(positions[:1])
+            result[:, :, :tile_h, :tile_w] += output.float() * weights[0]
+            i = 1
+
+            tile_memory = torch.cuda.max_memory_allocated(x.device) - allocated if x.device.type == "cuda" else 0
+            self.batch_size = self.fit(x.device, tile_memory)
+
+        while i < len(positions):
+            batch = positions[i:i + self.batch_size]
+
+            try:
+                output = run(batch)
+            except RuntimeError as e:
+                if not is_out_of_memory(e) or self.batch_size == 1:
+                    raise
+
+                output = None
+
+            if output is None:
+                devices.torch_gc()
+                self.batch_size //= 2
+                print(f"SD upscale ran out of memory, retrying with {self.batch_size} tiles at a time")
+                continue
+
+            for j, (y, x0) in enumerate(batch):
+                result[:, :, y:y + tile_h, x0:x0 + tile_w] += output[j * rows:(j + 1) * rows].float() * weights[i + j]
+
+            i += len(batch)
+
+        return (result / total).to(x.dtype)
+
+    def fit(self, device, tile_memory):
+        limit = max(shared.opts.sd_upscale_max_tile_batch, 1)
+
+        budget = memory_budget(device)
+        if budget is None or tile_memory <= 0:
+            return limit
+
+        return max(min(limit, budget // tile_memory), 1)
+
+
+class TiledEncoder:
+    """Stands in for sd_model.encode_first_stage: encodes the whole image at once, and if that runs out of memory,
+    encodes overlapping tiles and blends the distributions they give"""
+
+    def __init__(self, encode_first_stage, tile_h, tile_w, overlap):
+        self.encode_first_stage = encode_first_stage
+        self.tile_h = tile_h
+        self.tile_w = tile_w
+        self.overlap = overlap
+
+    def __call__(self, x):
+        try:
+            return self.encode_first_stage(x)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+
+        # the exception is out of scope here, so the memory its traceback held on to can be freed
+        devices.torch_gc()
+        print("VAE encode ran out of memory, encoding in tiles")
+
+        return self.encode_tiled(x)
+
+    def encode_tiled(self, x):
+        height, width = x.shape[2] // 8, x.shape[3] // 8
+        tile_h = min(self.tile_h, height)
+        tile_w = min(self.tile_w, width)
+        overlap = min(self.overlap, tile_h // 2, tile_w // 2)
+
+        positions, weights, total = tile_weights(height, width, tile_h, tile_w, overlap)
+
+        result = None
+        for (y, x0), weight in zip(positions, weights):
+            moments = self.encode_first_stage(x[:, :, y * 8:(y + tile_h) * 8, x0 * 8:(x0 + tile_w) * 8]).parameters
+            if result is None:
+                result = torch.zeros((x.shape[0], moments.shape[1], height, width), device=moments.device, dtype=torch.float32)
+
+            result[:, :, y:y + tile_h, x0:x0 + tile_w] += moments.float() * weight.to(moments.device)
+
+        return DiagonalGaussianDistribution((result / total.to(result.device)).to(x.dtype))
+
+
+@contextlib.contextmanager
+def tiled_model(sd_model, denoiser, encoder):
+    sd_model.apply_model = denoiser
+    sd_model.encode_first_stage = encoder
+
+    try:
+        yield
+    finally:
+        del sd_model.apply_model
+        del sd_model.encode_first_stage
+
+
+def process(p: StableDiffusionProcessingImg2Img, upscaler, scale_factor, overlap):
+    """Upscales p.init_images[0] with upscaler and then redraws it with img2img in tiles of p.width x p.height,
+    overlapping by overlap pixels. Returns Processed with p.n_iter images and a dict with tile and throughput stats.
+
+    Unlike running img2img on every tile, the whole image is encoded once, and every step of a single sampling loop
+    denoises all tiles, blended together in latent space. Images are saved like any img2img result.
+    """
+
+    processing.fix_seed(p)
+
+    p.extra_generation_params["SD upscale overlap"] = overlap
+    p.extra_generation_params["SD upscale upscaler"] = upscaler.name
+
+    init_img = images.flatten(p.init_images[0], shared.opts.img2img_background_color)
+
+    if upscaler.name != "None":
+        img = upscaler.scaler.upscale(init_img, scale_factor, upscaler.data_path)
+    else:
+        img = init_img
+
+    devices.torch_gc()
+
+    tile_h = max(p.height // 8, 8)
+    tile_w = max(p.width // 8, 8)
+    overlap = overlap // 8
+
+    p.init_images = [img]
+    p.width = img.width // 8 * 8
+    p.height = img.height // 8 * 8
+    p.resize_mode = 0
+    p.batch_size = 1
+    p.do_not_save_grid = True
+    shared.state.job_count = p.n_iter
+
+    denoiser = TiledDenoiser(p.sd_model.apply_model, tile_h, tile_w, overlap)
+    encoder = TiledEncoder(p.sd_model.encode_first_stage, tile_h, tile_w, overlap)
+
+    start = time.perf_counter()
+    with tiled_model(p.sd_model, denoiser, encoder):
+        processed = processing.process_images(p)
+    elapsed = time.perf_counter() - start
+
+    stats = {
+        "width": p.width,
+        "height": p.height,
+        "tiles": denoiser.tiles,
+        "tile_batch_size": denoiser.batch_size or 0,
+        "unet_calls": denoiser.calls,
+        "tile_evaluations": denoiser.evaluations,
+        "time": elapsed,
+        "tiles_per_second": denoiser.evaluations / elapsed if elapsed > 0 else 0.0,
+    }
+
+    print(f"SD upscale: {p.width}x{p.height} in {denoiser.tiles} tiles, {denoiser.evaluations} tile evaluations in {denoiser.calls} UNet calls, {stats['tiles_per_second']:.2f} tiles/s")
+
+    return processed, stats
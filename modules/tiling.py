@@ -0,0 +1,30 @@
+"""Helpers shared by code that works on overlapping tiles: the VAE decoder, upscalers and tiled img2img. Only needs
+torch, so that importing it does not pull in the Stable Diffusion model code."""
+
+import torch
+
+
+def is_out_of_memory(e):
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+def tile_positions(size, tile, overlap):
+    if size <= tile:
+        return [0]
+
+    stride = tile - overlap
+    return list(range(0, size - tile, stride)) + [size - tile]
+
+
+def blend_ramp(size, overlap, start, end):
+    """weights along one side of a tile: rising over the overlap at the start and falling at the end where the tile
+    overlaps its neighbours, 1 elsewhere; never 0, so every pixel has some weight"""
+
+    res = torch.ones(size)
+    ramp = torch.linspace(0, 1, overlap + 2)[1:-1]
+    if start and overlap > 0:
+        res[:overlap] = ramp
+    if end and overlap > 0:
+        res[-overlap:] = ramp.flip(0)
+
+    return res
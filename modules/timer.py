@@ -1,11 +1,37 @@
+import os
 import time
 
 
+def read_peak_rss():
+    """returns the highest resident set size this process has had, in bytes; where that is not available, returns the
+    current resident set size, or None if that can't be determined either"""
+
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss
+    except Exception:
+        return None
+
+
 class Timer:
-    def __init__(self):
+    def __init__(self, track_memory=False):
         self.start = time.time()
         self.records = {}
         self.total = 0
+        self.track_memory = track_memory
+        self.peak_rss = {}
+
+        # the peak is never reset, since that would affect the whole process; a category's peak is only recorded
+        # if the process reached a new high during it
+        self.last_peak_rss = read_peak_rss() if track_memory else None
 
     def elapsed(self):
         end = time.time()
@@ -21,6 +47,20 @@ class Timer:
         self.records[category] += e + extra_time
         self.total += e + extra_time
 
+        if self.track_memory:
+            rss = read_peak_rss()
+            if rss is not None and (self.last_peak_rss is None or rss > self.last_peak_rss):
+                self.peak_rss[category] = max(self.peak_rss.get(category, 0), rss)
+                self.last_peak_rss = rss
+
+    def format_record(self, category, time_taken):
+        res = f"{category}: {time_taken:.1f}s"
+
+        if category in self.peak_rss:
+            res += f" [{self.peak_rss[category] / 1024 ** 3:.1f} GB]"
+
+        return res
+
     def summary(self):
         res = f"{self.total:.1f}s"
 
@@ -29,7 +69,10 @@ class Timer:
             return res
 
         res += " ("
-        res += ", ".join([f"{category}: {time_taken:.1f}s" for category, time_taken in additions])
+        res += ", ".join([self.format_record(category, time_taken) for category, time_taken in additions])
         res += ")"
 
+        if self.peak_rss:
+            res += f"; peak RAM {max(self.peak_rss.values()) / 1024 ** 3:.1f} GB"
+
         return res
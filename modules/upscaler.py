@@ -1,4 +1,7 @@
+import itertools
 import os
+import threading
+import time
 from abc import abstractmethod
 
 import PIL
@@ -7,12 +10,39 @@ import torch
 from PIL import Image
 
 import modules.shared
-from modules import modelloader, shared
+from modules import modelloader, shared, lru_cache
 
 LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
 NEAREST = (Image.Resampling.NEAREST if hasattr(Image, 'Resampling') else Image.NEAREST)
 
 
+def model_size(model):
+    """bytes taken by the weights of a network returned by load_model, or by the network in its model attribute"""
+
+    module = model if isinstance(model, torch.nn.Module) else getattr(model, "model", None)
+    if not isinstance(module, torch.nn.Module):
+        return 0
+
+    return sum(x.numel() * x.element_size() for x in itertools.chain(module.parameters(), module.buffers()))
+
+
+# networks made by load_model of all upscalers, by (upscaler name, path, file modification time)
+model_cache = lru_cache.LruCache("upscaler_models", lambda: shared.opts.upscaler_model_cache_mb * 1024 * 1024, size_of=model_size)
+
+# time spent loading models and upscaling with them, by (upscaler name, path)
+timings = {}
+timings_lock = threading.Lock()
+
+
+def record_timing(name, path, load_time, upscale_time, count=1):
+    with timings_lock:
+        timing = timings.setdefault((name, path), {"loads": 0, "load_time": 0.0, "upscales": 0, "upscale_time": 0.0})
+        timing["loads"] += 1 if load_time > 0 else 0
+        timing["load_time"] += load_time
+        timing["upscales"] += count
+        timing["upscale_time"] += upscale_time
+
+
 class Upscaler:
     name = None
     model_path = None
@@ -36,6 +66,7 @@ class Upscaler:
         self.half = not modules.shared.cmd_opts.no_half
         self.pre_pad = 0
         self.mod_scale = None
+        self.load_time = 0.0
 
         if self.model_path is None and self.name:
             self.model_path = os.path.join(shared.models_path, self.name)
@@ -52,31 +83,70 @@ class Upscaler:
     def do_upscale(self, img: PIL.Image, selected_model: str):
         return img
 
+    def do_upscale_batch(self, imgs, selected_model: str):
+        """do_upscale() for several images; upscalers that can run images through their network together override
+        this"""
+
+        return [self.do_upscale(img, selected_model) for img in imgs]
+
     def upscale(self, img: PIL.Image, scale, selected_model: str = None):
+        return self.upscale_batch([img], scale, selected_model)[0]
+
+    def upscale_batch(self, imgs, scale, selected_model: str = None):
+        """upscale() for several images, each going through do_upscale_batch() as many times as it needs"""
+
         self.scale = scale
-        dest_w = int(img.width * scale)
-        dest_h = int(img.height * scale)
+        imgs = list(imgs)
+        dest = [(int(img.width * scale), int(img.height * scale)) for img in imgs]
+
+        start = time.perf_counter()
+        self.load_time = 0.0
 
+        pending = list(range(len(imgs)))
         for i in range(3):
-            shape = (img.width, img.height)
+            shapes = [(imgs[j].width, imgs[j].height) for j in pending]
 
-            img = self.do_upscale(img, selected_model)
+            for j, img in zip(pending, self.do_upscale_batch([imgs[j] for j in pending], selected_model)):
+                imgs[j] = img
 
-            if shape == (img.width, img.height):
+            pending = [j for j, shape in zip(pending, shapes) if shape != (imgs[j].width, imgs[j].height) and (imgs[j].width < dest[j][0] or imgs[j].height < dest[j][1])]
+            if not pending:
                 break
 
-            if img.width >= dest_w and img.height >= dest_h:
-                break
+        for j, (dest_w, dest_h) in enumerate(dest):
+            if imgs[j].width != dest_w or imgs[j].height != dest_h:
+                imgs[j] = imgs[j].resize((int(dest_w), int(dest_h)), resample=LANCZOS)
 
-        if img.width != dest_w or img.height != dest_h:
-            img = img.resize((int(dest_w), int(dest_h)), resample=LANCZOS)
+        record_timing(self.name, selected_model, self.load_time, time.perf_counter() - start - self.load_time, len(imgs))
 
-        return img
+        return imgs
 
     @abstractmethod
     def load_model(self, path: str):
         pass
 
+    def load_model_cached(self, path: str):
+        """returns what load_model(path) returns, from model_cache unless the file has changed since it was loaded;
+        the time spent loading counts towards load rather than upscale time"""
+
+        key = (self.name, path, os.path.getmtime(path) if path and os.path.exists(path) else None)
+
+        model = model_cache.get(key)
+        if model is not None:
+            return model
+
+        start = time.perf_counter()
+        model = self.load_model(path)
+        elapsed = time.perf_counter() - start
+
+        model_cache.record_load(elapsed)
+        self.load_time += elapsed
+
+        if model is not None:
+            model_cache.put(key, model)
+
+        return model
+
     def find_models(self, ext_filter=None) -> list:
         return modelloader.load_models(model_path=self.model_path, model_url=self.model_url, command_path=self.user_path)
 
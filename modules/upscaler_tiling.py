@@ -0,0 +1,223 @@
+import concurrent.futures
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from modules import shared
+from modules.tiling import is_out_of_memory, tile_positions, blend_ramp
+
+
+def image_to_tensor(img, device, dtype, bgr=True):
+    x = np.array(img.convert("RGB"))
+    if bgr:
+        x = x[:, :, ::-1]
+
+    x = torch.from_numpy(np.ascontiguousarray(np.moveaxis(x, 2, 0)))
+
+    return x.unsqueeze(0).to(device).to(dtype) / 255
+
+
+def tensor_to_image(x, bgr=True):
+    x = x[0].float().clamp_(0, 1).mul_(255).round_().byte().cpu().numpy()
+    x = np.moveaxis(x, 0, 2)
+    if bgr:
+        x = x[:, :, ::-1]
+
+    return Image.fromarray(np.ascontiguousarray(x), "RGB")
+
+
+def memory_budget(device):
+    """returns how many bytes upscaling may use on device, or None if it can not be told (not on CUDA)"""
+
+    if device.type != "cuda":
+        return None
+
+    free, _ = torch.cuda.mem_get_info(device)
+    cached = torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+    return int((free + cached) * 0.8)
+
+
+def run_batch(model, xs, positions, tile_h, tile_w):
+    batch = torch.cat([xs[k][:, :, y:y + tile_h, x0:x0 + tile_w] for k, y, x0 in positions])
+
+    with torch.no_grad():
+        return model(batch)
+
+
+class TiledUpscale:
+    """Upscales image tensors with a network in overlapping tiles.
+
+    Tiles are cut from tensors on the device and run through the network several at a time, from one image or from
+    several: on CUDA as many as the memory left over fits, judging by what the first tile took, and on CPU in
+    parallel threads. The outputs are blended into the results on the device with weights that fade out across the
+    overlaps, so seams don't show.
+    """
+
+    def __init__(self, model, device, tile, overlap, pad_to=1, desc=None):
+        self.model = model
+        self.device = device
+        self.tile = tile
+        self.overlap = overlap
+        self.pad_to = pad_to
+        self.desc = desc
+
+    def pad(self, x):
+        height, width = x.shape[2], x.shape[3]
+        pad_h = -height % self.pad_to
+        pad_w = -width % self.pad_to
+        if pad_h == 0 and pad_w == 0:
+            return x
+
+        mode = "reflect" if pad_h < height and pad_w < width else "replicate"
+        return torch.nn.functional.pad(x, (0, pad_w, 0, pad_h), mode=mode)
+
+    def batch_size(self, tile_memory, tiles):
+        limit = min(max(shared.opts.upscaler_tile_batch_size, 1), tiles)
+
+        budget = memory_budget(self.device)
+        if budget is None or tile_memory <= 0:
+            return limit
+
+        return max(min(limit, budget // tile_memory), 1)
+
+    def upscale(self, x):
+        """upscales x, a (1, channels, height, width) tensor on the device, and returns the result as float32"""
+
+        return self.upscale_batch([x])[0]
+
+    def upscale_batch(self, xs):
+        """upscale() for a list of tensors of any sizes; tiles of the same size from different tensors go through
+        the network together"""
+
+        sizes = [(x.shape[2], x.shape[3]) for x in xs]
+        xs = [self.pad(x) for x in xs]
+
+        if self.tile <= 0:
+            res = []
+            for x, (height, width) in zip(xs, sizes):
+                with torch.no_grad():
+                    output = self.model(x).float()
+
+                scale = output.shape[2] // x.shape[2]
+                res.append(output[:, :, :height * scale, :width * scale])
+
+            return res
+
+        tile = max(self.tile // self.pad_to * self.pad_to, self.pad_to)
+
+        # tiles are grouped by size, because only tiles of the same size can go into one batch
+        layouts = []
+        groups = {}
+        for k, x in enumerate(xs):
+            tile_h = min(tile, x.shape[2])
+            tile_w = min(tile, x.shape[3])
+            overlap = min(self.overlap, tile_h // 2, tile_w // 2)
+            layouts.append((tile_h, tile_w, overlap))
+
+            groups.setdefault((tile_h, tile_w), []).extend((k, y, x0) for y in tile_positions(x.shape[2], tile_h, overlap) for x0 in tile_positions(x.shape[3], tile_w, overlap))
+
+        results = [None] * len(xs)
+        weights = [None] * len(xs)
+        scales = [1] * len(xs)
+
+        def blend(outputs, batch_positions):
+            for output, (k, y, x0) in zip(outputs, batch_positions):
+                tile_h, tile_w, overlap = layouts[k]
+                height, width = xs[k].shape[2], xs[k].shape[3]
+
+                if results[k] is None:
+                    scales[k] = output.shape[1] // tile_h
+                    results[k] = torch.zeros((1, output.shape[0], height * scales[k], width * scales[k]), device=self.device, dtype=torch.float32)
+                    weights[k] = torch.zeros((1, 1, height * scales[k], width * scales[k]), device=self.device, dtype=torch.float32)
+
+                scale = scales[k]
+                weight = blend_ramp(tile_h * scale, overlap * scale, y > 0, y + tile_h < height)[:, None] * blend_ramp(tile_w * scale, overlap * scale, x0 > 0, x0 + tile_w < width)[None, :]
+                weight = weight.to(self.device)
+
+                results[k][:, :, y * scale:(y + tile_h) * scale, x0 * scale:(x0 + tile_w) * scale] += output.float() * weight
+                weights[k][:, :, y * scale:(y + tile_h) * scale, x0 * scale:(x0 + tile_w) * scale] += weight
+
+            pbar.update(len(batch_positions))
+
+        with tqdm(total=sum(len(x) for x in groups.values()), desc=self.desc, disable=self.desc is None) as pbar:
+            tile_memory = None
+            for (tile_h, tile_w), positions in groups.items():
+                if tile_memory is None:
+                    if self.device.type == "cuda":
+                        torch.cuda.reset_peak_memory_stats(self.device)
+                    allocated = torch.cuda.memory_allocated(self.device) if self.device.type == "cuda" else 0
+
+                    # the first tile goes alone to find out how much memory a tile takes
+                    blend(run_batch(self.model, xs, positions[:1], tile_h, tile_w), positions[:1])
+                    tile_memory = torch.cuda.max_memory_allocated(self.device) - allocated if self.device.type == "cuda" else 0
+                    tile_area = tile_h * tile_w
+                    positions = positions[1:]
+
+                if self.device.type == "cpu" and shared.opts.upscaler_cpu_threads > 1:
+                    self.run_threaded(xs, positions, tile_h, tile_w, blend)
+                else:
+                    self.run_batched(xs, positions, tile_h, tile_w, blend, self.batch_size(tile_memory * tile_h * tile_w // tile_area, len(positions)))
+
+        res = []
+        for x, result, weight, scale, (height, width) in zip(xs, results, weights, scales, sizes):
+            # an image can be left without any tiles done if upscaling was interrupted
+            if result is None:
+                res.append(x.float()[:, :, :height, :width])
+                continue
+
+            res.append((result / weight.clamp_(min=1e-8))[:, :, :height * scale, :width * scale])
+
+        return res
+
+    def run_batched(self, xs, positions, tile_h, tile_w, blend, batch_size):
+        i = 0
+        while i < len(positions) and not shared.state.interrupted:
+            batch_positions = positions[i:i + batch_size]
+
+            try:
+                outputs = run_batch(self.model, xs, batch_positions, tile_h, tile_w)
+            except RuntimeError as e:
+                if not is_out_of_memory(e) or batch_size == 1:
+                    raise
+
+                outputs = None
+
+            if outputs is None:
+                torch.cuda.empty_cache()
+                batch_size //= 2
+                print(f"Upscaling ran out of memory, retrying with {batch_size} tiles at a time")
+                continue
+
+            blend(outputs, batch_positions)
+            i += len(batch_positions)
+
+    def run_threaded(self, xs, positions, tile_h, tile_w, blend):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=shared.opts.upscaler_cpu_threads, thread_name_prefix="upscale-tile") as executor:
+            futures = {executor.submit(run_batch, self.model, xs, [position], tile_h, tile_w): position for position in positions}
+
+            for future in concurrent.futures.as_completed(futures):
+                if shared.state.interrupted:
+                    for pending in futures:
+                        pending.cancel()
+                    break
+
+                blend(future.result(), [futures[future]])
+
+
+def upscale(model, img, tile, overlap, device, dtype=torch.float32, pad_to=1, bgr=True, desc=None):
+    """upscales a PIL image with a network that takes and returns (batch, 3, height, width) tensors in the 0..1 range;
+    tile = 0 runs the whole image at once"""
+
+    return upscale_batch(model, [img], tile, overlap, device, dtype, pad_to, bgr, desc)[0]
+
+
+def upscale_batch(model, imgs, tile, overlap, device, dtype=torch.float32, pad_to=1, bgr=True, desc=None):
+    """upscale() for a list of PIL images, running their tiles through the network together"""
+
+    xs = [image_to_tensor(img, device, dtype, bgr) for img in imgs]
+    outputs = TiledUpscale(model, device, tile, overlap, pad_to, desc).upscale_batch(xs)
+
+    return [tensor_to_image(output, bgr) for output in outputs]
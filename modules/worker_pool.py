@@ -0,0 +1,347 @@
+import atexit
+import base64
+import json
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+HEALTH_PATH = "/sdapi/v1/worker/health"
+
+# front end arguments that are not passed on to the workers; the value tells whether the argument takes a value
+front_end_args = {
+    "--worker-devices": True,
+    "--worker-urls": True,
+    "--worker-base-port": True,
+    "--port": True,
+    "--device-id": True,
+    "--listen": False,
+    "--nowebui": False,
+    "--api": False,
+}
+
+
+class WorkerError(Exception):
+    """A worker received the job and answered with an HTTP error."""
+
+    def __init__(self, status_code, detail):
+        super().__init__(f"worker returned {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+class WorkerUnavailable(Exception):
+    pass
+
+
+def basic_auth_header(api_auth):
+    """returns the Authorization header for the first user:password pair of --api-auth, or {} without it"""
+
+    if not api_auth:
+        return {}
+
+    credentials = api_auth.split(",")[0].strip()
+    return {"Authorization": "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")}
+
+
+def request_json(url, data=None, timeout=None, headers=None):
+    headers = dict(headers or {})
+    if data is not None:
+        headers["Content-Type"] = "application/json"
+
+    request = urllib.request.Request(url, data=data, headers=headers)
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as res:
+            return json.loads(res.read())
+    except urllib.error.HTTPError as e:
+        body = e.read().decode("utf-8", "replace")
+        try:
+            detail = json.loads(body).get("detail", body)
+        except (ValueError, AttributeError):
+            detail = body
+
+        raise WorkerError(e.code, detail) from None
+
+
+def is_connection_failure(e):
+    """tells whether the request failed because the worker could not be reached, rather than because it took too long"""
+
+    reason = e.reason if isinstance(e, urllib.error.URLError) else e
+
+    return isinstance(reason, OSError) and not isinstance(reason, (socket.timeout, TimeoutError))
+
+
+class DeviceWorker:
+    """A generation process with its own model replica on one device, reached over HTTP."""
+
+    def __init__(self, name, url, process=None):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.process = process
+        self.healthy = False
+        self.draining = False
+        self.device = None
+        self.checkpoint = None
+        self.checkpoints = set()
+        self.queued = 0
+        self.in_flight = 0
+        self.jobs = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_seen = None
+
+    def has_checkpoint(self, checkpoint):
+        return checkpoint is None or checkpoint in self.checkpoints
+
+    def load(self):
+        # the worker's own queue includes the jobs this dispatcher sent to it, so the two are not added up
+        return max(self.in_flight, self.queued)
+
+    def dict(self):
+        return {
+            "name": self.name,
+            "url": self.url,
+            "healthy": self.healthy,
+            "draining": self.draining,
+            "device": self.device,
+            "checkpoint": self.checkpoint,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_seen": self.last_seen,
+        }
+
+
+class WorkerPool:
+    """Hands generation jobs to device workers.
+
+    A job goes to the healthy worker that is not draining and has the lowest load: the number of jobs it has queued
+    or in flight, plus swap_penalty if the requested checkpoint is not among the models the worker has loaded. Workers
+    are polled every health_interval seconds and a worker that does not answer gets no jobs until it does again. A job
+    that could not be delivered is sent to another worker; one that reached a worker and failed there is not retried.
+    A draining worker gets no new jobs but finishes the ones it has. Workers started with --api-auth are sent the
+    credentials given as api_auth with every request.
+    """
+
+    def __init__(self, workers, swap_penalty=2, health_interval=5.0, request_timeout=None, wait_timeout=300.0, api_auth=None):
+        self.workers = list(workers)
+        self.headers = basic_auth_header(api_auth)
+        self.swap_penalty = swap_penalty
+        self.health_interval = health_interval
+        self.request_timeout = request_timeout
+        self.wait_timeout = wait_timeout
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.monitor = None
+
+    def start(self):
+        with self.condition:
+            if self.monitor is not None and self.monitor.is_alive():
+                return
+
+            self.monitor = threading.Thread(target=self.health_loop, name="worker-pool-health", daemon=True)
+            self.monitor.start()
+
+    def stop(self):
+        self.stopped.set()
+
+        for worker in self.workers:
+            if worker.process is not None and worker.process.poll() is None:
+                worker.process.terminate()
+
+    def health_loop(self):
+        while not self.stopped.is_set():
+            for worker in list(self.workers):
+                self.check(worker)
+
+            self.stopped.wait(self.health_interval)
+
+    def check(self, worker):
+        """asks the worker for its state; returns True if it answered"""
+
+        try:
+            if worker.process is not None and worker.process.poll() is not None:
+                raise WorkerUnavailable(f"process exited with code {worker.process.returncode}")
+
+            health = request_json(worker.url + HEALTH_PATH, timeout=5, headers=self.headers)
+        except Exception as e:
+            self.mark_unhealthy(worker, e)
+            return False
+
+        with self.condition:
+            if not worker.healthy:
+                print(f"Worker {worker.name} at {worker.url} is ready")
+
+            worker.healthy = True
+            worker.failures = 0
+            worker.last_seen = time.time()
+            worker.device = health.get("device")
+            worker.checkpoint = health.get("checkpoint")
+            worker.checkpoints = set(health.get("checkpoints") or [])
+            worker.queued = health.get("queued", 0)
+            self.condition.notify_all()
+
+        return True
+
+    def mark_unhealthy(self, worker, error):
+        with self.condition:
+            if worker.healthy:
+                print(f"Worker {worker.name} at {worker.url} is unavailable: {error}", file=sys.stderr)
+
+            worker.healthy = False
+            worker.failures += 1
+            worker.last_error = str(error)
+
+    def cost(self, worker, checkpoint=None):
+        return worker.load() + (0 if worker.has_checkpoint(checkpoint) else self.swap_penalty)
+
+    def choose(self, checkpoint=None):
+        """picks the worker for a job and counts the job as in flight on it; waits up to wait_timeout for a worker to
+        become available"""
+
+        deadline = time.time() + self.wait_timeout
+
+        with self.condition:
+            while True:
+                candidates = [x for x in self.workers if x.healthy and not x.draining]
+                if candidates:
+                    worker = min(candidates, key=lambda x: (self.cost(x, checkpoint), x.jobs))
+                    worker.in_flight += 1
+                    return worker
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise WorkerUnavailable("no device worker is available")
+
+                self.condition.wait(remaining)
+
+    def run(self, path, payload, checkpoint=None):
+        """posts payload to path on the chosen worker and returns the decoded response"""
+
+        data = json.dumps(payload).encode("utf-8")
+
+        for _ in range(max(len(self.workers), 1)):
+            worker = self.choose(checkpoint)
+            try:
+                res = request_json(worker.url + path, data, timeout=self.request_timeout, headers=self.headers)
+            except (urllib.error.URLError, OSError) as e:
+                if not is_connection_failure(e):
+                    raise
+
+                # the job never reached the worker or died with it; it is safe to run it elsewhere
+                self.mark_unhealthy(worker, e)
+                continue
+            finally:
+                with self.condition:
+                    worker.in_flight -= 1
+                    self.condition.notify_all()
+
+            with self.condition:
+                worker.jobs += 1
+                if checkpoint is not None:
+                    worker.checkpoints.add(checkpoint)
+
+            return res
+
+        raise WorkerUnavailable(f"could not deliver the job to any of {len(self.workers)} device workers")
+
+    def get(self, name):
+        for worker in self.workers:
+            if worker.name == name:
+                return worker
+
+        return None
+
+    def drain(self, name, draining=True):
+        """stops (or with draining=False, resumes) sending jobs to the worker; returns the worker, or None if there is no
+        worker with that name"""
+
+        worker = self.get(name)
+        if worker is None:
+            return None
+
+        with self.condition:
+            worker.draining = draining
+            self.condition.notify_all()
+
+        print(f"Worker {worker.name} is {'draining' if draining else 'taking jobs again'}")
+
+        return worker
+
+    def wait_drained(self, name, timeout=None):
+        """waits until the worker has no jobs from this dispatcher in flight; returns False on timeout"""
+
+        worker = self.get(name)
+        if worker is None:
+            return True
+
+        with self.condition:
+            return self.condition.wait_for(lambda: worker.in_flight == 0, timeout)
+
+    def status(self):
+        with self.condition:
+            return [x.dict() for x in self.workers]
+
+
+def worker_args(argv):
+    """returns argv without the arguments that only apply to the front end"""
+
+    res = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+
+        name = arg.split("=", 1)[0]
+        if name in front_end_args:
+            skip = front_end_args[name] and "=" not in arg
+            continue
+
+        res.append(arg)
+
+    return res
+
+
+def spawn(device_ids, base_port, argv, script="webui.py"):
+    """starts an API-only webui process for each device and returns the workers"""
+
+    workers = []
+    for i, device_id in enumerate(device_ids):
+        port = base_port + i
+        command = [sys.executable, script] + worker_args(argv) + ["--nowebui", "--device-id", device_id, "--port", str(port)]
+
+        print(f"Starting worker for device {device_id} on port {port}")
+        workers.append(DeviceWorker(f"cuda:{device_id}", f"http://127.0.0.1:{port}", subprocess.Popen(command)))
+
+    return workers
+
+
+def enabled(cmd_opts):
+    return bool(cmd_opts.nowebui and (cmd_opts.worker_devices or cmd_opts.worker_urls))
+
+
+def from_cmd_opts(cmd_opts, **kwargs):
+    """returns a started WorkerPool for --worker-devices/--worker-urls, or None if this process generates by itself"""
+
+    if not enabled(cmd_opts):
+        return None
+
+    workers = []
+    if cmd_opts.worker_devices:
+        workers += spawn([x.strip() for x in cmd_opts.worker_devices.split(",") if x.strip()], cmd_opts.worker_base_port, sys.argv[1:])
+    if cmd_opts.worker_urls:
+        workers += [DeviceWorker(x.strip(), x.strip()) for x in cmd_opts.worker_urls.split(",") if x.strip()]
+
+    # spawned workers inherit --api-auth, and remote ones are expected to use the same credentials
+    pool = WorkerPool(workers, api_auth=cmd_opts.api_auth, **kwargs)
+    pool.start()
+    atexit.register(pool.stop)
+
+    return pool
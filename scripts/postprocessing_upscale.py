@@ -49,33 +49,49 @@ class ScriptPostprocessingUpscale(scripts_postprocessing.ScriptPostprocessing):
         }
 
     def upscale(self, image, info, upscaler, upscale_mode, upscale_by,  upscale_to_width, upscale_to_height, upscale_crop):
-        if upscale_mode == 1:
-            upscale_by = max(upscale_to_width/image.width, upscale_to_height/image.height)
-            info["Postprocess upscale to"] = f"{upscale_to_width}x{upscale_to_height}"
-        else:
-            info["Postprocess upscale by"] = upscale_by
+        return self.upscale_batch([image], [info], upscaler, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)[0]
 
-        cache_key = (hash(np.array(image.getdata()).tobytes()), upscaler.name, upscale_mode, upscale_by,  upscale_to_width, upscale_to_height, upscale_crop)
-        cached_image = upscale_cache.pop(cache_key, None)
+    def upscale_batch(self, images, infos, upscaler, upscale_mode, upscale_by,  upscale_to_width, upscale_to_height, upscale_crop):
+        """upscale() for several images; the ones that are not cached and need the same scale are upscaled together"""
 
-        if cached_image is not None:
-            image = cached_image
-        else:
-            image = upscaler.scaler.upscale(image, upscale_by, upscaler.data_path)
+        scales = []
+        for image, info in zip(images, infos):
+            if upscale_mode == 1:
+                scales.append(max(upscale_to_width/image.width, upscale_to_height/image.height))
+                info["Postprocess upscale to"] = f"{upscale_to_width}x{upscale_to_height}"
+            else:
+                scales.append(upscale_by)
+                info["Postprocess upscale by"] = upscale_by
 
-        upscale_cache[cache_key] = image
-        if len(upscale_cache) > shared.opts.upscaling_max_images_in_cache:
-            upscale_cache.pop(next(iter(upscale_cache), None), None)
+        cache_keys = [(hash(np.array(image.getdata()).tobytes()), upscaler.name, upscale_mode, scale,  upscale_to_width, upscale_to_height, upscale_crop) for image, scale in zip(images, scales)]
+        results = [upscale_cache.pop(cache_key, None) for cache_key in cache_keys]
+
+        for scale in dict.fromkeys(scales):
+            indices = [i for i, result in enumerate(results) if result is None and scales[i] == scale]
+            if not indices:
+                continue
+
+            for i, image in zip(indices, upscaler.scaler.upscale_batch([images[i] for i in indices], scale, upscaler.data_path)):
+                results[i] = image
+
+        for cache_key, image in zip(cache_keys, results):
+            upscale_cache[cache_key] = image
+            if len(upscale_cache) > shared.opts.upscaling_max_images_in_cache:
+                upscale_cache.pop(next(iter(upscale_cache), None), None)
 
         if upscale_mode == 1 and upscale_crop:
-            cropped = Image.new("RGB", (upscale_to_width, upscale_to_height))
-            cropped.paste(image, box=(upscale_to_width // 2 - image.width // 2, upscale_to_height // 2 - image.height // 2))
-            image = cropped
-            info["Postprocess crop to"] = f"{image.width}x{image.height}"
+            for i, (image, info) in enumerate(zip(results, infos)):
+                cropped = Image.new("RGB", (upscale_to_width, upscale_to_height))
+                cropped.paste(image, box=(upscale_to_width // 2 - image.width // 2, upscale_to_height // 2 - image.height // 2))
+                results[i] = cropped
+                info["Postprocess crop to"] = f"{cropped.width}x{cropped.height}"
 
-        return image
+        return results
 
     def process(self, pp: scripts_postprocessing.PostprocessedImage, upscale_mode=1, upscale_by=2.0, upscale_to_width=None, upscale_to_height=None, upscale_crop=False, upscaler_1_name=None, upscaler_2_name=None, upscaler_2_visibility=0.0):
+        self.process_batch([pp], upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop, upscaler_1_name, upscaler_2_name, upscaler_2_visibility)
+
+    def process_batch(self, pps, upscale_mode=1, upscale_by=2.0, upscale_to_width=None, upscale_to_height=None, upscale_crop=False, upscaler_1_name=None, upscaler_2_name=None, upscaler_2_visibility=0.0):
         if upscaler_1_name == "None":
             upscaler_1_name = None
 
@@ -91,16 +107,22 @@ class ScriptPostprocessingUpscale(scripts_postprocessing.ScriptPostprocessing):
         upscaler2 = next(iter([x for x in shared.sd_upscalers if x.name == upscaler_2_name and x.name != "None"]), None)
         assert upscaler2 or (upscaler_2_name is None), f'could not find upscaler named {upscaler_2_name}'
 
-        upscaled_image = self.upscale(pp.image, pp.info, upscaler1, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)
-        pp.info[f"Postprocess upscaler"] = upscaler1.name
+        images = [pp.image for pp in pps]
+        infos = [pp.info for pp in pps]
+
+        upscaled_images = self.upscale_batch(images, infos, upscaler1, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)
+        for pp in pps:
+            pp.info[f"Postprocess upscaler"] = upscaler1.name
 
         if upscaler2 and upscaler_2_visibility > 0:
-            second_upscale = self.upscale(pp.image, pp.info, upscaler2, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)
-            upscaled_image = Image.blend(upscaled_image, second_upscale, upscaler_2_visibility)
+            second_upscales = self.upscale_batch(images, infos, upscaler2, upscale_mode, upscale_by, upscale_to_width, upscale_to_height, upscale_crop)
+            upscaled_images = [Image.blend(upscaled_image, second_upscale, upscaler_2_visibility) for upscaled_image, second_upscale in zip(upscaled_images, second_upscales)]
 
-            pp.info[f"Postprocess upscaler 2"] = upscaler2.name
+            for pp in pps:
+                pp.info[f"Postprocess upscaler 2"] = upscaler2.name
 
-        pp.image = upscaled_image
+        for pp, upscaled_image in zip(pps, upscaled_images):
+            pp.image = upscaled_image
 
     def image_changed(self):
         upscale_cache.clear()
@@ -121,11 +143,16 @@ class ScriptPostprocessingUpscaleSimple(ScriptPostprocessingUpscale):
         }
 
     def process(self, pp: scripts_postprocessing.PostprocessedImage, upscale_by=2.0, upscaler_name=None):
+        self.process_batch([pp], upscale_by, upscaler_name)
+
+    def process_batch(self, pps, upscale_by=2.0, upscaler_name=None):
         if upscaler_name is None or upscaler_name == "None":
             return
 
         upscaler1 = next(iter([x for x in shared.sd_upscalers if x.name == upscaler_name]), None)
         assert upscaler1, f'could not find upscaler named {upscaler_name}'
 
-        pp.image = self.upscale(pp.image, pp.info, upscaler1, 0, upscale_by, 0, 0, False)
-        pp.info[f"Postprocess upscaler"] = upscaler1.name
+        upscaled_images = self.upscale_batch([pp.image for pp in pps], [pp.info for pp in pps], upscaler1, 0, upscale_by, 0, 0, False)
+        for pp, upscaled_image in zip(pps, upscaled_images):
+            pp.image = upscaled_image
+            pp.info[f"Postprocess upscaler"] = upscaler1.name
@@ -1,6 +1,6 @@
 from collections import namedtuple
 from copy import copy
-from itertools import permutations, chain
+from itertools import permutations, chain, product
 import random
 import csv
 from io import StringIO
@@ -10,7 +10,7 @@ import numpy as np
 import modules.scripts as scripts
 import gradio as gr
 
-from modules import images, paths, sd_samplers, processing, sd_models, sd_vae
+from modules import images, paths, sd_samplers, processing, sd_models, sd_vae, extra_networks
 from modules.processing import process_images, Processed, StableDiffusionProcessingTxt2Img
 from modules.shared import opts, cmd_opts, state
 import modules.shared as shared
@@ -157,7 +157,7 @@ def str_permutations(x):
 
 
 class AxisOption:
-    def __init__(self, label, type, apply, format_value=format_value_add_label, confirm=None, cost=0.0, choices=None):
+    def __init__(self, label, type, apply, format_value=format_value_add_label, confirm=None, cost=0.0, choices=None, batchable=False):
         self.label = label
         self.type = type
         self.apply = apply
@@ -166,6 +166,9 @@ class AxisOption:
         self.cost = cost
         self.choices = choices
 
+        # the axis only changes prompts or seeds, so cells that differ only in its values can be sampled in one batch
+        self.batchable = batchable
+
 
 class AxisOptionImg2Img(AxisOption):
     def __init__(self, *args, **kwargs):
@@ -180,14 +183,14 @@ class AxisOptionTxt2Img(AxisOption):
 
 axis_options = [
     AxisOption("Nothing", str, do_nothing, format_value=format_nothing),
-    AxisOption("Seed", int, apply_field("seed")),
-    AxisOption("Var. seed", int, apply_field("subseed")),
+    AxisOption("Seed", int, apply_field("seed"), batchable=True),
+    AxisOption("Var. seed", int, apply_field("subseed"), batchable=True),
     AxisOption("Var. strength", float, apply_field("subseed_strength")),
     AxisOption("Steps", int, apply_field("steps")),
     AxisOptionTxt2Img("Hires steps", int, apply_field("hr_second_pass_steps")),
     AxisOption("CFG Scale", float, apply_field("cfg_scale")),
-    AxisOption("Prompt S/R", str, apply_prompt, format_value=format_value),
-    AxisOption("Prompt order", str_permutations, apply_order, format_value=format_value_join_list),
+    AxisOption("Prompt S/R", str, apply_prompt, format_value=format_value, batchable=True),
+    AxisOption("Prompt order", str_permutations, apply_order, format_value=format_value_join_list, batchable=True),
     AxisOptionTxt2Img("Sampler", str, apply_sampler, format_value=format_value, confirm=confirm_samplers, choices=lambda: [x.name for x in sd_samplers.samplers]),
     AxisOptionImg2Img("Sampler", str, apply_sampler, format_value=format_value, confirm=confirm_samplers, choices=lambda: [x.name for x in sd_samplers.samplers_for_img2img]),
     AxisOption("Checkpoint name", str, apply_checkpoint, format_value=format_value, confirm=confirm_checkpoints, cost=1.0, choices=lambda: list(sd_models.checkpoints_list)),
@@ -205,7 +208,60 @@ axis_options = [
 ]
 
 
-def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend, include_lone_images, include_sub_grids, first_axes_processed, second_axes_processed, margin_size):
+def plan_cells(p, axes, max_batch_size):
+    """Decides in what order the cells of the grid are processed and which of them are sampled together.
+
+    axes is a list of (AxisOption, values) for x, y and z. Cells are ordered so that the values of expensive axes, like
+    checkpoint and VAE, change as rarely as possible, and then so that cells with the same extra networks in the prompt
+    come one after another. Consecutive cells that differ only in values of batchable axes are put into batches of up to
+    max_batch_size cells.
+
+    Returns a list of (cells, pc) for every batch: cells is a list of (ix, iy, iz), and pc is a copy of p with the
+    axes of the first cell applied, except expensive ones, for estimating the cost.
+    """
+
+    ranked = sorted(range(len(axes)), key=lambda i: -axes[i][0].cost)
+    batching = max_batch_size > 1 and any(opt.batchable for opt, _ in axes)
+    networks_order = {}
+    planned = []
+
+    for indices in product(*[range(len(values)) for _, values in axes]):
+        pc = copy(p)
+        pc.styles = pc.styles[:]
+        for (opt, values), i in zip(axes, indices):
+            if opt.cost <= 0:
+                opt.apply(pc, values[i], values)
+
+        # extra networks like LoRA are activated for the whole batch, and changing them costs time too
+        _, extra_network_data = extra_networks.parse_prompts([pc.prompt])
+        networks = repr(sorted((name, [params.items for params in params_list]) for name, params_list in extra_network_data.items()))
+
+        state_key = (
+            tuple(indices[i] for i in ranked if axes[i][0].cost > 0),
+            networks_order.setdefault(networks, len(networks_order)),
+            tuple(indices[i] for i in ranked if axes[i][0].cost <= 0 and not axes[i][0].batchable),
+        )
+
+        batch_key = processing.coalesce_key(pc, allow_scripts=True) if batching and pc.batch_size == 1 else None
+
+        planned.append((state_key, batch_key, indices, pc))
+
+    planned.sort(key=lambda x: x[0])
+
+    res = []
+    last_key = None
+    for state_key, batch_key, indices, pc in planned:
+        if batch_key is not None and (state_key, batch_key) == last_key and len(res[-1][0]) < max_batch_size:
+            res[-1][0].append(indices)
+            continue
+
+        res.append(([indices], pc))
+        last_key = (state_key, batch_key)
+
+    return res
+
+
+def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, batches, process_batch, draw_legend, include_lone_images, include_sub_grids, margin_size):
     hor_texts = [[images.GridAnnotation(x)] for x in x_labels]
     ver_texts = [[images.GridAnnotation(y)] for y in y_labels]
     title_texts = [[images.GridAnnotation(z)] for z in z_labels]
@@ -218,18 +274,15 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
     cell_mode = "P"
     cell_size = (1, 1)
 
-    state.job_count = len(xs) * len(ys) * len(zs) * p.n_iter
+    cell_count = len(xs) * len(ys) * len(zs)
+    state.job_count = len(batches) * p.n_iter
 
-    def process_cell(x, y, z, ix, iy, iz):
+    def process_cell(ix, iy, iz, processed: Processed):
         nonlocal image_cache, processed_result, cell_mode, cell_size
 
         def index(ix, iy, iz):
             return ix + iy * len(xs) + iz * len(xs) * len(ys)
 
-        state.job = f"{index(ix, iy, iz) + 1} out of {len(xs) * len(ys) * len(zs)}"
-
-        processed: Processed = cell(x, y, z)
-
         try:
             # this dereference will throw an exception if the image was not processed
             # (this happens in cases such as if the user stops the process from the UI)
@@ -251,36 +304,14 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
         except:
             image_cache[index(ix, iy, iz)] = Image.new(cell_mode, cell_size)
 
-    if first_axes_processed == 'x':
-        for ix, x in enumerate(xs):
-            if second_axes_processed == 'y':
-                for iy, y in enumerate(ys):
-                    for iz, z in enumerate(zs):
-                        process_cell(x, y, z, ix, iy, iz)
-            else:
-                for iz, z in enumerate(zs):
-                    for iy, y in enumerate(ys):
-                        process_cell(x, y, z, ix, iy, iz)
-    elif first_axes_processed == 'y':
-        for iy, y in enumerate(ys):
-            if second_axes_processed == 'x':
-                for ix, x in enumerate(xs):
-                    for iz, z in enumerate(zs):
-                        process_cell(x, y, z, ix, iy, iz)
-            else:
-                for iz, z in enumerate(zs):
-                    for ix, x in enumerate(xs):
-                        process_cell(x, y, z, ix, iy, iz)
-    elif first_axes_processed == 'z':
-        for iz, z in enumerate(zs):
-            if second_axes_processed == 'x':
-                for ix, x in enumerate(xs):
-                    for iy, y in enumerate(ys):
-                        process_cell(x, y, z, ix, iy, iz)
-            else:
-                for iy, y in enumerate(ys):
-                    for ix, x in enumerate(xs):
-                        process_cell(x, y, z, ix, iy, iz)
+    done = 0
+    for batch in batches:
+        state.job = f"{done + 1} out of {cell_count}" if len(batch) == 1 else f"{done + 1}-{done + len(batch)} out of {cell_count}"
+
+        for (ix, iy, iz), processed in zip(batch, process_batch(batch)):
+            process_cell(ix, iy, iz, processed)
+
+        done += len(batch)
 
     if not processed_result:
         print("Unexpected error: draw_xyz_grid failed to return even a single processed image")
@@ -310,11 +341,17 @@ class SharedSettingsStackHelper(object):
     def __enter__(self):
         self.CLIP_stop_at_last_layers = opts.CLIP_stop_at_last_layers
         self.vae = opts.sd_vae
-  
+        self.checkpoint_info = shared.sd_model.sd_checkpoint_info if shared.sd_model is not None else None
+        self.vae_file = modules.sd_vae.loaded_vae_file
+
     def __exit__(self, exc_type, exc_value, tb):
         opts.data["sd_vae"] = self.vae
-        modules.sd_models.reload_model_weights()
-        modules.sd_vae.reload_vae_weights()
+
+        # only checkpoint and VAE axes change what is loaded; without them there is nothing to restore
+        if shared.sd_model is None or shared.sd_model.sd_checkpoint_info != self.checkpoint_info:
+            modules.sd_models.reload_model_weights()
+        if modules.sd_vae.loaded_vae_file != self.vae_file:
+            modules.sd_vae.reload_vae_weights()
 
         opts.data["CLIP_stop_at_last_layers"] = self.CLIP_stop_at_last_layers
 
@@ -489,73 +526,30 @@ class Script(scripts.Script):
             ys = fix_axis_seeds(y_opt, ys)
             zs = fix_axis_seeds(z_opt, zs)
 
-        if x_opt.label == 'Steps':
-            total_steps = sum(xs) * len(ys) * len(zs)
-        elif y_opt.label == 'Steps':
-            total_steps = sum(ys) * len(xs) * len(zs)
-        elif z_opt.label == 'Steps':
-            total_steps = sum(zs) * len(xs) * len(ys)
-        else:
-            total_steps = p.steps * len(xs) * len(ys) * len(zs)
-
-        if isinstance(p, StableDiffusionProcessingTxt2Img) and p.enable_hr:
-            if x_opt.label == "Hires steps":
-                total_steps += sum(xs) * len(ys) * len(zs)
-            elif y_opt.label == "Hires steps":
-                total_steps += sum(ys) * len(xs) * len(zs)
-            elif z_opt.label == "Hires steps":
-                total_steps += sum(zs) * len(xs) * len(ys)
-            elif p.hr_second_pass_steps:
-                total_steps += p.hr_second_pass_steps * len(xs) * len(ys) * len(zs)
-            else:
-                total_steps *= 2
-
-        total_steps *= p.n_iter
-
-        image_cell_count = p.n_iter * p.batch_size
-        cell_console_text = f"; {image_cell_count} images per cell" if image_cell_count > 1 else ""
-        plural_s = 's' if len(zs) > 1 else ''
-        print(f"X/Y/Z plot will create {len(xs) * len(ys) * len(zs) * image_cell_count} images on {len(zs)} {len(xs)}x{len(ys)} grid{plural_s}{cell_console_text}. (Total steps to process: {total_steps})")
-        shared.total_tqdm.updateTotal(total_steps)
-
         grid_infotext = [None]
 
-        # If one of the axes is very slow to change between (like SD model
-        # checkpoint), then make sure it is in the outer iteration of the nested
-        # `for` loop.
-        first_axes_processed = 'x'
-        second_axes_processed = 'y'
-        if x_opt.cost > y_opt.cost and x_opt.cost > z_opt.cost:
-            first_axes_processed = 'x'
-            if y_opt.cost > z_opt.cost:
-                second_axes_processed = 'y'
-            else:
-                second_axes_processed = 'z'
-        elif y_opt.cost > x_opt.cost and y_opt.cost > z_opt.cost:
-            first_axes_processed = 'y'
-            if x_opt.cost > z_opt.cost:
-                second_axes_processed = 'x'
-            else:
-                second_axes_processed = 'z'
-        elif z_opt.cost > x_opt.cost and z_opt.cost > y_opt.cost:
-            first_axes_processed = 'z'
-            if x_opt.cost > y_opt.cost:
-                second_axes_processed = 'x'
-            else:
-                second_axes_processed = 'y'
-
-        def cell(x, y, z):
+        def process_batch(cells):
             if shared.state.interrupted:
-                return Processed(p, [], p.seed, "")
-
-            pc = copy(p)
-            pc.styles = pc.styles[:]
-            x_opt.apply(pc, x, xs)
-            y_opt.apply(pc, y, ys)
-            z_opt.apply(pc, z, zs)
-
-            res = process_images(pc)
+                return [Processed(p, [], p.seed, "")] * len(cells)
+
+            pcs = []
+            for ix, iy, iz in cells:
+                pc = copy(p)
+                pc.styles = pc.styles[:]
+                x_opt.apply(pc, xs[ix], xs)
+                y_opt.apply(pc, ys[iy], ys)
+                z_opt.apply(pc, zs[iz], zs)
+                pcs.append(pc)
+
+            if len(pcs) > 1:
+                for pc in pcs:
+                    pc.do_not_save_grid = True
+
+                res = processing.process_images_batched(pcs)
+            else:
+                res = [process_images(pcs[0])]
 
+            pc = pcs[0]
             if grid_infotext[0] is None:
                 pc.extra_generation_params = copy(pc.extra_generation_params)
                 pc.extra_generation_params['Script'] = self.title()
@@ -582,7 +576,33 @@ class Script(scripts.Script):
 
             return res
 
+        # planning applies the cheap axes, some of which change settings, so it goes inside the settings stack too
         with SharedSettingsStackHelper():
+            axes = [(x_opt, xs), (y_opt, ys), (z_opt, zs)]
+            plan = plan_cells(p, axes, opts.xyz_grid_max_batch_size)
+
+            total_steps = 0
+            for _, pc in plan:
+                total_steps += pc.steps
+                if isinstance(pc, StableDiffusionProcessingTxt2Img) and pc.enable_hr:
+                    total_steps += pc.hr_second_pass_steps or pc.steps
+
+            total_steps *= p.n_iter
+
+            image_cell_count = p.n_iter * p.batch_size
+            cell_console_text = f"; {image_cell_count} images per cell" if image_cell_count > 1 else ""
+            plural_s = 's' if len(zs) > 1 else ''
+            print(f"X/Y/Z plot will create {len(xs) * len(ys) * len(zs) * image_cell_count} images on {len(zs)} {len(xs)}x{len(ys)} grid{plural_s}{cell_console_text}. (Total steps to process: {total_steps})")
+
+            loads = []
+            for axis, (opt, _) in enumerate(axes):
+                if opt.cost > 0:
+                    used = [cells[0][axis] for cells, _ in plan]
+                    loads.append(f"up to {sum(1 for a, b in zip([None] + used, used) if a != b)} {opt.label} loads")
+
+            print(f"X/Y/Z plot plan: {len(xs) * len(ys) * len(zs)} cells in {len(plan)} sampling calls{''.join(f', {x}' for x in loads)}")
+            shared.total_tqdm.updateTotal(total_steps)
+
             processed, sub_grids = draw_xyz_grid(
                 p,
                 xs=xs,
@@ -591,12 +611,11 @@ class Script(scripts.Script):
                 x_labels=[x_opt.format_value(p, x_opt, x) for x in xs],
                 y_labels=[y_opt.format_value(p, y_opt, y) for y in ys],
                 z_labels=[z_opt.format_value(p, z_opt, z) for z in zs],
-                cell=cell,
+                batches=[cells for cells, _ in plan],
+                process_batch=process_batch,
                 draw_legend=draw_legend,
                 include_lone_images=include_lone_images,
                 include_sub_grids=include_sub_grids,
-                first_axes_processed=first_axes_processed,
-                second_axes_processed=second_axes_processed,
                 margin_size=margin_size
             )
 
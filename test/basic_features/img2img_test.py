@@ -1,3 +1,4 @@
+import os
 import unittest
 import requests
 from gradio.processing_utils import encode_pil_to_base64
@@ -61,6 +62,25 @@ class TestImg2ImgWorking(unittest.TestCase):
 
         self.assertEqual(requests.post(self.url_img2img, json=self.simple_img2img).status_code, 200)
 
+    def test_sd_upscale_api_performed(self):
+        self.simple_img2img["upscaler"] = "Lanczos"
+        self.simple_img2img["scale_factor"] = 2.0
+        self.simple_img2img["overlap"] = 8
+
+        response = requests.post("http://localhost:7860/sdapi/v1/sd-upscale", json=self.simple_img2img)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(response.json()["stats"]["tiles"], 0)
+
+    @unittest.skipUnless(os.environ.get("TEST_ACCESS_TOKEN"), "set TEST_ACCESS_TOKEN to the access token of a verified user with credits")
+    def test_img2img_auth_with_string_preset_performed(self):
+        # img2img declares preset as str, so the preset id arrives as "0", "3", or the default "none"
+        headers = {"Authorization": f"Bearer {os.environ['TEST_ACCESS_TOKEN']}"}
+
+        for preset in [os.environ.get("TEST_PRESET_ID", "0"), "none"]:
+            self.simple_img2img["preset"] = preset
+            response = requests.post("http://localhost:7860/sdapi/v1/img2img-auth", json=self.simple_img2img, headers=headers)
+            self.assertEqual(response.status_code, 200, f"preset {preset!r}: {response.text}")
+
 
 if __name__ == "__main__":
     unittest.main()
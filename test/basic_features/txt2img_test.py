@@ -1,5 +1,9 @@
+import base64
+import io
+import threading
 import unittest
 import requests
+from PIL import Image
 
 
 class TestTxt2ImgWorking(unittest.TestCase):
@@ -75,6 +79,31 @@ class TestTxt2ImgWorking(unittest.TestCase):
         self.simple_txt2img["batch_size"] = 2
         self.assertEqual(requests.post(self.url_txt2img, json=self.simple_txt2img).status_code, 200)
 
+    def png_parameters(self, response):
+        self.assertEqual(response.status_code, 200, response.text)
+        return [Image.open(io.BytesIO(base64.b64decode(x))).info.get("parameters") for x in response.json()["images"]]
+
+    def test_txt2img_merged_requests_have_own_infotext(self):
+        # requests that wait in the queue together are sampled as one batch; each must get the image metadata it
+        # would have had on its own
+        seeds = [101, 102, 103, 104]
+        payloads = [dict(self.simple_txt2img, seed=seed) for seed in seeds]
+        expected = [self.png_parameters(requests.post(self.url_txt2img, json=payload)) for payload in payloads]
+
+        responses = [None] * len(payloads)
+
+        def post(i):
+            responses[i] = requests.post(self.url_txt2img, json=payloads[i])
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(len(payloads))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for seed, response, parameters in zip(seeds, responses, expected):
+            self.assertEqual(self.png_parameters(response), parameters, f"seed {seed}")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,126 @@
+"""Compares applying Lora in every layer call with merging it into the weights once, on layers shaped like the
+attention and feed-forward layers of the SD 1.x UNet.
+
+Run from the repository root: python test/benchmark_lora_merge.py [rank]
+The layers and the Lora are random, so no checkpoint or Lora file is needed; runs on the GPU if there is one.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "extensions-builtin", "Lora"))
+
+import torch
+
+from modules import devices, shared
+
+shared.cmd_opts.lora_dir = tempfile.mkdtemp()
+
+import lora
+
+# (width, number of transformer blocks) of the SD 1.x UNet levels
+levels = [(320, 5), (640, 5), (1280, 6)]
+tokens = {320: 4096, 640: 1024, 1280: 256}
+steps = 20
+loras = 2
+
+
+def make_model(rank):
+    layers = {}
+    for dim, blocks in levels:
+        for block in range(blocks):
+            for name, shape in [("to_q", (dim, dim)), ("to_k", (dim, dim)), ("to_v", (dim, dim)), ("to_out", (dim, dim)), ("ff_in", (dim * 8, dim)), ("ff_out", (dim, dim * 4))]:
+                layer = torch.nn.Linear(shape[1], shape[0]).to(devices.device, devices.dtype)
+                layer.lora_layer_name = f"{dim}_{block}_{name}"
+                layer.benchmark_tokens = tokens[dim]
+                layers[layer.lora_layer_name] = layer
+
+    model = types.SimpleNamespace(lora_layer_mapping=layers, sd_checkpoint_info=types.SimpleNamespace(filename="benchmark.ckpt"))
+
+    networks = []
+    for i in range(loras):
+        network = lora.LoraModule(f"benchmark{i}")
+        network.mtime = 0
+        for name, layer in layers.items():
+            module = lora.LoraUpDownModule()
+            module.down = torch.nn.Linear(layer.in_features, rank, bias=False).to(devices.device, devices.dtype)
+            module.up = torch.nn.Linear(rank, layer.out_features, bias=False).to(devices.device, devices.dtype)
+            module.alpha = rank
+            network.modules[name] = module
+        networks.append(network)
+
+    return model, networks
+
+
+def run_steps(model):
+    layers = list(model.lora_layer_mapping.values())
+    inputs = {(layer.benchmark_tokens, layer.in_features): None for layer in layers}
+    inputs = {key: torch.randn((2, *key), device=devices.device, dtype=devices.dtype) for key in inputs}
+    synchronize()
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        for _ in range(steps):
+            for layer in layers:
+                layer(inputs[(layer.benchmark_tokens, layer.in_features)])
+    synchronize()
+
+    return (time.perf_counter() - start) / steps
+
+
+def timed(func):
+    synchronize()
+    start = time.perf_counter()
+    func()
+    synchronize()
+
+    return time.perf_counter() - start
+
+
+def synchronize():
+    if devices.device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def main():
+    rank = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+
+    torch.nn.Linear_forward_before_lora = torch.nn.Linear.forward
+    torch.nn.Linear.forward = lora.lora_Linear_forward
+
+    model, networks = make_model(rank)
+    shared.sd_model = model
+    shared.opts.data["lora_apply_to_outputs"] = False
+    shared.opts.data["lora_merge_cache_mb"] = 0
+
+    lora.loaded_loras[:] = networks
+    per_forward = run_steps(model)
+
+    merge = timed(lora.merge_loaded_loras)
+    merged = run_steps(model)
+    lora.restore_weights()
+
+    shared.opts.data["lora_merge_cache_mb"] = 8192
+    lora.merge_loaded_loras()
+    lora.restore_weights()
+    merge_cached = timed(lora.merge_loaded_loras)
+    lora.restore_weights()
+
+    lora.loaded_loras.clear()
+    plain = run_steps(model)
+
+    print(f"{len(model.lora_layer_mapping)} layers, {loras} Lora of rank {rank}, on {devices.device}")
+    print(f"step without Lora:         {plain * 1000:8.2f} ms")
+    print(f"step, Lora per forward:    {per_forward * 1000:8.2f} ms")
+    print(f"step, Lora merged:         {merged * 1000:8.2f} ms")
+    print(f"merge:                     {merge * 1000:8.2f} ms")
+    print(f"merge from cache:          {merge_cached * 1000:8.2f} ms")
+    print(f"merging pays off after {merge / max(per_forward - merged, 1e-9):.1f} steps")
+
+
+if __name__ == "__main__":
+    main()
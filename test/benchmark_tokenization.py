@@ -0,0 +1,66 @@
+"""Measures how long it takes to tokenize a prompt with and without the process-wide tokenization cache.
+
+Run from the repository root: python test/benchmark_tokenization.py
+Only the CLIP tokenizer is loaded, so no checkpoint or GPU is needed.
+"""
+
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformers import CLIPTokenizer
+
+from modules import sd_hijack_clip
+from modules.shared import opts
+from modules.textual_inversion.textual_inversion import EmbeddingDatabase
+
+prompts = [
+    "masterpiece, best quality, (ultra-detailed:1.2), 1girl, solo, long hair, looking at viewer, smile, [blush], outdoors, cherry blossoms",
+    "a photo of an astronaut riding a horse on mars, (cinematic lighting), highly detailed, sharp focus, 8k, artstation",
+    "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, jpeg artifacts, signature, watermark, username, blurry",
+    "fantasy landscape with a mountain and an oak in foreground, (snow:0.8), sunset, volumetric fog, BREAK trending on artstation, by greg rutkowski",
+]
+
+repeats = 200
+
+
+def make_clip():
+    wrapped = types.SimpleNamespace(tokenizer=CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14"))
+    hijack = types.SimpleNamespace(embedding_db=EmbeddingDatabase())
+
+    return sd_hijack_clip.FrozenCLIPEmbedderWithCustomWords(wrapped, hijack)
+
+
+def measure(clip, cache_size):
+    opts.tokenization_cache_size = cache_size
+    sd_hijack_clip.tokenization_cache.clear()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for prompt in prompts:
+            clip.process_texts([prompt])
+
+    return (time.perf_counter() - start) / (repeats * len(prompts))
+
+
+def main():
+    clip = make_clip()
+    cache_size = opts.tokenization_cache_size
+
+    try:
+        uncached = measure(clip, 0)
+        cached = measure(clip, max(cache_size, len(prompts)))
+    finally:
+        opts.tokenization_cache_size = cache_size
+
+    print(f"tokenization per prompt without cache: {uncached * 1e6:.1f} us")
+    print(f"tokenization per prompt with cache:    {cached * 1e6:.1f} us")
+    print(f"speedup: {uncached / cached:.1f}x")
+    print(sd_hijack_clip.tokenization_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Measures VAE decode throughput at several resolutions: one image at a time (the old way), batched, tiled, and the
+approx/cheap fast-preview modes.
+
+Run from the repository root: python test/benchmark_vae_decode.py [batch size]
+The VAE is built from configs/v1-inference.yaml with random weights, which decode as fast as trained ones, so no
+checkpoint is needed. The approx mode needs models/VAE-approx/model.pt and is skipped without it.
+"""
+
+import os
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from omegaconf import OmegaConf
+
+from modules import devices, paths, sd_vae_decode
+from modules.processing import decode_first_stage
+from modules.shared import opts
+from ldm.util import instantiate_from_config
+
+resolutions = [512, 768, 1024, 1536, 2048]
+repeats = 3
+
+
+def make_model():
+    config = OmegaConf.load(os.path.join(paths.script_path, "configs", "v1-inference.yaml")).model.params.first_stage_config
+    config.params.lossconfig = {"target": "torch.nn.Identity"}
+    vae = instantiate_from_config(config).to(devices.device, devices.dtype_vae).eval()
+
+    return types.SimpleNamespace(decode_first_stage=lambda z: vae.decode(z / 0.18215))
+
+
+def one_at_a_time(model, samples):
+    return torch.stack([decode_first_stage(model, samples[i:i + 1])[0].cpu() for i in range(samples.shape[0])]).float()
+
+
+def measure(func, samples):
+    if devices.device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func(samples)
+    elapsed = (time.perf_counter() - start) / repeats
+
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if devices.device.type == "cuda" else 0
+
+    return samples.shape[0] / elapsed, peak
+
+
+def main():
+    batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    model = make_model()
+    has_approx = os.path.exists(os.path.join(paths.models_path, "VAE-approx", "model.pt"))
+
+    methods = {
+        "one at a time": lambda x: one_at_a_time(model, x),
+        "batched": lambda x: sd_vae_decode.decode(model, x),
+        "tiled": lambda x: torch.cat([sd_vae_decode.decode_tiled(model, x[i:i + 1], opts.vae_decode_tile_size) for i in range(x.shape[0])]),
+        "cheap": lambda x: sd_vae_decode.decode(model, x, "cheap"),
+    }
+    if has_approx:
+        methods["approx"] = lambda x: sd_vae_decode.decode(model, x, "approx")
+
+    print(f"{'resolution':>10} {'method':>14} {'images/s':>9} {'peak MB':>8}")
+    with torch.no_grad():
+        for resolution in resolutions:
+            samples = torch.randn((batch_size, 4, resolution // 8, resolution // 8), device=devices.device, dtype=devices.dtype_vae)
+
+            for name, func in methods.items():
+                try:
+                    speed, peak = measure(func, samples)
+                    print(f"{resolution:>10} {name:>14} {speed:>9.2f} {peak:>8.0f}")
+                except RuntimeError as e:
+                    if not sd_vae_decode.is_out_of_memory(e):
+                        raise
+                    print(f"{resolution:>10} {name:>14} {'out of memory':>18}")
+
+                devices.torch_gc()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""A stand-in for an API-only webui process on one device, for trying the worker pool without a GPU.
+
+It answers the worker health check and txt2img/img2img requests one job at a time, sleeping step_time per sampling
+step and switch_time whenever a job asks for a checkpoint other than the loaded one.
+
+Run on its own: python test/fake_device_worker.py --port 7870 --device cuda:0 --checkpoint a.safetensors
+"""
+
+import argparse
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 1x1 white PNG
+IMAGE = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4//8/AAX+Av4N70a4AAAAAElFTkSuQmCC"
+
+
+class FakeDevice:
+    def __init__(self, device, checkpoint, step_time, switch_time):
+        self.device = device
+        self.checkpoint = checkpoint
+        self.step_time = step_time
+        self.switch_time = switch_time
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.busy = False
+        self.jobs = 0
+        self.switches = 0
+
+    def health(self):
+        return {"device": self.device, "checkpoint": self.checkpoint, "checkpoints": [self.checkpoint], "queued": self.queued, "busy": self.busy}
+
+    def generate(self, payload):
+        self.queued += 1
+        try:
+            with self.lock:
+                self.busy = True
+                checkpoint = (payload.get("override_settings") or {}).get("sd_model_checkpoint")
+                switched = checkpoint is not None and checkpoint != self.checkpoint
+                if switched:
+                    time.sleep(self.switch_time)
+                    self.checkpoint = checkpoint
+                    self.switches += 1
+
+                count = payload.get("n_iter", 1) * payload.get("batch_size", 1)
+                time.sleep(payload.get("steps", 20) * payload.get("n_iter", 1) * self.step_time)
+                self.jobs += 1
+                self.busy = False
+        finally:
+            self.queued -= 1
+
+        info = {"device": self.device, "checkpoint": self.checkpoint, "switched": switched, "infotexts": [f"{payload.get('prompt', '')}\n\nSteps: {payload.get('steps', 20)}"] * count}
+        return {"images": [IMAGE] * count, "images_compressed": [IMAGE] * count, "parameters": payload, "info": info}
+
+
+def make_handler(fake, api_auth=None):
+    expected = None if api_auth is None else "Basic " + base64.b64encode(api_auth.encode("utf-8")).decode("ascii")
+
+    class Handler(BaseHTTPRequestHandler):
+        def authorized(self):
+            if expected is None or self.headers.get("Authorization") == expected:
+                return True
+
+            self.send_json(401, {"detail": "Incorrect username or password"})
+            return False
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if not self.authorized():
+                return
+
+            if self.path == "/sdapi/v1/worker/health":
+                self.send_json(200, fake.health())
+            else:
+                self.send_json(404, {"detail": "Not Found"})
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not self.authorized():
+                return
+
+            if self.path not in ("/sdapi/v1/txt2img", "/sdapi/v1/img2img"):
+                self.send_json(404, {"detail": "Not Found"})
+            elif self.path == "/sdapi/v1/img2img" and not payload.get("init_images"):
+                self.send_json(404, {"detail": "Init image not found"})
+            else:
+                self.send_json(200, fake.generate(payload))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def make_server(port=0, device="cuda:0", checkpoint="a.safetensors", step_time=0.01, switch_time=0.5, api_auth=None):
+    """returns a not yet started server; port 0 picks a free port, see server.server_address; with api_auth given as
+    user:password, requests without those Basic credentials get 401 like with --api-auth"""
+
+    fake = FakeDevice(device, checkpoint, step_time, switch_time)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(fake, api_auth))
+    server.daemon_threads = True
+    server.fake = fake
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=7870)
+    parser.add_argument("--device", type=str, default="cuda:0")
+    parser.add_argument("--checkpoint", type=str, default="a.safetensors")
+    parser.add_argument("--step-time", type=float, default=0.01, help="seconds per sampling step")
+    parser.add_argument("--switch-time", type=float, default=0.5, help="seconds to switch checkpoints")
+    parser.add_argument("--api-auth", type=str, default=None, help="user:password to require, like the webui option")
+    args = parser.parse_args()
+
+    server = make_server(args.port, args.device, args.checkpoint, args.step_time, args.switch_time, args.api_auth)
+    print(f"Fake worker for {args.device} listening on port {server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Hammers the credit ledger from many threads at once and checks that nobody overspends, that every balance can be
+rebuilt from the credits_update ledger, that adjustments are in the ledger as soon as they are committed and that
+reconciling keeps credits granted before the ledger was kept.
+
+Run from the repository root with the API's .env in place: python test/load_test_credit_ledger.py [database url]
+By default a throwaway SQLite file is used; pass a MySQL URL (mysql+pymysql://...) of a scratch database to test
+against MySQL. Only the credits, credits_update, credits_reservation and credits_opening tables are created and touched.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+from modules.api import models
+from modules.api.config import settings
+from modules.api.ledger import CreditLedger
+
+users = 8
+threads = 32
+attempts = 200
+cost = 30
+
+
+def make_session_factory(url):
+    if url.startswith("sqlite"):
+        engine = create_engine(url, connect_args={"check_same_thread": False, "timeout": 30})
+    else:
+        engine = create_engine(url, pool_size=threads, max_overflow=0)
+
+    tables = [models.CreditsDB.__table__, models.CreditsUpdateDB.__table__, models.CreditsReservationDB.__table__, models.CreditsOpeningDB.__table__]
+    models.Base.metadata.drop_all(bind=engine, tables=tables)
+    models.Base.metadata.create_all(bind=engine, tables=tables)
+
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def worker(ledger, session_factory, emails, stats, lock):
+    db = session_factory()
+    try:
+        for _ in range(attempts):
+            email = random.choice(emails)
+            try:
+                reservation = ledger.reserve(db, email, cost)
+            except HTTPException:
+                with lock:
+                    stats["rejected"] += 1
+                continue
+
+            outcome = random.random()
+            if outcome < 0.7:
+                ledger.commit(db, reservation)
+                charged = cost
+            elif outcome < 0.8:
+                charged = cost // 3
+                ledger.commit(db, reservation, charged)
+            else:
+                ledger.refund(db, reservation)
+                charged = 0
+
+            with lock:
+                stats["charged"] += charged
+                stats["reserved"] += 1
+    finally:
+        db.close()
+
+
+def main():
+    url = sys.argv[1] if len(sys.argv) > 1 else "sqlite:///" + os.path.join(tempfile.mkdtemp(), "ledger.db")
+    session_factory = make_session_factory(url)
+    ledger = CreditLedger(session_factory)
+
+    emails = [f"user{i}@example.com" for i in range(users)]
+    granted = 500
+    with session_factory() as db:
+        db.add_all([models.CreditsDB(email=email, credits=settings.DEFAULT_CREDITS) for email in emails])
+        db.commit()
+
+        # credits granted by an admin before the ledger was kept are not in credits_update
+        ledger.update_balance(db, emails[0], granted)
+        opening = ledger.reconcile(db, apply=True)
+
+    assert opening["opened"] == users and not opening["mismatches"], opening
+
+    # a purchase handled by another process must be visible to this one's reconciliation right away
+    other = CreditLedger(session_factory)
+    with session_factory() as db:
+        other.adjust(db, emails[1], granted)
+        report = ledger.reconcile(db)
+
+    assert not other.pending and not report["mismatches"], report
+
+    stats = {"charged": 0, "reserved": 0, "rejected": 0}
+    lock = threading.Lock()
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(ledger, session_factory, emails, stats, lock)) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    ledger.flush()
+
+    with session_factory() as db:
+        balances = dict(db.query(models.CreditsDB.email, models.CreditsDB.credits).all())
+        ledger_rows = db.query(func.count(models.CreditsUpdateDB.id)).scalar()
+        reservations = db.query(func.count(models.CreditsReservationDB.id)).scalar()
+        report = ledger.reconcile(db, apply=True)
+
+    total_initial = settings.DEFAULT_CREDITS * users + 2 * granted
+    total_left = sum(balances.values())
+
+    print(f"{threads * attempts} attempts in {elapsed:.2f}s ({threads * attempts / elapsed:.0f}/s): {stats['reserved']} reserved, {stats['rejected']} rejected")
+    print(f"charged {stats['charged']} credits, {total_initial - total_left} taken from balances, {ledger_rows} ledger rows")
+    print(f"reconciliation: {report['checked']} checked, {len(report['mismatches'])} mismatches")
+
+    assert min(balances.values()) >= 0, "a balance went negative"
+    assert total_initial - total_left == stats["charged"], "balances do not match the credits charged"
+    assert report["checked"] == users and not report["opened"], report
+    assert not report["mismatches"], report["mismatches"]
+    assert not reservations, f"{reservations} reservations left open"
+
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Runs the device worker pool against several fake device workers on CPU and checks that jobs prefer workers with the
+requested checkpoint loaded, that every worker is used, that a draining worker gets no new jobs, that jobs move on
+to the remaining workers when one goes down and that workers started with --api-auth get the credentials.
+
+Run from the repository root: python test/load_test_worker_pool.py
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_device_worker import make_server
+from modules.worker_pool import DeviceWorker, WorkerPool
+
+checkpoints = ["a.safetensors", "b.safetensors", "c.safetensors"]
+threads = 12
+jobs_per_thread = 10
+
+
+def start_workers(api_auth=None):
+    servers = []
+    for i, checkpoint in enumerate(checkpoints):
+        server = make_server(device=f"cuda:{i}", checkpoint=checkpoint, step_time=0.002, switch_time=0.3, api_auth=api_auth)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+
+    return servers
+
+
+def make_pool(servers, swap_penalty, api_auth=None):
+    pool = WorkerPool([DeviceWorker(f"cuda:{i}", f"http://127.0.0.1:{server.server_address[1]}") for i, server in enumerate(servers)],
+                      swap_penalty=swap_penalty, health_interval=0.1, wait_timeout=10, api_auth=api_auth)
+    pool.start()
+
+    deadline = time.time() + 5
+    while not all(worker.healthy for worker in pool.workers):
+        assert time.time() < deadline, pool.status()
+        time.sleep(0.05)
+
+    return pool
+
+
+def run_jobs(pool, count, seed):
+    rng = random.Random(seed)
+    plan = [[rng.choice(checkpoints) for _ in range(count)] for _ in range(threads)]
+    devices = Counter()
+    switches = 0
+    errors = []
+    lock = threading.Lock()
+
+    def worker(checkpoint_list):
+        nonlocal switches
+        for checkpoint in checkpoint_list:
+            try:
+                res = pool.run("/sdapi/v1/txt2img", {"prompt": "test", "steps": 20, "override_settings": {"sd_model_checkpoint": checkpoint}}, checkpoint)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                continue
+
+            with lock:
+                devices[res["info"]["device"]] += 1
+                switches += res["info"]["switched"]
+
+    start = time.perf_counter()
+    pool_threads = [threading.Thread(target=worker, args=(x,)) for x in plan]
+    for thread in pool_threads:
+        thread.start()
+    for thread in pool_threads:
+        thread.join()
+
+    return devices, switches, errors, time.perf_counter() - start
+
+
+def main():
+    total = threads * jobs_per_thread
+
+    for swap_penalty in (0, 2):
+        servers = start_workers()
+        pool = make_pool(servers, swap_penalty)
+        devices, switches, errors, elapsed = run_jobs(pool, jobs_per_thread, seed=1)
+        print(f"swap penalty {swap_penalty}: {total} jobs in {elapsed:.2f}s, {switches} checkpoint switches, per device {dict(devices)}")
+
+        assert not errors, errors
+        assert sum(devices.values()) == total
+        assert len(devices) == len(servers), "a worker got no jobs"
+
+        pool.stop()
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    servers = start_workers()
+    pool = make_pool(servers, swap_penalty=2)
+
+    pool.drain("cuda:0")
+    devices, _, errors, _ = run_jobs(pool, 3, seed=2)
+    print(f"with cuda:0 draining: per device {dict(devices)}")
+    assert not errors, errors
+    assert "cuda:0" not in devices, "a draining worker got a job"
+    assert pool.wait_drained("cuda:0", timeout=1)
+    pool.drain("cuda:0", False)
+
+    servers[1].shutdown()
+    servers[1].server_close()
+    devices, _, errors, _ = run_jobs(pool, 3, seed=3)
+    print(f"with cuda:1 down: per device {dict(devices)}, status {[(x['name'], x['healthy']) for x in pool.status()]}")
+    assert not errors, errors
+    assert "cuda:1" not in devices
+    assert not pool.get("cuda:1").healthy
+
+    pool.stop()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+    servers = start_workers(api_auth="user:secret")
+    pool = make_pool(servers, swap_penalty=2, api_auth="user:secret,other:password")
+    devices, _, errors, _ = run_jobs(pool, 3, seed=4)
+    print(f"with --api-auth: per device {dict(devices)}")
+    assert not errors, errors
+    assert sum(devices.values()) == threads * 3
+
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()